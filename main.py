@@ -9,23 +9,23 @@ import git
 from pyrogram import enums, idle
 
 from utils.client import CustomClient
-from utils.misc import env, scheduler, scheduler_jobs
-from utils.scripts import Formatter, get_proxy, handle_restart
+from utils.db import db
+from utils.git_info import repo_info
+from utils.misc import env, job_store, scheduler, scheduler_jobs
+from utils.paste_server import paste_server
+from utils.sampler import sampler
+from utils.scripts import get_proxy, handle_restart, setup_logging
+from utils.shell_pool import shell_pool
 from utils.storage import FernetStorage
 
 os.chdir(pathlib.Path(__file__).parent)
 
 
 async def main():
-    stdout_handler = logging.StreamHandler()
-    stdout_handler.setFormatter(
-        Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    )
-
-    logging.basicConfig(
+    log_listener = setup_logging(
         level=logging.INFO,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        handlers=[stdout_handler],
+        log_file=env.str("LOG_FILE", None),
+        max_bytes=(env.int("LOG_FILE_MAX_SIZE_MB", None) or 10) * 2**20,
     )
 
     app = CustomClient(
@@ -44,6 +44,8 @@ async def main():
         parse_mode=enums.ParseMode.HTML,
         skip_updates=False,
         proxy=get_proxy(),
+        updates_queue_size=env.int("UPDATES_QUEUE_SIZE", None) or 10000,
+        updates_shed_policy=env.str("UPDATES_SHED_POLICY", None) or "coalesce",
     )
 
     # For security purposes
@@ -70,21 +72,46 @@ async def main():
     #
     # await handle_restart(app)
 
+    job_store.client = app
+
     for job in scheduler_jobs:
         scheduler.add_job(
             func=job.func,
             trigger=job.trigger,
-            args=[app] + job.args,
+            # The client can't be pickled for the process pool
+            args=job.args if job.options["executor"] == "process" else [app] + job.args,
             kwargs=job.kwargs,
             id=job.id,
+            replace_existing=True,
+            **job.options,
         )
 
     scheduler.start()
 
+    sampler.start(period=db.get("core.sampler", "period", 5))
+    repo_info.refresh()
+
+    if db.get("shell", "pool", True):
+        await shell_pool.start(
+            executable=db.get("shell", "executable"),
+            size=db.get("shell", "pool_size", 2),
+        )
+
+    if env.bool("PASTE_SERVER", False):
+        paste_server.path = pathlib.Path(env.str("PASTE_DIR", None) or ".pastes")
+        paste_server.base_url = env.str("PASTE_SERVER_URL", None)
+        paste_server.max_size = (env.int("PASTE_MAX_SIZE_MB", None) or 100) * 2**20
+        await paste_server.start(
+            host=env.str("PASTE_SERVER_HOST", None) or "0.0.0.0",
+            port=env.int("PASTE_SERVER_PORT", None) or 8080,
+        )
+
     await idle()
 
     await app.stop()
 
+    log_listener.stop()
+
 
 if __name__ == "__main__":
     with contextlib.suppress(KeyboardInterrupt, SystemExit):
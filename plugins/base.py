@@ -1,5 +1,9 @@
+import contextlib
 import datetime
+import html
 import os
+import pathlib
+import re
 import subprocess
 import sys
 from time import perf_counter
@@ -11,13 +15,18 @@ from pyrogram.types import Message
 
 from utils.db import db
 from utils.filters import command
-from utils.misc import modules_help, uptime
+from utils.git_info import repo_info
+from utils.misc import job_stats, modules_help, scheduler, uptime
+from utils.sampler import sampler, sparkline
 from utils.scripts import (
     format_exc,
     get_args,
     get_cpu_usage,
     get_prefix,
     get_ram_usage,
+    install_requirements,
+    requirements_hash,
+    set_prefix,
     shell_exec,
     time_diff,
     with_args,
@@ -69,19 +78,29 @@ async def _restart(_: Client, message: Message):
     os.execvp(sys.executable, [sys.executable, *sys.argv])
 
 
+def _plugin_name(path: str) -> str:
+    return ".".join(pathlib.PurePosixPath(path).with_suffix("").parts[1:])
+
+
 @Client.on_message(
     ~filters.scheduled & command(["update"]) & filters.me & ~filters.forwarded
 )
-async def _update(_: Client, message: Message):
+async def _update(client: Client, message: Message):
     await message.edit("<code>Updating...</code>")
     args, nargs = get_args(message)
 
-    current_hash = git.Repo().head.commit.hexsha
+    steps = []
 
-    git.Repo().remote("origin").fetch()
+    def report(title: str, started: float):
+        steps.append(f"{title}: {perf_counter() - started:.2f}s")
 
-    branch = git.Repo().active_branch.name
-    upcoming = next(git.Repo().iter_commits(f"origin/{branch}", max_count=1)).hexsha
+    local = await repo_info.local()
+    current_hash = local["hash"]
+
+    started = perf_counter()
+    await repo_info.fetch()
+    upcoming = repo_info.remote_hash
+    report("Fetch", started)
 
     if current_hash == upcoming:
         return await message.edit("<b>Userbot already up to date</b>")
@@ -89,51 +108,88 @@ async def _update(_: Client, message: Message):
     if "--hard" in args:
         await shell_exec("git reset --hard HEAD")
 
+    started = perf_counter()
     try:
-        git.Repo().remote("origin").pull()
+        await repo_info.pull()
     except git.exc.GitCommandError as e:
         return await message.edit_text(
             "<b>Update failed! Try again with --hard argument.</b>\n\n"
             f"<code>{e.stderr.strip()}</code>"
         )
+    report("Pull", started)
+
+    changed = await repo_info.changed_files(current_hash, "HEAD")
+    plugins = [
+        path for path in changed if path.startswith("plugins/") and path.endswith(".py")
+    ]
+    # Anything outside plugins/ needs a restart, including non-Python files such as
+    # REPL drivers, which warm pools keep running
+    core = [path for path in changed if not path.startswith("plugins/")]
+
+    new_hash = requirements_hash()
+    if new_hash and new_hash != db.get("core.updater", "requirements_hash"):
+        await message.edit(
+            "<code>Installing requirements...\n\n" + "\n".join(steps) + "</code>"
+        )
 
-    upcoming_version = len(list(git.Repo().iter_commits()))
-    current_version = upcoming_version - (
-        len(list(git.Repo().iter_commits(f"{current_hash}..{upcoming}")))
-    )
+        started = perf_counter()
+        returncode, _, stderr = await install_requirements()
+        report("Pip", started)
 
-    db.set(
-        "core.updater",
-        "restart_info",
-        {
-            "chat_id": message.chat.id,
-            "message_id": message.id,
-            "time": perf_counter(),
-            "hash": current_hash,
-            "version": f"{current_version}",
-            "type": "update",
-        },
-    )
+        if returncode != 0:
+            return await message.edit(
+                "<b>Failed to install requirements, userbot wasn't restarted.</b>\n\n"
+                f"<code>{html.escape(stderr.strip()[-3000:])}</code>"
+            )
 
-    try:
-        subprocess.run([sys.executable, "-m", "pip", "install", "-U", "pip"])
-        subprocess.run(
-            [
-                sys.executable,
-                "-m",
-                "pip",
-                "install",
-                "-U",
-                "-r",
-                "requirements.txt",
-            ]
+        db.set("core.updater", "requirements_hash", new_hash)
+
+    current_version = local["version"]
+
+    if core or "--restart" in args:
+        db.set(
+            "core.updater",
+            "restart_info",
+            {
+                "chat_id": message.chat.id,
+                "message_id": message.id,
+                "time": perf_counter(),
+                "hash": current_hash,
+                "version": f"{current_version}",
+                "type": "update",
+                "steps": "\n".join(steps),
+            },
         )
-    except Exception as e:
-        await message.edit(format_exc(e))
-        db.remove("core.updater", "restart_info")
-    else:
+
+        await message.edit("<code>Restarting...\n\n" + "\n".join(steps) + "</code>")
         os.execvp(sys.executable, [sys.executable, *sys.argv])
 
+    # Only plugins changed, reload them without restarting
+    started = perf_counter()
+    failed = []
+    for path in plugins:
+        name = _plugin_name(path)
+
+        if os.path.isfile(path):
+            if not client.load_plugin(name):
+                failed.append(name)
+        else:
+            client.unload_plugin(name)
+            with contextlib.suppress(ValueError):
+                module = modules_help.get_module_by_path(os.path.abspath(path))
+                modules_help.delete_module(module.name)
+    report(f"Reload ({len(plugins)} plugins)", started)
+
+    result = (
+        f"<b>Userbot updated from</b> <code>{current_hash[:7]}</code> "
+        f"<b>to</b> <code>{upcoming[:7]}</code> <b>without restart</b>\n\n"
+    )
+    if failed:
+        result += f"<b>Failed to load:</b> <code>{', '.join(failed)}</code>\n\n"
+    result += "<code>" + "\n".join(steps) + "</code>"
+
+    await message.edit(result)
+
 
 @Client.on_message(
     ~filters.scheduled
@@ -141,7 +197,7 @@ async def _update(_: Client, message: Message):
     & filters.me
     & ~filters.forwarded
 )
-async def set_prefix(_, message: Message):
+async def prefix_cmd(_, message: Message):
     args, _ = get_args(message)
     prefix = get_prefix()
 
@@ -151,7 +207,7 @@ async def set_prefix(_, message: Message):
             f"To change prefix use <code>{prefix}{message.command[0]} [new prefix]</code>"
         )
 
-    db.set("core.main", "prefix", args[0])
+    set_prefix(args[0])
     await message.edit(f"<b>Prefix changed to:</b> <code>{args[0]}</code>")
 
 
@@ -181,17 +237,16 @@ async def sendmod(client: Client, message: Message):
 @Client.on_message(
     ~filters.scheduled & command(["status"]) & filters.me & ~filters.forwarded
 )
-async def _status(_, message: Message):
+async def _status(client: Client, message: Message):
     args, _ = get_args(message)
 
-    current_hash = git.Repo().head.commit.hexsha
-    git.Repo().remote("origin").fetch()
-    branch = git.Repo().active_branch.name
-    upcoming = next(git.Repo().iter_commits(f"origin/{branch}", max_count=1)).hexsha
-    upcoming_version = len(list(git.Repo().iter_commits()))
-    current_version = upcoming_version - (
-        len(list(git.Repo().iter_commits(f"{current_hash}..{upcoming}")))
-    )
+    info = await repo_info.status()
+    branch = info["branch"]
+    current_hash = info["hash"]
+    current_version = info["version"]
+    # Remote head is fetched in background, show current one until it's known
+    upcoming = info["remote_hash"] or current_hash
+    upcoming_version = info["remote_version"] or current_version
     repo_link = "https://github.com/lonsdale228/Kurimuzon-Userbot"
 
     result = f"<emoji id=5219903664428167948>🤖</emoji> <a href='{repo_link}'>Kurimuzon-Userbot</a> / "
@@ -222,6 +277,12 @@ async def _status(_, message: Message):
     result += f"├─<b>Latest version:</b> <a href='{repo_link}/commit/{upcoming}'>"
     result += f"#{upcoming[:7]} ({upcoming_version})</a>\n"
     result += f"├─<b>Prefix:</b> <code>{get_prefix()}</code>\n"
+    high_depth, low_depth = client.updates_queue.depth
+    queue_stats = client.updates_queue.stats
+    result += (
+        f"├─<b>Updates queue:</b> <code>{high_depth + low_depth}/{client.updates_queue.maxsize} "
+        f"(shed {queue_stats['shed']}, coalesced {queue_stats['coalesced']})</code>\n"
+    )
     result += f"├─<b>Modules:</b> <code>{modules_help.modules_count}</code>\n"
     result += f"└─<b>Commands:</b> <code>{modules_help.commands_count}</code>\n\n"
 
@@ -245,13 +306,115 @@ async def ping(_, message: Message):
     await message.edit(f"<b>Pong! {round(end - start, 3)}s</b>")
 
 
+@Client.on_message(
+    ~filters.scheduled & command(["resources"]) & filters.me & ~filters.forwarded
+)
+async def resources(_, message: Message):
+    args, _ = get_args(message)
+    window = args[0] if args else "15m"
+
+    matches = re.findall(r"(\d+)([smhd])", window)
+    if not matches:
+        return await message.edit("<b>Invalid window, use e.g. 30s, 15m, 1h</b>")
+
+    seconds_map = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    seconds = sum(int(value) * seconds_map[unit] for value, unit in matches)
+
+    samples = sampler.window(seconds)
+    if not samples["time"]:
+        return await message.edit("<b>No samples collected yet</b>")
+
+    metrics = (
+        ("rss", "RAM", "MB"),
+        ("cpu", "CPU", "%"),
+        ("fds", "Open FDs", ""),
+        ("children", "Child processes", ""),
+        ("lag", "Loop lag", "ms"),
+    )
+
+    result = (
+        f"<b>Resources for last {window}</b> "
+        f"(<code>{len(samples['time'])}</code> samples every <code>{sampler.period}s</code>)\n\n"
+    )
+    for name, title, unit in metrics:
+        values = samples[name]
+        result += (
+            f"<b>{title}:</b> <code>{min(values):.1f}/{sum(values) / len(values):.1f}/"
+            f"{max(values):.1f}{unit}</code> (min/avg/max)\n"
+            f"<code>{sparkline(values)}</code>\n"
+        )
+
+    await message.edit(result)
+
+
+@Client.on_message(
+    ~filters.scheduled & command(["jobs"]) & filters.me & ~filters.forwarded
+)
+async def jobs(_, message: Message):
+    scheduled = scheduler.get_jobs()
+
+    if not scheduled:
+        return await message.edit("<b>No scheduled jobs</b>")
+
+    result = f"<b>Scheduled jobs ({len(scheduled)}):</b>\n\n"
+    for job in scheduled:
+        stats = job_stats.get(job.id)
+        next_run = (
+            job.next_run_time.strftime("%Y-%m-%d %H:%M:%S")
+            if job.next_run_time
+            else "paused"
+        )
+        average = stats["total_time"] / stats["runs"] if stats["runs"] else 0
+
+        result += (
+            f"<b>{html.escape(job.id)}</b> (<code>{job.executor}</code>)\n"
+            f"├─<b>Trigger:</b> <code>{html.escape(str(job.trigger))}</code>\n"
+            f"├─<b>Next run:</b> <code>{next_run}</code>\n"
+            f"├─<b>Runs:</b> <code>{stats['runs']} ({stats['errors']} failed)</code>\n"
+            f"├─<b>Time:</b> <code>last {stats['last_time']:.3f}s, avg {average:.3f}s, "
+            f"max {stats['max_time']:.3f}s</code>\n"
+            f"└─<b>Missed:</b> <code>{stats['missed']} "
+            f"(+{stats['skipped']} skipped, already running)</code>\n\n"
+        )
+
+    await message.edit(result)
+
+
+@Client.on_message(
+    ~filters.scheduled & command(["limits"]) & filters.me & ~filters.forwarded
+)
+async def limits(client: Client, message: Message):
+    args, _ = get_args(message)
+    rate_limiter = client.rate_limiter
+
+    if args and args[0] == "reset":
+        rate_limiter.reset()
+        return await message.edit("<b>Learned rate limits cleared</b>")
+
+    if not rate_limiter.buckets:
+        return await message.edit("<b>No rate limits learned, all calls are unlimited</b>")
+
+    result = "<b>Learned rate limits:</b>\n"
+    for key, bucket in sorted(rate_limiter.buckets.items()):
+        result += f"• <code>{key}</code>: <code>{bucket.rate:.2f}/s</code>\n"
+
+    await message.edit(result)
+
+
 module = modules_help.add_module("base", __file__)
 module.add_command(
     "help", "Get common/module/command help.", "[module/command name]", ["h"]
 )
 module.add_command("prefix", "Set custom prefix", None, ["kprefix"])
 module.add_command("restart", "Useful when you want to reload a bot")
-module.add_command("update", "Update the userbot from the repository")
+module.add_command(
+    "update", "Update the userbot from the repository", "[--hard] [--restart]"
+)
 module.add_command("sendmod", "Send module to chat", "[module_name]", ["sm"])
 module.add_command("status", "Get information about the userbot and system", "[-a]")
 module.add_command("ping", "Check ping to Telegram servers", aliases=["p"])
+module.add_command(
+    "resources", "Show resource usage history of the userbot", "[window, e.g. 1h]"
+)
+module.add_command("jobs", "Show scheduled jobs and their statistics")
+module.add_command("limits", "Show API rate limits learned from FloodWaits", "[reset]")
@@ -0,0 +1,248 @@
+import asyncio
+import html
+import re
+import statistics
+from typing import List, Optional, Tuple
+
+from pyrogram import Client, filters
+from pyrogram.types import Message
+
+from utils.db import db
+from utils.executions import queued
+from utils.filters import command
+from utils.limits import Limits
+from utils.misc import modules_help
+from utils.runners import RunResult, runners
+from utils.scripts import edit_message, send_output
+
+MARKER = "__bench__"
+
+PYTHON_HARNESS = """
+import timeit
+
+timer = timeit.Timer({stmt!r}, {setup!r})
+number = {number} or timer.autorange()[0]
+times = timer.repeat(repeat={repeat}, number=number)
+print({marker!r}, number, *map(repr, times))
+"""
+
+C_HARNESS = """
+#include <stdio.h>
+#include <time.h>
+{setup}
+
+static double bench_now(void) {{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec * 1e-9;
+}}
+
+static double bench_run(long number) {{
+    double start = bench_now();
+    for (long bench_i = 0; bench_i < number; bench_i++) {{
+{stmt}
+    }}
+    return bench_now() - start;
+}}
+
+int main(void) {{
+    long number = {number}L;
+
+    /* Same as timeit autorange: 1, 2, 5, 10, 20, 50... loops until it takes 0.2s */
+    for (long base = 1; number == 0 && base <= 1000000000000L; base *= 10) {{
+        long steps[] = {{1, 2, 5}};
+        for (int k = 0; k < 3; k++) {{
+            if (bench_run(base * steps[k]) >= 0.2) {{
+                number = base * steps[k];
+                break;
+            }}
+        }}
+    }}
+    if (number == 0) number = 1000000000000L;
+
+    printf("{marker} %ld", number);
+    for (int r = 0; r < {repeat}; r++) printf(" %.9f", bench_run(number));
+    printf("\\n");
+    return 0;
+}}
+"""
+
+LANGUAGES = {
+    "py": ("python", PYTHON_HARNESS, None),
+    "c": ("gcc", C_HARNESS, ["-O2"]),
+    "cpp": ("gpp", C_HARNESS, ["-O2"]),
+}
+
+
+def _parse_args(text: str) -> Tuple[dict, str]:
+    """Splits leading -n, -r and -l options from the code"""
+    options = {}
+
+    while match := re.match(r"-([nrl])\s+(\S+)(\s+|$)", text):
+        options[match.group(1)] = match.group(2)
+        text = text[match.end() :]
+
+    return options, text
+
+
+def _split_code(code: str) -> Tuple[str, List[str]]:
+    """Returns setup (before a "===" line) and snippets (separated by "---" lines)"""
+    setup = ""
+    parts = re.split(r"^===\s*$", code, maxsplit=1, flags=re.M)
+    if len(parts) == 2:
+        setup, code = parts
+
+    snippets = [
+        snippet.strip("\n") for snippet in re.split(r"^---\s*$", code, flags=re.M)
+    ]
+
+    return setup.strip("\n"), [snippet for snippet in snippets if snippet.strip()]
+
+
+def _format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("µs", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.3g} {unit}"
+
+    return f"{seconds / 1e-9:.3g} ns"
+
+
+class BenchResult:
+    def __init__(self, number: int, times: List[float]):
+        self.number = number
+        # Time of a single loop in each repeat
+        self.loops = [time / number for time in times]
+
+    @property
+    def median(self) -> float:
+        return statistics.median(self.loops)
+
+    @property
+    def p95(self) -> float:
+        if len(self.loops) < 2:
+            return self.loops[0]
+
+        return statistics.quantiles(self.loops, n=20, method="inclusive")[18]
+
+    @property
+    def stdev(self) -> float:
+        return statistics.stdev(self.loops) if len(self.loops) > 1 else 0.0
+
+    def format(self) -> str:
+        return (
+            f"{self.number} loops, {len(self.loops)} runs\n"
+            f"min {_format_time(min(self.loops))}, median {_format_time(self.median)}, "
+            f"p95 {_format_time(self.p95)}, stdev {_format_time(self.stdev)}\n"
+            f"{1 / self.median if self.median else float('inf'):,.0f} ops/sec"
+        )
+
+
+def _parse_result(run: RunResult) -> Optional[BenchResult]:
+    for line in run.stdout.splitlines():
+        if line.startswith(MARKER):
+            number, *times = line.split()[1:]
+            return BenchResult(int(number), [float(time) for time in times])
+
+    return None
+
+
+@Client.on_message(
+    ~filters.scheduled & command(["bench", "rbench"]) & filters.me & ~filters.forwarded
+)
+@queued("bench")
+async def bench(_: Client, message: Message):
+    text = message.text.split(maxsplit=1)[1] if len(message.command) > 1 else ""
+    options, code = _parse_args(text)
+
+    if message.command[0] == "rbench" and message.reply_to_message:
+        code = message.reply_to_message.text or ""
+
+    setup, snippets = _split_code(code)
+    if not snippets:
+        return await message.edit_text("<b>Code to benchmark isn't provided</b>")
+
+    language = options.get("l", "py")
+    if language not in LANGUAGES:
+        return await message.edit_text(
+            f"<b>Language should be one of: {', '.join(LANGUAGES)}</b>"
+        )
+
+    for key in ("n", "r"):
+        if key in options and not options[key].isdigit():
+            return await message.edit_text(f"<b>-{key} should be a number</b>")
+
+    number = int(options.get("n", 0))
+    repeat = max(int(options.get("r", 7)), 1)
+    runner_name, harness, flags = LANGUAGES[language]
+    runner = runners[runner_name]
+
+    timeout = db.get("shell", "timeout", 60)
+    limits = Limits.from_db() if db.get("shell", "limits", True) else None
+    header = (
+        f"<b>Benchmark ({runner.language}):</b>\n"
+        f'<pre language="{runner.pre_language}">{html.escape(code)}</pre>\n\n'
+    )
+    results = []
+
+    for index, snippet in enumerate(snippets):
+        name = chr(ord("A") + index) if len(snippets) > 1 else "Result"
+        await edit_message(
+            message,
+            header + f"<b><emoji id=5821116867309210830>🔃</emoji> Running {name}...</b>",
+            wait=False,
+        )
+
+        source = harness.format(
+            stmt=snippet, setup=setup, number=number, repeat=repeat, marker=MARKER
+        )
+
+        try:
+            run = await runner.execute(source, flags, timeout=timeout, limits=limits)
+        except asyncio.exceptions.TimeoutError:
+            return await edit_message(
+                message,
+                header + f"<b><emoji id=5465665476971471368>❌</emoji> {name}: "
+                f"timeout expired ({timeout} seconds)</b>",
+            )
+
+        result = _parse_result(run)
+        if result is None:
+            error = run.limit_error or f"Error with status code {run.returncode}"
+            return await send_output(
+                message,
+                lambda preview: header
+                + f"<b><emoji id=5465665476971471368>❌</emoji> {name}: {error}</b>\n{preview}",
+                run.stderr or run.stdout,
+                tail=True,
+            )
+
+        results.append((name, result))
+
+    text = header
+    for name, result in results:
+        text += f"<b>{name}:</b>\n<code>{result.format()}</code>\n\n"
+
+    if len(results) > 1:
+        baseline_name, baseline = results[0]
+        for name, result in results[1:]:
+            if not baseline.median or not result.median:
+                text += f"<b>{name} can't be compared with {baseline_name}, a median is zero</b>\n"
+                continue
+
+            ratio = baseline.median / result.median
+            if ratio >= 1:
+                text += f"<b>{name} is {ratio:.2f}x faster than {baseline_name}</b>\n"
+            else:
+                text += f"<b>{name} is {1 / ratio:.2f}x slower than {baseline_name}</b>\n"
+
+    await edit_message(message, text)
+
+
+module = modules_help.add_module("bench", __file__)
+module.add_command(
+    "bench",
+    "Benchmark code like timeit: min, median, p95, stdev and ops/sec. "
+    "Setup goes before a === line, snippets to compare are separated by --- lines",
+    "[-n loops] [-r runs] [-l py | c | cpp] [code]",
+)
+module.add_command("rbench", "Benchmark code from reply", "[-n loops] [-r runs] [-l py | c | cpp]")
@@ -1,5 +1,3 @@
-import asyncio
-
 from pyrogram import Client, filters
 from pyrogram.types import Message
 
@@ -31,7 +29,6 @@ async def purge(client: Client, message: Message):
         if len(chunk) >= 100:
             await client.delete_messages(message.chat.id, chunk)
             chunk.clear()
-            await asyncio.sleep(1)
 
     if chunk:
         await client.delete_messages(message.chat.id, chunk)
@@ -50,7 +47,6 @@ async def tagall_handler(client: Client, message: Message):
 
     for i in range(0, len(tags), 5):
         await message.reply(args + "".join(tags[i : i + 5]), quote=False)
-        await asyncio.sleep(0.1)
 
 
 module = modules_help.add_module("chat_tools", __file__)
@@ -1,42 +1,161 @@
 import asyncio
+import builtins
+import cProfile
 import html
+import inspect
+import io
+import marshal
+import os
+import pstats
 import re
-import tempfile
-from contextlib import redirect_stderr, redirect_stdout
-from io import StringIO
+import tracemalloc
 from time import perf_counter
-from traceback import print_exc
+from traceback import format_exception
+from typing import Dict, List, Optional, Tuple
 import random
 from pyrogram import Client, enums, filters, raw, types
 from pyrogram.types import Message
 
+from utils.capture import capture_output
+from utils.compile_cache import BuildResult
 from utils.db import db
+from utils.executions import executions, queued
 from utils.filters import command
+from utils.limits import Limits
 from utils.misc import modules_help
-from utils.scripts import paste_yaso, shell_exec
-
-
-async def aexec(code, client, message, timeout=None):
-    exec(
-        "async def __todo(client, message, *args):\n"
-        + " from pyrogram import raw, types, enums\n"
-        + " from utils.db import db\n"
-        + " app = client\n"
-        + " m = message\n"
-        + " r = m.reply_to_message\n"
-        + " u = m.from_user\n"
-        + " ru = getattr(r, 'from_user', None)\n"
-        + " p = print\n"
-        + " here = m.chat.id\n"
-        + "".join(f"\n {_l}" for _l in code.split("\n"))
-    )
+from utils.py_pool import SnippetError, SnippetTimeout, WorkerDied, python_pool
+from utils.runners import Runner, runners
+from utils.scripts import OutputRing, edit_message, paste, send_output
+from utils.snippets import code_cache
+
+
+# chat id -> globals of persistent (.py -k) snippets
+namespaces: Dict[int, dict] = {}
+# Only one profiler can be enabled in a thread at once
+profile_lock = asyncio.Lock()
+
+
+def new_namespace() -> dict:
+    return {
+        "__builtins__": builtins,
+        "__name__": "__snippet__",
+        "asyncio": asyncio,
+        "raw": raw,
+        "types": types,
+        "enums": enums,
+        "db": db,
+    }
+
+
+def get_namespace(chat_id: int) -> dict:
+    if chat_id not in namespaces:
+        namespaces[chat_id] = new_namespace()
+
+    return namespaces[chat_id]
+
+
+class Profiled:
+    """Awaitable which runs the coroutine with the profiler enabled only while the
+    coroutine itself is running, so other tasks of the event loop don't get into the profile
+    """
+
+    def __init__(self, coro, profiler: cProfile.Profile):
+        self.coro = coro
+        self.profiler = profiler
+
+    def __await__(self):
+        value, error = None, None
+
+        while True:
+            self.profiler.enable()
+            try:
+                if error is not None:
+                    future = self.coro.throw(error)
+                else:
+                    future = self.coro.send(value)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self.profiler.disable()
+
+            try:
+                value, error = (yield future), None
+            except BaseException as e:
+                value, error = None, e
+
+
+async def aexec(
+    code, client, message, timeout=None, namespace=None, output=None, profiler=None
+):
+    """Executes code and returns its stdout and stderr.
+
+    By default code runs as a body of a new function. If ``namespace`` is passed,
+    code runs at top level of it (``await`` is allowed), so defined names are kept there.
+    Output is written to ``output`` as it's printed, if it's passed.
+    If ``profiler`` is passed, the code runs under it (see :class:`Profiled`).
+    """
+    with capture_output(output) as output:
+        if namespace is None:
+            local = {}
+            exec(code_cache.get(code), globals(), local)
+
+            coro = local["__todo"](client, message)
+            if profiler is not None:
+                coro = Profiled(coro, profiler)
+
+            await asyncio.wait_for(coro, timeout=timeout)
+        else:
+            reply = message.reply_to_message
+            namespace.update(
+                client=client,
+                app=client,
+                message=message,
+                m=message,
+                r=reply,
+                u=message.from_user,
+                ru=getattr(reply, "from_user", None),
+                p=print,
+                here=message.chat.id,
+            )
+
+            compiled = code_cache.get(code, repl=True)
+            if profiler is not None:
+                profiler.enable()
+
+            try:
+                # Code without top level await is executed right here
+                result = eval(compiled, namespace)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+
+            if inspect.iscoroutine(result):
+                if profiler is not None:
+                    result = Profiled(result, profiler)
+
+                await asyncio.wait_for(result, timeout=timeout)
+
+    return output.getvalue()
 
-    f = StringIO()
 
-    with redirect_stdout(f):
-        await asyncio.wait_for(locals()["__todo"](client, message), timeout=timeout)
+async def _stream_output(message: Message, task: asyncio.Task, output: OutputRing):
+    """Shows output of the running snippet until it's finished"""
+    edit_interval = db.get("shell", "edit_interval", 2)
+    shown = 0
 
-    return f.getvalue()
+    while not task.done():
+        await asyncio.wait({task}, timeout=edit_interval)
+
+        if task.done() or output.size == shown:
+            continue
+
+        shown = output.size
+        await edit_message(
+            message,
+            "<b><emoji id=5821116867309210830>🔃</emoji> Executing...</b>\n\n"
+            f"<pre>{html.escape(output.tail(3072))}</pre>",
+            wait=False,
+        )
 
 
 code_result = (
@@ -51,6 +170,7 @@ code_result = (
 @Client.on_message(
     ~filters.scheduled & command(["py", "rpy"]) & filters.me & ~filters.forwarded
 )
+@queued("py")
 async def python_exec(client: Client, message: Message):
     if len(message.command) == 1 and message.command[0] != "rpy":
         return await message.edit_text("<b>Code to execute isn't provided</b>")
@@ -59,6 +179,8 @@ async def python_exec(client: Client, message: Message):
         if not message.reply_to_message:
             return await message.edit_text("<b>Code to execute isn't provided</b>")
 
+        flags = set(message.command[1:])
+
         # Check if message is a reply to message with already executed code
         for entity in message.reply_to_message.entities:
             if (
@@ -74,521 +196,528 @@ async def python_exec(client: Client, message: Message):
     else:
         code = message.text.split(maxsplit=1)[1]
 
-    await message.edit_text(
-        "<b><emoji id=5821116867309210830>🔃</emoji> Executing...</b>"
+        flags = set()
+        while match := re.match(r"(-[kw])(\s+|$)", code):
+            flags.add(match.group(1))
+            code = code[match.end() :]
+
+    if not code:
+        return await message.edit_text("<b>Code to execute isn't provided</b>")
+
+    if {"-k", "-w"} <= flags:
+        return await message.edit_text("<b>-k can't be used together with -w</b>")
+
+    await edit_message(
+        message, "<b><emoji id=5821116867309210830>🔃</emoji> Executing...</b>", wait=False
     )
 
+    output = None
+
+    def partial_output(error: Optional[BaseException] = None) -> str:
+        """Output printed before the error, if any"""
+        if isinstance(error, (SnippetError, SnippetTimeout)):
+            text = error.output
+        else:
+            text = output.getvalue() if output is not None else ""
+
+        phone_number = client.profile.phone_number
+        if phone_number:
+            text = text.replace(phone_number, "888" + "".join(random.choices("0123456789", k=8)))
+
+        if not text:
+            return ""
+
+        return f"\n<b>Output:</b>\n<pre>{html.escape(text[-1024:])}</pre>"
+
     try:
         code = code.replace("\u00a0", "")
 
+        timeout = db.get("shell", "timeout", 60)
+
         start_time = perf_counter()
-        result = await aexec(
-            code, client, message, timeout=db.get("shell", "timeout", 60)
-        )
+        file = None
+        if "-w" in flags:
+            python_pool.memory_limit = db.get("python", "memory_limit", 1024) * 2**20
+            await python_pool.start(size=db.get("python", "workers", 2))
+
+            result = await python_pool.execute(
+                code,
+                client,
+                message,
+                timeout=timeout,
+                cpu_limit=db.get("python", "cpu_limit", timeout),
+            )
+        else:
+            output = OutputRing(db.get("shell", "max_output", 65536), spill=True)
+            file = output.file
+            task = asyncio.create_task(
+                aexec(
+                    code,
+                    client,
+                    message,
+                    timeout=timeout,
+                    namespace=get_namespace(message.chat.id) if "-k" in flags else None,
+                    output=output,
+                )
+            )
+
+            try:
+                await _stream_output(message, task, output)
+            finally:
+                task.cancel()
+
+            result = task.result()
         stop_time = perf_counter()
 
         # Replace account phone number to anonymous
-        random_phone_number = "".join(str(random.randint(0, 9)) for _ in range(8))
-        result = result.replace(client.me.phone_number, f"888{random_phone_number}")
-
-        if not result:
-            result = "No result"
-        elif len(result) > 3072:
-            paste_result = html.escape(await paste_yaso(result))
+        phone_number = client.profile.phone_number
+        if phone_number:
+            random_phone_number = "".join(str(random.randint(0, 9)) for _ in range(8))
+            result = result.replace(phone_number, f"888{random_phone_number}")
+
+            if file is not None:
+                await asyncio.to_thread(
+                    file.replace, phone_number, f"888{random_phone_number}"
+                )
 
-            if paste_result == "Pasting failed":
-                with open("error.log", "w") as file:
-                    file.write(result)
+        def render(preview: str) -> str:
+            return code_result.format(
+                emoji_id=5260480440971570446,
+                language="Python",
+                pre_language="python",
+                code=html.escape(code),
+                result=f"<b><emoji id=5472164874886846699>✨</emoji> Result</b>:\n"
+                f"{preview}\n"
+                f"<b>Completed in {round(stop_time - start_time, 5)}s.</b>",
+            )
 
-                result = None
-            else:
-                result = paste_result
+        try:
+            if not result:
+                return await edit_message(message, render("No result"))
 
-        elif re.match(r"^(https?):\/\/[^\s\/$.?#].[^\s]*$", result):
-            result = html.escape(result)
-        else:
-            result = f"<pre>{html.escape(result)}</pre>"
+            if re.match(r"^(https?):\/\/[^\s\/$.?#].[^\s]*$", result):
+                return await edit_message(
+                    message, render(html.escape(result)), disable_web_page_preview=True
+                )
 
-        if result:
-            return await message.edit_text(
-                code_result.format(
-                    emoji_id=5260480440971570446,
-                    language="Python",
-                    pre_language="python",
-                    code=html.escape(code),
-                    result=f"<b><emoji id=5472164874886846699>✨</emoji> Result</b>:\n"
-                    f"{result}\n"
-                    f"<b>Completed in {round(stop_time - start_time, 5)}s.</b>",
-                ),
-                disable_web_page_preview=True,
+            await send_output(
+                message, render, result, file=file, disable_web_page_preview=True
             )
-        else:
-            return await message.reply_document(
-                document="error.log",
-                caption=code_result.format(
-                    emoji_id=5260480440971570446,
-                    language="Python",
-                    pre_language="python",
-                    code=html.escape(code),
-                    result=f"<b><emoji id=5472164874886846699>✨</emoji> Result is too long</b>\n"
-                    f"<b>Completed in {round(stop_time - start_time, 5)}s.</b>",
-                ),
-            )
-    except asyncio.TimeoutError:
-        return await message.edit_text(
+        finally:
+            if file is not None:
+                file.close()
+    except asyncio.TimeoutError as e:
+        return await edit_message(
+            message,
+            code_result.format(
+                emoji_id=5260480440971570446,
+                language="Python",
+                pre_language="python",
+                code=html.escape(code),
+                result="<b><emoji id=5465665476971471368>❌</emoji> Timeout Error!</b>"
+                + partial_output(e),
+            ),
+            disable_web_page_preview=True,
+        )
+    except WorkerDied as e:
+        return await edit_message(
+            message,
             code_result.format(
                 emoji_id=5260480440971570446,
                 language="Python",
                 pre_language="python",
                 code=html.escape(code),
-                result="<b><emoji id=5465665476971471368>❌</emoji> Timeout Error!</b>",
+                result=f"<b><emoji id=5465665476971471368>❌</emoji> {html.escape(str(e))}</b>",
             ),
             disable_web_page_preview=True,
         )
     except Exception as e:
-        err = StringIO()
-        with redirect_stderr(err):
-            print_exc()
+        if isinstance(e, SnippetError):
+            name, traceback = e.name, e.traceback
+        else:
+            name, traceback = e.__class__.__name__, "".join(format_exception(e))
 
-        return await message.edit_text(
+        return await edit_message(
+            message,
             code_result.format(
                 emoji_id=5260480440971570446,
                 language="Python",
                 pre_language="python",
                 code=html.escape(code),
-                result=f"<b><emoji id=5465665476971471368>❌</emoji> {e.__class__.__name__}: {e}</b>\n"
-                f"Traceback: {html.escape(await paste_yaso(err.getvalue()))}",
+                result=f"<b><emoji id=5465665476971471368>❌</emoji> {name}: {e}</b>\n"
+                f"Traceback: {html.escape(await paste(traceback))}" + partial_output(e),
             ),
             disable_web_page_preview=True,
         )
 
 
-@Client.on_message(
-    ~filters.scheduled & command(["gcc", "rgcc"]) & filters.me & ~filters.forwarded
-)
-async def gcc_exec(_: Client, message: Message):
-    if len(message.command) == 1 and message.command[0] != "rgcc":
-        return await message.edit_text("<b>Code to execute isn't provided</b>")
+def _profile_table(profiler: cProfile.Profile, limit: int) -> str:
+    stats = pstats.Stats(profiler).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)
+    lines = [f"{'ncalls':>9} {'tottime':>8} {'cumtime':>8}  function"]
 
-    if message.command[0] == "rgcc":
-        code = message.reply_to_message.text
-    else:
-        code = message.text.split(maxsplit=1)[1]
+    for (file, line, name), (primitive_calls, calls, tottime, cumtime, _) in rows:
+        # Resuming the snippet coroutine, see Profiled
+        if file == "~" and name.endswith("of 'coroutine' objects>"):
+            continue
 
-    await message.edit_text(
-        "<b><emoji id=5821116867309210830>🔃</emoji> Executing...</b>"
+        ncalls = str(calls) if calls == primitive_calls else f"{calls}/{primitive_calls}"
+        function = name if file == "~" else f"{os.path.basename(file)}:{line}({name})"
+        lines.append(f"{ncalls:>9} {tottime:8.4f} {cumtime:8.4f}  {function}")
+
+        if len(lines) > limit:
+            break
+
+    return "\n".join(lines)
+
+
+def _allocation_table(snapshot: tracemalloc.Snapshot, limit: int) -> str:
+    snapshot = snapshot.filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, inspect.getfile(type(code_cache))),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        )
     )
+    lines = [f"{'size':>10} {'count':>7}  line"]
 
-    with tempfile.TemporaryDirectory() as tempdir:
-        with tempfile.NamedTemporaryFile("w+", suffix=".c", dir=tempdir) as file:
-            file.write(code)
-            file.seek(0)
+    for stat in snapshot.statistics("lineno")[:limit]:
+        frame = stat.traceback[0]
+        lines.append(
+            f"{stat.size / 1024:8.1f}KB {stat.count:>7}  "
+            f"{os.path.basename(frame.filename)}:{frame.lineno}"
+        )
 
-            timeout = db.get("shell", "timeout", 60)
-            try:
-                comp_start_time = perf_counter()
-                rcode, stdout, stderr = await shell_exec(
-                    command=f"gcc -o output {file.name}",
-                    executable=db.get("shell", "executable"),
-                    timeout=timeout,
-                )
-                comp_stop_time = perf_counter()
-
-                if rcode != 0:
-                    return await message.edit_text(
-                        code_result.format(
-                            emoji_id=5257955893554721164,
-                            language="C",
-                            pre_language="c",
-                            code=html.escape(code),
-                            result=f"<b><emoji id=5465665476971471368>❌</emoji> Compilation error with status code {rcode}:</b>\n"
-                            f"<code>{html.escape(stderr)}</code>\n\n<b>Compiled in {round(comp_stop_time - comp_start_time, 5)}s.</b>\n",
-                        ),
-                        disable_web_page_preview=True,
-                    )
-
-                exec_start_time = perf_counter()
-                rcode, stdout, stderr = await shell_exec(
-                    command="./output",
-                    executable=db.get("shell", "executable"),
-                    timeout=timeout,
-                )
-                exec_stop_time = perf_counter()
-            except asyncio.exceptions.TimeoutError:
-                return await message.edit_text(
-                    code_result.format(
-                        emoji_id=5257955893554721164,
-                        language="C",
-                        pre_language="c",
-                        code=html.escape(code),
-                        result=f"<b><emoji id=5465665476971471368>❌</emoji> Error!</b>\n<b>Timeout expired ({timeout} seconds)</b>",
-                    ),
-                    disable_web_page_preview=True,
-                )
-            else:
-                if stderr:
-                    return await message.edit_text(
-                        code_result.format(
-                            emoji_id=5257955893554721164,
-                            language="C",
-                            pre_language="c",
-                            code=html.escape(code),
-                            result=f"<b><emoji id=5465665476971471368>❌</emoji> Error with status code {rcode}:</b>\n"
-                            f"<code>{html.escape(stderr)}</code>",
-                        ),
-                        disable_web_page_preview=True,
-                    )
-
-                result = None
-
-                if len(stdout) > 3072:
-                    result = html.escape(await paste_yaso(stdout))
-                else:
-                    result = f"<pre>{html.escape(stdout)}</pre>"
-
-                return await message.edit_text(
-                    code_result.format(
-                        emoji_id=5257955893554721164,
-                        language="C",
-                        pre_language="c",
-                        code=html.escape(code),
-                        result=f"<b><emoji id=5472164874886846699>✨</emoji> Result</b>:\n"
-                        f"{result}\n\n"
-                        f"<b>Compiled in {round(comp_stop_time - comp_start_time, 5)}s.</b>\n"
-                        f"<b>Completed in {round(exec_stop_time - exec_start_time, 5)}s.</b>",
-                    ),
-                    disable_web_page_preview=True,
-                )
+    return "\n".join(lines)
 
 
 @Client.on_message(
-    ~filters.scheduled & command(["gpp", "rgpp"]) & filters.me & ~filters.forwarded
+    ~filters.scheduled & command(["pyprof", "rpyprof"]) & filters.me & ~filters.forwarded
 )
-async def gpp_exec(_: Client, message: Message):
-    if len(message.command) == 1 and message.command[0] != "rgpp":
-        return await message.edit_text("<b>Code to execute isn't provided</b>")
+@queued("pyprof")
+async def python_profile(client: Client, message: Message):
+    text = message.text.split(maxsplit=1)[1] if len(message.command) > 1 else ""
 
-    if message.command[0] == "rgpp":
-        code = message.reply_to_message.text
-    else:
-        code = message.text.split(maxsplit=1)[1]
+    options = {}
+    while match := re.match(r"-(m|n\s+(\d+))(\s+|$)", text):
+        options[match.group(1)[0]] = match.group(2)
+        text = text[match.end() :]
 
-    await message.edit_text(
-        "<b><emoji id=5821116867309210830>🔃</emoji> Executing...</b>"
+    code = text
+    if message.command[0] == "rpyprof" and message.reply_to_message:
+        code = message.reply_to_message.text or ""
+
+    code = code.replace("\u00a0", "")
+    if not code.strip():
+        return await message.edit_text("<b>Code to profile isn't provided</b>")
+
+    limit = int(options.get("n") or 15)
+    trace_memory = "m" in options
+
+    await edit_message(
+        message, "<b><emoji id=5821116867309210830>🔃</emoji> Profiling...</b>", wait=False
     )
 
-    with tempfile.TemporaryDirectory() as tempdir:
-        with tempfile.NamedTemporaryFile("w+", suffix=".cpp", dir=tempdir) as file:
-            file.write(code)
-            file.seek(0)
+    def show(result: str):
+        return edit_message(
+            message,
+            code_result.format(
+                emoji_id=5260480440971570446,
+                language="Python",
+                pre_language="python",
+                code=html.escape(code),
+                result=result,
+            ),
+            disable_web_page_preview=True,
+        )
+
+    timeout = db.get("shell", "timeout", 60)
+    output = OutputRing(db.get("shell", "max_output", 65536))
+    profiler = cProfile.Profile()
+    snapshot = None
+    peak = 0
 
-            timeout = db.get("shell", "timeout", 60)
-            try:
-                comp_start_time = perf_counter()
-                rcode, stdout, stderr = await shell_exec(
-                    command=f"g++ -o output {file.name}",
-                    executable=db.get("shell", "executable"),
-                    timeout=timeout,
-                )
-                comp_stop_time = perf_counter()
-
-                if rcode != 0:
-                    return await message.edit_text(
-                        code_result.format(
-                            emoji_id=5258035603852767295,
-                            language="C++",
-                            pre_language="cpp",
-                            code=html.escape(code),
-                            result=f"<b><emoji id=5465665476971471368>❌</emoji> Compilation error with status code {rcode}:</b>\n"
-                            f"<code>{html.escape(stderr)}</code>\n\n<b>Compiled in {round(comp_stop_time - comp_start_time, 5)}s.</b>\n",
-                        ),
-                        disable_web_page_preview=True,
-                    )
-
-                exec_start_time = perf_counter()
-                rcode, stdout, stderr = await shell_exec(
-                    command="./output",
-                    executable=db.get("shell", "executable"),
-                    timeout=timeout,
-                )
-                exec_stop_time = perf_counter()
-            except asyncio.exceptions.TimeoutError:
-                return await message.edit_text(
-                    code_result.format(
-                        emoji_id=5258035603852767295,
-                        language="C++",
-                        pre_language="cpp",
-                        code=html.escape(code),
-                        result=f"<b><emoji id=5465665476971471368>❌</emoji> Error!</b>\n<b>Timeout expired ({timeout} seconds)</b>",
-                    ),
-                    disable_web_page_preview=True,
-                )
-            else:
-                if stderr:
-                    return await message.edit_text(
-                        code_result.format(
-                            emoji_id=5258035603852767295,
-                            language="C++",
-                            pre_language="cpp",
-                            code=html.escape(code),
-                            result=f"<b><emoji id=5465665476971471368>❌</emoji> Error with status code {rcode}:</b>\n"
-                            f"<code>{html.escape(stderr)}</code>",
-                        ),
-                        disable_web_page_preview=True,
-                    )
-
-                if len(stdout) > 3072:
-                    result = html.escape(await paste_yaso(stdout))
-                else:
-                    result = f"<pre>{html.escape(result)}</pre>"
-
-                return await message.edit_text(
-                    code_result.format(
-                        emoji_id=5258035603852767295,
-                        language="C++",
-                        pre_language="cpp",
-                        code=html.escape(code),
-                        result=f"<b><emoji id=5472164874886846699>✨</emoji> Result</b>:\n"
-                        f"{result}\n\n"
-                        f"<b>Compiled in {round(comp_stop_time - comp_start_time, 5)}s.</b>\n"
-                        f"<b>Completed in {round(exec_stop_time - exec_start_time, 5)}s.</b>",
-                    ),
-                    disable_web_page_preview=True,
-                )
+    await profile_lock.acquire()
+    if trace_memory:
+        tracemalloc.start()
 
+    start_time = perf_counter()
+    try:
+        # Top level of a fresh namespace, so memory held by variables shows up in the snapshot
+        await aexec(
+            code,
+            client,
+            message,
+            timeout=timeout,
+            namespace=new_namespace(),
+            output=output,
+            profiler=profiler,
+        )
+    except asyncio.TimeoutError:
+        return await show("<b><emoji id=5465665476971471368>❌</emoji> Timeout Error!</b>")
+    except Exception as e:
+        return await show(
+            f"<b><emoji id=5465665476971471368>❌</emoji> {e.__class__.__name__}: {html.escape(str(e))}</b>\n"
+            f"Traceback: {html.escape(await paste(''.join(format_exception(e))))}"
+        )
+    finally:
+        stop_time = perf_counter()
 
-@Client.on_message(
-    ~filters.scheduled & command(["lua", "rlua"]) & filters.me & ~filters.forwarded
-)
-async def lua_exec(_: Client, message: Message):
-    if len(message.command) == 1 and message.command[0] != "rlua":
-        return await message.edit_text("<b>Code to execute isn't provided</b>")
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
 
-    if message.command[0] == "rlua":
-        code = message.reply_to_message.text
-    else:
-        code = message.text.split(maxsplit=1)[1]
+        profile_lock.release()
 
-    await message.edit_text(
-        "<b><emoji id=5821116867309210830>🔃</emoji> Executing...</b>"
+    result = (
+        f"<b><emoji id=5472164874886846699>✨</emoji> Top {limit} by cumulative time:</b>\n"
+        f"<pre>{html.escape(_profile_table(profiler, limit))}</pre>\n"
     )
 
-    with tempfile.TemporaryDirectory() as tempdir:
-        with tempfile.NamedTemporaryFile("w+", suffix=".lua", dir=tempdir) as file:
-            file.write(code)
-            file.seek(0)
+    if snapshot is not None:
+        result += (
+            f"<b>Top allocation sites (still allocated at the end), peak {peak / 2**20:.2f}MB:</b>\n"
+            f"<pre>{html.escape(_allocation_table(snapshot, limit))}</pre>\n"
+        )
 
-            timeout = db.get("shell", "timeout", 60)
-            try:
-                exec_start_time = perf_counter()
-                rcode, stdout, stderr = await shell_exec(
-                    command=f"lua {file.name}",
-                    executable=db.get("shell", "executable"),
-                    timeout=timeout,
-                )
-                exec_stop_time = perf_counter()
-            except asyncio.exceptions.TimeoutError:
-                return await message.edit_text(
-                    code_result.format(
-                        emoji_id=5258338381867266341,
-                        language="Lua",
-                        pre_language="lua",
-                        code=html.escape(code),
-                        result=f"<b><emoji id=5465665476971471368>❌</emoji> Error!</b>\n<b>Timeout expired ({timeout} seconds)</b>",
-                    ),
-                    disable_web_page_preview=True,
-                )
-            else:
-                if stderr:
-                    return await message.edit_text(
-                        code_result.format(
-                            emoji_id=5258338381867266341,
-                            language="Lua",
-                            pre_language="lua",
-                            code=html.escape(code),
-                            result=f"<b><emoji id=5465665476971471368>❌</emoji> Error with status code {rcode}:</b>\n"
-                            f"<code>{html.escape(stderr)}</code>",
-                        ),
-                        disable_web_page_preview=True,
-                    )
-
-                if len(stdout) > 3072:
-                    result = html.escape(await paste_yaso(stdout))
-                else:
-                    result = f"<pre>{html.escape(result)}</pre>"
-
-                return await message.edit_text(
-                    code_result.format(
-                        emoji_id=5258338381867266341,
-                        language="Lua",
-                        pre_language="lua",
-                        code=html.escape(code),
-                        result=f"<b><emoji id=5472164874886846699>✨</emoji> Result</b>:\n"
-                        f"{result}\n\n"
-                        f"<b>Completed in {round(exec_stop_time - exec_start_time, 5)}s.</b>",
-                    ),
-                    disable_web_page_preview=True,
-                )
+    if output.size:
+        result += f"<b>Output:</b>\n<pre>{html.escape(output.tail(512))}</pre>\n"
+
+    result += f"<b>Completed in {round(stop_time - start_time, 5)}s.</b>"
+    await show(result)
+
+    dump = io.BytesIO(marshal.dumps(pstats.Stats(profiler).stats))
+    dump.name = "profile.prof"
+    await message.reply_document(
+        document=dump,
+        caption="<b>Full profile</b>, open with <code>python -m pstats</code> or snakeviz",
+        quote=True,
+    )
 
 
 @Client.on_message(
-    ~filters.scheduled & command(["go", "rgo"]) & filters.me & ~filters.forwarded
+    ~filters.scheduled & command(["pyclear"]) & filters.me & ~filters.forwarded
 )
-async def go_exec(_: Client, message: Message):
-    if len(message.command) == 1 and message.command[0] != "rgo":
-        return await message.edit_text("<b>Code to execute isn't provided</b>")
+async def python_clear(_: Client, message: Message):
+    namespaces.pop(message.chat.id, None)
+    await message.edit_text("<b>Python namespace of this chat cleared</b>")
+
 
-    if message.command[0] == "rgo":
-        code = message.reply_to_message.text
+@Client.on_message(
+    ~filters.scheduled & command(["cancel"]) & filters.me & ~filters.forwarded
+)
+async def cancel_execution(_: Client, message: Message):
+    if len(message.command) > 1:
+        if not message.command[1].isdigit():
+            return await message.edit_text("<b>Execution id should be a number</b>")
+
+        execution = executions.get(int(message.command[1]))
+    elif message.reply_to_message:
+        execution = executions.find(message.chat.id, message.reply_to_message.id)
     else:
-        code = message.text.split(maxsplit=1)[1]
+        execution = executions.find(message.chat.id)
+
+    if execution is None or not executions.cancel(execution):
+        return await message.edit_text("<b>No such execution is queued or running</b>")
 
     await message.edit_text(
-        "<b><emoji id=5821116867309210830>🔃</emoji> Executing...</b>"
+        f"<b>Execution {execution.id} ({execution.name}, {execution.state}) cancelled</b>"
     )
 
-    with tempfile.TemporaryDirectory() as tempdir:
-        with tempfile.NamedTemporaryFile("w+", suffix=".go", dir=tempdir) as file:
-            file.write(code)
-            file.seek(0)
-
-            timeout = db.get("shell", "timeout", 60)
-            try:
-                exec_start_time = perf_counter()
-                rcode, stdout, stderr = await shell_exec(
-                    command=f"go run {file.name}",
-                    executable=db.get("shell", "executable"),
-                    timeout=timeout,
-                )
-                exec_stop_time = perf_counter()
-            except asyncio.exceptions.TimeoutError:
-                return await message.edit_text(
-                    code_result.format(
-                        emoji_id=5258117049317603088,
-                        language="Go",
-                        pre_language="go",
-                        code=html.escape(code),
-                        result=f"<b><emoji id=5465665476971471368>❌</emoji> Error!</b>\n<b>Timeout expired ({timeout} seconds)</b>",
-                    ),
-                    disable_web_page_preview=True,
-                )
-            else:
-                if stderr:
-                    return await message.edit_text(
-                        code_result.format(
-                            emoji_id=5258117049317603088,
-                            language="Go",
-                            pre_language="go",
-                            code=html.escape(code),
-                            result=f"<b><emoji id=5465665476971471368>❌</emoji> Error with status code {rcode}:</b>\n"
-                            f"<code>{html.escape(stderr)}</code>",
-                        ),
-                        disable_web_page_preview=True,
-                    )
-
-                if len(stdout) > 3072:
-                    result = html.escape(await paste_yaso(stdout))
-                else:
-                    result = f"<pre>{html.escape(result)}</pre>"
-
-                return await message.edit_text(
-                    code_result.format(
-                        emoji_id=5258117049317603088,
-                        language="Go",
-                        pre_language="go",
-                        code=html.escape(code),
-                        result=f"<b><emoji id=5472164874886846699>✨</emoji> Result</b>:\n"
-                        f"{result}\n\n"
-                        f"<b>Completed in {round(exec_stop_time - exec_start_time, 5)}s.</b>",
-                    ),
-                    disable_web_page_preview=True,
-                )
-
 
 @Client.on_message(
-    ~filters.scheduled & command(["node", "rnode"]) & filters.me & ~filters.forwarded
+    ~filters.scheduled & command(["queue"]) & filters.me & ~filters.forwarded
 )
-async def node_exec(_: Client, message: Message):
-    if len(message.command) == 1 and message.command[0] != "rnode":
-        return await message.edit_text("<b>Code to execute isn't provided</b>")
+async def execution_queue(_: Client, message: Message):
+    text = f"<b>Executions ({len(executions.running)}/{executions.slots} slots busy)</b>\n\n"
 
-    if message.command[0] == "rnode":
-        code = message.reply_to_message.text
-    else:
-        code = message.text.split(maxsplit=1)[1]
+    for execution in executions.running.values():
+        text += (
+            f"<code>{execution.id}</code> {execution.name} in <code>{execution.chat_id}</code>: "
+            f"running {execution.run_time:.1f}s, waited {execution.wait_time:.1f}s\n"
+        )
 
-    await message.edit_text(
-        "<b><emoji id=5821116867309210830>🔃</emoji> Executing...</b>"
-    )
+    for execution in executions.queued():
+        text += (
+            f"<code>{execution.id}</code> {execution.name} in <code>{execution.chat_id}</code>: "
+            f"#{execution.position} in queue, waiting {execution.wait_time:.1f}s\n"
+        )
 
-    with tempfile.TemporaryDirectory() as tempdir:
-        with tempfile.NamedTemporaryFile("w+", suffix=".js", dir=tempdir) as file:
-            file.write(code)
-            file.seek(0)
+    if executions.stats:
+        text += "\n<b>Stats:</b>\n"
 
-            timeout = db.get("shell", "timeout", 60)
-            try:
-                exec_start_time = perf_counter()
-                rcode, stdout, stderr = await shell_exec(
-                    command=f"node {file.name}",
-                    executable=db.get("shell", "executable"),
-                    timeout=timeout,
-                )
-                exec_stop_time = perf_counter()
-            except asyncio.exceptions.TimeoutError:
-                return await message.edit_text(
-                    code_result.format(
-                        emoji_id=5258042115023188415,
-                        language="Node.js",
-                        pre_language="javascript",
-                        code=html.escape(code),
-                        result=f"<b><emoji id=5465665476971471368>❌</emoji> Error!</b>\n<b>Timeout expired ({timeout} seconds)</b>",
-                    ),
-                    disable_web_page_preview=True,
-                )
-            else:
-                if stderr:
-                    return await message.edit_text(
-                        code_result.format(
-                            emoji_id=5258042115023188415,
-                            language="Node.js",
-                            pre_language="javascript",
-                            code=html.escape(code),
-                            result=f"<b><emoji id=5465665476971471368>❌</emoji> Error with status code {rcode}:</b>\n"
-                            f"<code>{html.escape(stderr)}</code>",
-                        ),
-                        disable_web_page_preview=True,
-                    )
-
-                if len(stdout) > 3072:
-                    result = html.escape(await paste_yaso(stdout))
-                else:
-                    result = f"<pre>{html.escape(result)}</pre>"
-
-                return await message.edit_text(
-                    code_result.format(
-                        emoji_id=5258042115023188415,
-                        language="Node.js",
-                        pre_language="javascript",
-                        code=html.escape(code),
-                        result=f"<b><emoji id=5472164874886846699>✨</emoji> Result</b>:\n"
-                        f"{result}\n\n"
-                        f"<b>Completed in {round(exec_stop_time - exec_start_time, 5)}s.</b>",
-                    ),
-                    disable_web_page_preview=True,
-                )
+    for name, stats in sorted(executions.stats.items()):
+        runs = stats["runs"]
+        text += (
+            f"<b>{name}:</b> {runs} runs, {stats['cancelled']} cancelled, "
+            f"wait avg {stats['total_wait'] / runs:.2f}s / max {stats['max_wait']:.2f}s, "
+            f"run avg {stats['total_run'] / runs:.2f}s / max {stats['max_run']:.2f}s\n"
+        )
+
+    await message.edit_text(text)
+
+
+def _split_flags(code: str) -> Tuple[List[str], str]:
+    """Splits leading compiler flags (e.g. "-O2 -march=native") from the code"""
+    flags = []
+
+    while match := re.match(r"(-\S+)(\s+|$)", code):
+        flags.append(match.group(1))
+        code = code[match.end() :]
+
+    return flags, code
+
+
+def _compile_info(build: BuildResult) -> str:
+    if build.hit:
+        return f"<b>Cached binary used, saved {round(build.compile_time, 5)}s of compilation.</b>"
+
+    return f"<b>Compiled in {round(build.compile_time, 5)}s.</b>"
+
+
+def _runner_exec(runner: Runner):
+    async def runner_exec(_: Client, message: Message):
+        """Runs code from message with the runner (compiling it if needed)"""
+        from_reply = message.command[0] == f"r{runner.name}"
+
+        if len(message.command) == 1 and not from_reply:
+            return await message.edit_text("<b>Code to execute isn't provided</b>")
+
+        if from_reply:
+            if not message.reply_to_message or not message.reply_to_message.text:
+                return await message.edit_text("<b>Reply to a message with code</b>")
+
+            code = message.reply_to_message.text
+            flags = message.command[1:]
+        elif runner.compile:
+            flags, code = _split_flags(message.text.split(maxsplit=1)[1])
+        else:
+            # Interpreted code can start with "-", e.g. a Lua comment
+            flags, code = [], message.text.split(maxsplit=1)[1]
+
+        await edit_message(
+            message, "<b><emoji id=5821116867309210830>🔃</emoji> Executing...</b>", wait=False
+        )
+
+        def show(result: str):
+            return edit_message(
+                message,
+                code_result.format(
+                    emoji_id=runner.emoji_id,
+                    language=runner.language,
+                    pre_language=runner.pre_language,
+                    code=html.escape(code),
+                    result=result,
+                ),
+                disable_web_page_preview=True,
+            )
+
+        def send(header: str, output: str, footer: str, **kwargs):
+            """Shows output of the run between header and footer, see :func:`send_output`"""
+            return send_output(
+                message,
+                lambda preview: code_result.format(
+                    emoji_id=runner.emoji_id,
+                    language=runner.language,
+                    pre_language=runner.pre_language,
+                    code=html.escape(code),
+                    result=header + preview + footer,
+                ),
+                output,
+                disable_web_page_preview=True,
+                **kwargs,
+            )
+
+        timeout = db.get("shell", "timeout", 60)
+        try:
+            run = await runner.execute(
+                code,
+                flags,
+                timeout=timeout,
+                executable=db.get("shell", "executable"),
+                repl=db.get("code_runner", "repl", True),
+                limits=Limits.from_db() if db.get("shell", "limits", True) else None,
+            )
+        except asyncio.exceptions.TimeoutError:
+            return await show(
+                f"<b><emoji id=5465665476971471368>❌</emoji> Error!</b>\n<b>Timeout expired ({timeout} seconds)</b>"
+            )
+
+        build_info = f"{_compile_info(run.build)}\n" if run.build else ""
+        usage_info = f"{run.usage.format()}\n" if run.usage else ""
+
+        if not run.compiled:
+            return await send(
+                f"<b><emoji id=5465665476971471368>❌</emoji> Compilation error with status code {run.returncode}:</b>\n",
+                run.stderr,
+                f"\n\n{build_info}",
+                file_name="stderr.txt",
+            )
+
+        if run.limit_error:
+            return await send(
+                f"<b><emoji id=5465665476971471368>❌</emoji> {run.limit_error}</b>\n",
+                run.stderr or run.stdout,
+                f"\n\n{usage_info}",
+                tail=True,
+            )
+
+        if run.stderr:
+            return await send(
+                f"<b><emoji id=5465665476971471368>❌</emoji> Error with status code {run.returncode}:</b>\n",
+                run.stderr,
+                f"\n\n{usage_info}",
+                file_name="stderr.txt",
+            )
+
+        return await send(
+            "<b><emoji id=5472164874886846699>✨</emoji> Result</b>:\n",
+            run.stdout,
+            f"\n\n{build_info}{usage_info}<b>Completed in {round(run.exec_time, 5)}s.</b>",
+        )
+
+    return runner_exec
+
+
+# One handler per registered language, e.g. gcc_exec for .gcc and .rgcc
+for _runner in runners.values():
+    globals()[f"{_runner.name}_exec"] = Client.on_message(
+        ~filters.scheduled & command(_runner.commands) & filters.me & ~filters.forwarded
+    )(queued(_runner.name)(_runner_exec(_runner)))
 
 
 module = modules_help.add_module("code_runner", __file__)
-module.add_command("py", "Execute Python code", "[code]")
-module.add_command("rpy", "Execute Python code from reply")
-module.add_command("gcc", "Execute C code", "[code]")
-module.add_command("rgcc", "Execute C code from reply")
-module.add_command("gpp", "Execute C++ code", "[code]")
-module.add_command("rgpp", "Execute C++ code from reply")
-module.add_command("lua", "Execute Lua code", "[code]")
-module.add_command("rlua", "Execute Lua code from reply")
-module.add_command("go", "Execute Go code", "[code]")
-module.add_command("rgo", "Execute Go code from reply")
-module.add_command("node", "Execute Node.js code", "[code]")
-module.add_command("rnode", "Execute Node.js code from reply")
+module.add_command(
+    "py",
+    "Execute Python code, -k keeps variables between runs in this chat, "
+    "-w runs it in a separate worker process",
+    "[-k | -w] [code]",
+)
+module.add_command("rpy", "Execute Python code from reply", "[-k | -w]")
+module.add_command("pyclear", "Clear variables kept by .py -k in this chat")
+module.add_command(
+    "pyprof",
+    "Profile Python code with cProfile, -m also traces allocations with tracemalloc, "
+    "-n sets number of shown rows. The full profile is attached",
+    "[-m] [-n rows] [code]",
+)
+module.add_command("rpyprof", "Profile Python code from reply", "[-m] [-n rows]")
+module.add_command(
+    "cancel",
+    "Cancel queued or running execution, by id, the replied one or the latest in this chat",
+    "[id]",
+)
+module.add_command("queue", "Show running and queued executions and their wait/run times")
+for _runner in runners.values():
+    module.add_command(
+        _runner.name,
+        f"Execute {_runner.language} code",
+        "[flags] [code]" if _runner.compile else "[code]",
+    )
+    module.add_command(
+        f"r{_runner.name}",
+        f"Execute {_runner.language} code from reply",
+        "[flags]" if _runner.compile else None,
+    )
@@ -8,17 +8,31 @@ from pyrogram import Client, filters
 from pyrogram.types import Message
 
 from utils.db import db
+from utils.executions import queued
 from utils.filters import command
+from utils.limits import Limits
 from utils.misc import modules_help
-from utils.scripts import get_args, get_args_raw, shell_exec, with_args
+from utils.scripts import (
+    MAX_MESSAGE_LENGTH,
+    OutputRing,
+    ShellStream,
+    edit_message,
+    get_args,
+    get_args_raw,
+    send_output,
+    with_args,
+)
 
 
 @Client.on_message(
     ~filters.scheduled & command(["shell", "sh"]) & filters.me & ~filters.forwarded
 )
 @with_args("<b>Command is not provided</b>")
+@queued("sh")
 async def shell_handler(_: Client, message: Message):
-    await message.edit("<b><emoji id=5821116867309210830>🔃</emoji> Executing...</b>")
+    await edit_message(
+        message, "<b><emoji id=5821116867309210830>🔃</emoji> Executing...</b>", wait=False
+    )
 
     cmd_text = get_args_raw(message)
 
@@ -29,25 +43,94 @@ async def shell_handler(_: Client, message: Message):
     )
 
     timeout = db.get("shell", "timeout", 60)
+    edit_interval = db.get("shell", "edit_interval", 2)
+    output = OutputRing(
+        max_size=db.get("shell", "max_output", 65536),
+        spill=db.get("shell", "spill", True),
+    )
+    tail_length = max(MAX_MESSAGE_LENGTH - len(cmd_text) - 300, 256)
+
+    stream = ShellStream(
+        command=cmd_text,
+        executable=db.get("shell", "executable"),
+        timeout=timeout,
+        limits=Limits.from_db() if db.get("shell", "limits", True) else None,
+    )
+
     try:
-        start_time = perf_counter()
-        rcode, stdout, stderr = await shell_exec(
-            command=cmd_text, executable=db.get("shell", "executable"), timeout=timeout
-        )
-    except asyncio.exceptions.TimeoutError:
-        text += (
-            "<b><emoji id=5465665476971471368>❌</emoji> Error!</b>\n"
-            f"<b>Timeout expired ({timeout} seconds)</b>"
-        )
-    else:
-        stop_time = perf_counter()
-        text += (
-            "<b><emoji id=5472164874886846699>✨</emoji> Result</b>:\n"
-            f"<code>{html.escape(stderr or stdout)}</code>"
+        try:
+            start_time = perf_counter()
+            last_edit_time = start_time
+
+            async for _, chunk in stream:
+                output.write(chunk)
+
+                if perf_counter() - last_edit_time < edit_interval:
+                    continue
+
+                await edit_message(
+                    message,
+                    text + "<b><emoji id=5821116867309210830>🔃</emoji> Output</b>:\n"
+                    f"<code>{html.escape(output.tail(tail_length))}</code>",
+                    wait=False,
+                )
+                last_edit_time = perf_counter()
+        except asyncio.exceptions.TimeoutError:
+            text += (
+                "<b><emoji id=5465665476971471368>❌</emoji> Error!</b>\n"
+                f"<b>Timeout expired ({timeout} seconds)</b>\n\n"
+            )
+            footer = ""
+        else:
+            stop_time = perf_counter()
+            text += "<b><emoji id=5472164874886846699>✨</emoji> Result</b>:\n"
+            footer = "\n"
+
+            if stream.limit_error:
+                footer += f"<b><emoji id=5465665476971471368>❌</emoji> {stream.limit_error}</b>\n"
+            if stream.usage:
+                footer += f"\n{stream.usage.format()}\n"
+            footer += (
+                f"<b>Completed in {round(stop_time - start_time, 5)} seconds "
+                f"with code {stream.returncode}</b>"
+            )
+
+        await send_output(
+            message,
+            lambda preview: text + preview + footer,
+            output.getvalue(),
+            file=output.file,
+            tail=True,
+            upload=db.get("shell", "spill", True),
         )
-        text += f"<b>Completed in {round(stop_time - start_time, 5)} seconds with code {rcode}</b>"
+    finally:
+        output.close()
 
-    await message.edit(text)
+
+# shcfg flag -> shell setting, sizes are in MB
+LIMIT_FLAGS = {
+    "-c": "cpu_limit",
+    "-a": "memory_limit",
+    "-n": "process_limit",
+    "-f": "file_limit",
+    "-o": "output_limit",
+}
+
+
+def _limits_config() -> str:
+    limits = Limits.from_db()
+
+    def show(value, unit=""):
+        return f"{value:g}{unit}" if value else "none"
+
+    return (
+        f"<b>• Limits:</b> <code>{db.get('shell', 'limits', True)}</code>\n"
+        f"<b>  CPU time:</b> <code>{show(limits.cpu, 's')}</code>, "
+        f"<b>memory:</b> <code>{show(limits.memory and limits.memory / 2**20, 'MB')}</code>, "
+        f"<b>processes:</b> <code>{show(limits.processes)}</code>, "
+        f"<b>file size:</b> <code>{show(limits.file_size and limits.file_size / 2**20, 'MB')}</code>, "
+        f"<b>output:</b> <code>{show(limits.output and limits.output / 2**20, 'MB')}</code>"
+    )
 
 
 @Client.on_message(command(["shcfg"]) & filters.me)
@@ -58,11 +141,25 @@ async def shell_config_handler(_: Client, message: Message):
         return await message.edit_text(
             "<b>Current config:</b>\n"
             f"<b>• Executable:</b> <code>{db.get('shell', 'executable')}</code>\n"
-            f"<b>• Timeout:</b> <code>{db.get('shell', 'timeout')}</code>"
+            f"<b>• Timeout:</b> <code>{db.get('shell', 'timeout')}</code>\n"
+            f"<b>• Edit interval:</b> <code>{db.get('shell', 'edit_interval', 2)}</code>\n"
+            f"<b>• Max output:</b> <code>{db.get('shell', 'max_output', 65536)}</code>\n"
+            f"<b>• Upload full output:</b> <code>{db.get('shell', 'spill', True)}</code>\n"
+            f"<b>• Preview messages:</b> <code>{db.get('shell', 'preview_messages', 3)}</code>\n"
+            f"<b>• Compress output over:</b> <code>{db.get('shell', 'compress_size', 1)}MB</code>\n"
+            f"<b>• Worker pool:</b> <code>{db.get('shell', 'pool', True)}</code>\n"
+            f"{_limits_config()}"
         )
 
     executable = nargs.get("-e")
     timeout = nargs.get("-t")
+    edit_interval = nargs.get("-i")
+    max_output = nargs.get("-m")
+    spill = nargs.get("-s")
+    pool = nargs.get("-p")
+    limits = nargs.get("-l")
+    preview_messages = nargs.get("-v")
+    compress_size = nargs.get("-z")
 
     if executable:
         if not shutil.which(executable) and not os.access(executable, os.X_OK):
@@ -74,14 +171,71 @@ async def shell_config_handler(_: Client, message: Message):
             return await message.edit_text("-t should be number")
         db.set("shell", "timeout", float(timeout))
 
+    if edit_interval:
+        if not edit_interval.replace(".", "", 1).isdigit():
+            return await message.edit_text("-i should be number")
+        db.set("shell", "edit_interval", float(edit_interval))
+
+    if max_output:
+        if not max_output.isdigit():
+            return await message.edit_text("-m should be number")
+        db.set("shell", "max_output", int(max_output))
+
+    if spill:
+        if spill not in ("on", "off"):
+            return await message.edit_text("-s should be on or off")
+        db.set("shell", "spill", spill == "on")
+
+    if pool:
+        if pool not in ("on", "off"):
+            return await message.edit_text("-p should be on or off")
+        db.set("shell", "pool", pool == "on")
+
+    if limits:
+        if limits not in ("on", "off"):
+            return await message.edit_text("-l should be on or off")
+        db.set("shell", "limits", limits == "on")
+
+    if preview_messages:
+        if not preview_messages.isdigit() or int(preview_messages) < 1:
+            return await message.edit_text("-v should be positive number")
+        db.set("shell", "preview_messages", int(preview_messages))
+
+    if compress_size:
+        if not compress_size.replace(".", "", 1).isdigit():
+            return await message.edit_text("-z should be number, 0 disables compression")
+        db.set("shell", "compress_size", float(compress_size))
+
+    for flag, key in LIMIT_FLAGS.items():
+        value = nargs.get(flag)
+        if value is None:
+            continue
+
+        if not value.replace(".", "", 1).isdigit():
+            return await message.edit_text(f"{flag} should be number, 0 disables the limit")
+        db.set("shell", key, float(value) if "." in value else int(value))
+
     return await message.edit_text(
         "<b>Params set!</b>\n\n"
         "<b>Current config:</b>\n"
         f"<b>• Executable:</b> <code>{db.get('shell', 'executable')}</code>\n"
-        f"<b>• Timeout:</b> <code>{db.get('shell', 'timeout')}</code>"
+        f"<b>• Timeout:</b> <code>{db.get('shell', 'timeout')}</code>\n"
+        f"<b>• Edit interval:</b> <code>{db.get('shell', 'edit_interval', 2)}</code>\n"
+        f"<b>• Max output:</b> <code>{db.get('shell', 'max_output', 65536)}</code>\n"
+        f"<b>• Upload full output:</b> <code>{db.get('shell', 'spill', True)}</code>\n"
+        f"<b>• Preview messages:</b> <code>{db.get('shell', 'preview_messages', 3)}</code>\n"
+        f"<b>• Compress output over:</b> <code>{db.get('shell', 'compress_size', 1)}MB</code>\n"
+        f"<b>• Worker pool:</b> <code>{db.get('shell', 'pool', True)}</code>\n"
+        f"{_limits_config()}"
     )
 
 
 module = modules_help.add_module("shell", __file__)
 module.add_command("shell", "Execute command in shell", "[command]", ["sh"])
-module.add_command("shcfg", "Shell configuration", "[-t] [-e]")
+module.add_command(
+    "shcfg",
+    "Shell configuration, -v messages to show long output in, -z MB over which "
+    "uploaded output is gzipped, limits: -c CPU seconds, -a address space, "
+    "-n processes, -f file size, -o output size (MB, 0 is unlimited)",
+    "[-t] [-e] [-i] [-m] [-s on/off] [-p on/off] [-v] [-z] [-l on/off] [-c] [-a] [-n] [-f] [-o]",
+)
@@ -1,7 +1,10 @@
+import asyncio
 import contextlib
+import html
 import os
-import shutil
 import tempfile
+from time import perf_counter
+from typing import List, Optional
 
 from pyrogram import Client, enums, errors, filters
 from pyrogram.types import Message
@@ -9,68 +12,164 @@ from pyrogram.types import Message
 from utils.db import db
 from utils.filters import command
 from utils.misc import modules_help
-from utils.scripts import shell_exec
+from utils.scripts import edit_message
+from utils.transcoder import TranscodeError, transcoder
+
+# Video notes are square and at most a minute long
+SIZE = 480
+MAX_DURATION = 60
+
+
+def _video_note_options() -> List[str]:
+    return [
+        "-t",
+        str(MAX_DURATION),
+        # "-preset", "superfast", "-crf", "24",
+        "-vcodec",
+        "libx264",
+        "-acodec",
+        "aac",
+        "-vf",
+        rf"crop=min(iw\,ih):min(iw\,ih),scale={SIZE}:{SIZE}",
+    ]
+
+
+class Progress:
+    """Shows progress of all conversions of the command in one message, if it's set"""
+
+    def __init__(self, message: Optional[Message], count: int):
+        self.message = message
+        self.done: List[Optional[float]] = [0.0] * count
+        self.edit_interval = db.get("shell", "edit_interval", 2)
+        self.last_edit = 0.0
+
+    def update(self, index: int, fraction: Optional[float], seconds: float) -> None:
+        self.done[index] = fraction
+
+        if self.message is None or perf_counter() - self.last_edit < self.edit_interval:
+            return
+
+        self.last_edit = perf_counter()
+        lines = []
+
+        for number, done in enumerate(self.done, 1):
+            status = "converting" if done is None else f"{done:.0%}"
+            if len(self.done) > 1:
+                lines.append(f"Video {number}/{len(self.done)}: {status}")
+            else:
+                lines.append(f"Converting video: {status}")
+
+        text = "\n".join(lines)
+        asyncio.create_task(edit_message(self.message, f"<code>{text}</code>", wait=False))
+
+
+async def _convert(
+    msg: Message, tempdir: str, index: int, progress: Progress, timeout: float
+) -> str:
+    """Downloads media of the message and returns path to the video note"""
+    media = getattr(msg, msg.media.value)
+    input_file_path = os.path.join(tempdir, f"input{index}.mp4")
+    output_file_path = os.path.join(tempdir, f"output{index}.mp4")
+
+    await msg.download(file_name=input_file_path)
+
+    if media.width == SIZE and media.height == SIZE and media.duration <= MAX_DURATION:
+        progress.update(index, 1.0, media.duration)
+        return input_file_path
+
+    await transcoder.transcode(
+        input_file_path,
+        output_file_path,
+        _video_note_options(),
+        input_options=["-hwaccel", "auto"],
+        duration=min(media.duration, MAX_DURATION) if media.duration else None,
+        on_progress=lambda fraction, seconds: progress.update(index, fraction, seconds),
+        timeout=timeout,
+    )
+
+    return output_file_path
 
 
 @Client.on_message(
     ~filters.scheduled & command(["vnote"]) & filters.me & ~filters.forwarded
 )
-async def vnote(_: Client, message: Message):
+async def vnote(client: Client, message: Message):
     msg = message.reply_to_message or message
 
     if not msg.media:
         return await message.edit_text("<b>Message should contain media!</b>")
 
-    if msg.media not in (
-        enums.MessageMediaType.VIDEO,
-        enums.MessageMediaType.ANIMATION,
-    ):
+    messages = [msg]
+    if msg.media_group_id:
+        messages = await client.get_media_group(msg.chat.id, msg.id)
+
+    messages = [
+        album_message
+        for album_message in messages
+        if album_message.media
+        in (
+            enums.MessageMediaType.VIDEO,
+            enums.MessageMediaType.ANIMATION,
+        )
+    ]
+
+    if not messages:
         return await message.edit_text("<b>Only video and gif supported!</b>")
 
-    media = getattr(msg, msg.media.value)
+    if not transcoder.available:
+        return await message.edit_text("<b>ffmpeg not installed!</b>")
 
-    width = 480
-    height = 480
+    transcoder.jobs = db.get("vnote", "jobs", 2)
+    timeout = db.get("vnote", "timeout", 300)
 
     with tempfile.TemporaryDirectory() as tempdir:
-        input_file_path = os.path.join(tempdir, "input.mp4")
-        output_file_path = os.path.join(tempdir, "output.mp4")
-
-        await msg.download(file_name=input_file_path)
-
         await message.edit_text("<code>Converting video...</code>")
 
         if message.media:
             await message.delete()
 
-        if media.width == width and media.height == height and media.duration <= 60:
-            output_file_path = input_file_path
-        else:
-            if not shutil.which("ffmpeg"):
-                with contextlib.supress(errors.MessageIdInvalid):
-                    return await message.edit("<b>ffmpeg not installed!</b>")
-
-            await shell_exec(
-                command=f"ffmpeg -y -hwaccel auto -i {input_file_path} "
-                "-t 00:01:00 "
-                # "-preset superfast -crf 24 "
-                "-vcodec libx264 -acodec aac "
-                rf'-vf "crop=min(iw\,ih):min(iw\,ih),scale={width}:{height}" '
-                f"{output_file_path}",
-                executable=db.get("shell", "executable"),
-            )
-
-        try:
-            await message.reply_video_note(
-                video_note=output_file_path,
-                quote=False,
-            )
-        except errors.VoiceMessagesForbidden:
-            with contextlib.supress(errors.MessageIdInvalid):
-                return await message.edit(
-                    "<b>Voice messages forbidden in this chat.</b>"
+        progress = Progress(None if message.media else message, len(messages))
+
+        results = await asyncio.gather(
+            *(
+                _convert(album_message, tempdir, index, progress, timeout)
+                for index, album_message in enumerate(messages)
+            ),
+            return_exceptions=True,
+        )
+
+        errors_text = []
+        for number, result in enumerate(results, 1):
+            if isinstance(result, asyncio.TimeoutError):
+                errors_text.append(f"Video {number}: timeout expired ({timeout} seconds)")
+            elif isinstance(result, TranscodeError):
+                errors_text.append(
+                    f"Video {number}: {result}\n{html.escape(result.stderr[-1024:])}"
                 )
+            elif isinstance(result, BaseException):
+                raise result
+
+        for result in results:
+            if isinstance(result, BaseException):
+                continue
+
+            try:
+                await message.reply_video_note(video_note=result, quote=False)
+            except errors.VoiceMessagesForbidden:
+                with contextlib.suppress(errors.MessageIdInvalid):
+                    return await message.edit(
+                        "<b>Voice messages forbidden in this chat.</b>"
+                    )
+
+    if errors_text:
+        text = "\n".join(errors_text)
+        with contextlib.suppress(errors.MessageIdInvalid):
+            await message.edit(f"<b>Conversion failed:</b>\n<code>{text}</code>")
 
 
 module = modules_help.add_module("vnote", __file__)
-module.add_command("vnote", "Make video note from message or reply media", "[reply]")
+module.add_command(
+    "vnote",
+    "Make video notes from message or reply media, all videos of an album are converted",
+    "[reply]",
+)
@@ -0,0 +1,75 @@
+import contextlib
+import contextvars
+import io
+import sys
+from typing import Iterator, Optional
+
+from utils.scripts import OutputRing
+
+current_output: contextvars.ContextVar[Optional[OutputRing]] = contextvars.ContextVar(
+    "current_output", default=None
+)
+
+
+class TaskOutput(io.TextIOBase):
+    """Replacement for ``sys.stdout``/``sys.stderr`` which writes to the output buffer of
+    the current context (see :func:`capture_output`), or to the original stream otherwise.
+
+    Unlike ``contextlib.redirect_stdout``, concurrent executions each get their own output,
+    and anything printed outside of them still goes to the console. Tasks and threads
+    started by an execution inherit its context, so their output is captured too.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    @property
+    def encoding(self):
+        return getattr(self.stream, "encoding", "utf-8")
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        output = current_output.get()
+
+        if output is None:
+            return self.stream.write(text)
+
+        output.write(text)
+        return len(text)
+
+    def flush(self) -> None:
+        if current_output.get() is None:
+            self.stream.flush()
+
+    def fileno(self) -> int:
+        return self.stream.fileno()
+
+    def isatty(self) -> bool:
+        return current_output.get() is None and self.stream.isatty()
+
+
+def install() -> None:
+    """Replaces ``sys.stdout`` and ``sys.stderr`` with :class:`TaskOutput` once"""
+    if not isinstance(sys.stdout, TaskOutput):
+        sys.stdout = TaskOutput(sys.stdout)
+
+    if not isinstance(sys.stderr, TaskOutput):
+        sys.stderr = TaskOutput(sys.stderr)
+
+
+@contextlib.contextmanager
+def capture_output(output: Optional[OutputRing] = None) -> Iterator[OutputRing]:
+    """Captures everything printed in the current context into ``output``"""
+    install()
+
+    if output is None:
+        output = OutputRing()
+
+    token = current_output.set(output)
+
+    try:
+        yield output
+    finally:
+        current_output.reset(token)
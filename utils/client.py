@@ -1,14 +1,31 @@
+import asyncio
 import importlib
 import logging
 import sys
+import time
 from importlib import import_module
 from pathlib import Path
 
-from pyrogram import Client
+from pyrogram import Client, errors, raw, types
+from pyrogram.handlers import RawUpdateHandler
 from pyrogram.handlers.handler import Handler
+from pyrogram.session import Session
+
+from utils.db import db
+from utils.http import http_client
+from utils.limits import spawner
+from utils.paste_server import paste_server
+from utils.py_pool import python_pool
+from utils.ratelimit import RateLimiter
+from utils.runners import close_runners
+from utils.sampler import sampler
+from utils.shell_pool import shell_pool
+from utils.updates import UpdateQueue
 
 log = logging.getLogger(__name__)
 
+PROFILE_UPDATES = (raw.types.UpdateUser, raw.types.UpdateUserName, raw.types.UpdateUserPhone)
+
 
 class CustomClient(Client):
     """Modified Pyrogram Client, the main means for interacting with Telegram.
@@ -150,11 +167,149 @@ class CustomClient(Client):
         init_connection_params (:obj:`~pyrogram.raw.base.JSONValue`, *optional*):
             Additional initConnection parameters.
             For now, only the tz_offset field is supported, for specifying timezone offset in seconds.
+
+        updates_queue_size (``int``, *optional*):
+            Maximum number of pending low-priority updates. Own outgoing messages are never limited.
+            Defaults to 10000.
+
+        updates_shed_policy (``str``, *optional*):
+            What to do with incoming updates when the queue is full: "drop_oldest", "drop_newest" or
+            "coalesce" (replace queued update for the same target, otherwise drop oldest).
+            Defaults to "coalesce".
+
+        profile_ttl (``int``, *optional*):
+            How often (in seconds) the cached own profile (:attr:`profile`) is refreshed in background,
+            in addition to refreshes triggered by profile updates.
+            Defaults to 3600.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(
+        self,
+        *args,
+        updates_queue_size: int = 10000,
+        updates_shed_policy: str = "coalesce",
+        profile_ttl: int = 3600,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
 
+        self.profile_ttl = profile_ttl
+        self._profile_updated = 0.0
+        self._profile_task = None
+
+        self.dispatcher.updates_queue = UpdateQueue(
+            maxsize=updates_queue_size, policy=updates_shed_policy
+        )
+        self.rate_limiter = RateLimiter(db)
+
+    @property
+    def updates_queue(self) -> UpdateQueue:
+        return self.dispatcher.updates_queue
+
+    @property
+    def profile(self) -> "types.User":
+        """Own profile without API calls.
+
+        Kept up to date by profile updates, if it gets older than ``profile_ttl``,
+        it is refreshed in background and the cached one is returned meanwhile.
+        """
+        if time.monotonic() - self._profile_updated > self.profile_ttl:
+            self._refresh_profile()
+
+        return self.me
+
+    def _refresh_profile(self) -> None:
+        if self._profile_task is None or self._profile_task.done():
+            self._profile_task = asyncio.create_task(self._fetch_profile())
+
+    async def _fetch_profile(self) -> None:
+        try:
+            self.me = await self.get_me()
+        except Exception as e:
+            log.warning("[%s] Failed to refresh own profile: %r", self.name, e)
+        finally:
+            self._profile_updated = time.monotonic()
+
+    async def _on_profile_update(self, _, update, users, chats):
+        if not isinstance(update, PROFILE_UPDATES) or self.me is None:
+            return
+
+        if update.user_id != self.me.id:
+            return
+
+        if isinstance(update, raw.types.UpdateUserName):
+            self.me.first_name = update.first_name
+            self.me.last_name = update.last_name
+            self.me.username = next(
+                (u.username for u in update.usernames if u.editable),
+                next((u.username for u in update.usernames if u.active), None),
+            )
+        elif isinstance(update, raw.types.UpdateUserPhone):
+            self.me.phone_number = update.phone
+        else:
+            # Anything else (e.g. premium status) changed, just refetch it
+            self._refresh_profile()
+
+    async def start(self, *args, **kwargs):
+        result = await super().start(*args, **kwargs)
+
+        self._profile_updated = time.monotonic()
+        self.add_handler(RawUpdateHandler(self._on_profile_update), group=-1000)
+
+        return result
+
+    async def invoke(
+        self,
+        query,
+        retries: int = Session.MAX_RETRIES,
+        timeout: float = Session.WAIT_TIMEOUT,
+        sleep_threshold: float = None,
+        **kwargs,
+    ):
+        """Invokes raw function through the adaptive rate limiter.
+
+        FloodWait and FloodPremiumWait errors are always raised by the session, so the
+        limiter can learn from them. Waits below ``sleep_threshold`` are still handled here transparently.
+        """
+        if sleep_threshold is None:
+            sleep_threshold = self.sleep_threshold
+
+        while True:
+            await self.rate_limiter.acquire(query)
+
+            try:
+                result = await super().invoke(
+                    query, retries, timeout, sleep_threshold=0, **kwargs
+                )
+            except (errors.FloodWait, errors.FloodPremiumWait) as e:
+                self.rate_limiter.on_flood(query, e.value)
+
+                if e.value > sleep_threshold:
+                    raise
+
+                log.warning(
+                    '[%s] Waiting for %s seconds before continuing (required by "%s")',
+                    self.name,
+                    e.value,
+                    query.QUALNAME,
+                )
+            else:
+                self.rate_limiter.on_success(query)
+                return result
+
+    async def stop(self, *args, **kwargs):
+        result = await super().stop(*args, **kwargs)
+
+        await http_client.close()
+        await shell_pool.close()
+        await paste_server.stop()
+        await sampler.stop()
+        await python_pool.close()
+        await close_runners()
+        await spawner.close()
+
+        return result
+
     def unload_plugin(self, plugin_name: str) -> bool:
         """
         Unloads a plugin.
@@ -204,6 +359,51 @@ class CustomClient(Client):
 
         return True
 
+    def load_plugin(self, plugin_name: str) -> bool:
+        """
+        Loads (or reloads, if it's already loaded) a plugin.
+
+        Parameters:
+            plugin_name (``str``):
+                The name of the plugin to load.
+
+        Returns:
+            ``bool``: True if the plugin was loaded successfully, False otherwise.
+        """
+        if self.plugins:
+            root = self.plugins["root"]
+        else:
+            root = "plugins"
+
+        path = root + "." + plugin_name
+
+        if path in sys.modules:
+            self.unload_plugin(plugin_name)
+
+        try:
+            module = importlib.import_module(path)
+        except Exception as e:
+            log.warning('[%s] [LOAD] Ignoring module "%s": %s', self.name, path, e)
+            return False
+
+        for name in vars(module).keys():
+            # noinspection PyBroadException
+            try:
+                for handler, group in getattr(module, name).handlers:
+                    if isinstance(handler, Handler) and isinstance(group, int):
+                        self.add_handler(handler, group)
+
+                        log.info(
+                            '[{}] [LOAD] {}("{}") in group {} from "{}"'.format(
+                                self.name, type(handler).__name__, name, group, path
+                            )
+                        )
+
+            except Exception:
+                pass
+
+        return True
+
     def load_plugins(self):
         if self.plugins:
             plugins = self.plugins.copy()
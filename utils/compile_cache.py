@@ -0,0 +1,139 @@
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import shlex
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from utils.scripts import shell_exec
+
+
+class BuildResult:
+    def __init__(
+        self,
+        path: Optional[str],
+        hit: bool,
+        compile_time: float,
+        returncode: int = 0,
+        stderr: str = "",
+    ):
+        self.path = path
+        self.hit = hit
+        # For cache hits it's the time the original compilation took
+        self.compile_time = compile_time
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class CompileCache:
+    """Content-addressed cache of compiled snippets.
+
+    Binaries are stored under a hash of the source, compiler, compiler version and
+    flags, so running the same snippet again skips compilation. When total size of
+    the cache exceeds ``max_size`` bytes, least recently used binaries are removed.
+    """
+
+    def __init__(self, path: str = ".cache/bin", max_size: int = 512 * 2**20):
+        self.path = Path(path)
+        self.max_size = max_size
+
+        self._versions: Dict[str, str] = {}
+        self._locks = collections.defaultdict(asyncio.Lock)
+
+    async def compiler_version(self, version_command: str) -> str:
+        if version_command not in self._versions:
+            _, stdout, stderr = await shell_exec(version_command, timeout=30)
+            self._versions[version_command] = (stdout or stderr).strip()
+
+        return self._versions[version_command]
+
+    def _evict(self) -> None:
+        files = []
+        total = 0
+
+        for file in self.path.iterdir():
+            if file.suffix == ".json" or not file.is_file():
+                continue
+
+            stat = file.stat()
+            files.append((stat.st_mtime, stat.st_size, file))
+            total += stat.st_size
+
+        for _, size, file in sorted(files):
+            if total <= self.max_size:
+                break
+
+            file.unlink(missing_ok=True)
+            file.with_suffix(".json").unlink(missing_ok=True)
+            total -= size
+
+    async def build(
+        self,
+        source: str,
+        suffix: str,
+        command: str,
+        version_command: str,
+        flags: Optional[List[str]] = None,
+        executable: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> BuildResult:
+        """Returns path to the binary compiled from ``source``, compiling it if needed.
+
+        ``command`` is a format string with ``{flags}``, ``{source}`` and ``{output}``
+        placeholders, e.g. ``"gcc {flags} -o {output} {source}"``.
+        """
+        flags = flags or []
+        version = await self.compiler_version(version_command)
+        key = hashlib.sha256(
+            json.dumps([command, version, flags, source]).encode()
+        ).hexdigest()[:32]
+
+        binary = self.path / key
+        info = binary.with_suffix(".json")
+
+        async with self._locks[key]:
+            if binary.is_file():
+                os.utime(binary)
+
+                try:
+                    compile_time = json.loads(info.read_text())["compile_time"]
+                except (OSError, ValueError, KeyError):
+                    compile_time = 0.0
+
+                return BuildResult(str(binary.absolute()), True, compile_time)
+
+            self.path.mkdir(parents=True, exist_ok=True)
+
+            with tempfile.TemporaryDirectory(dir=self.path) as tempdir:
+                source_file = Path(tempdir) / f"main{suffix}"
+                source_file.write_text(source)
+                output = Path(tempdir) / "output"
+
+                started = time.perf_counter()
+                returncode, _, stderr = await shell_exec(
+                    command=command.format(
+                        flags=" ".join(shlex.quote(flag) for flag in flags),
+                        source=shlex.quote(str(source_file.absolute())),
+                        output=shlex.quote(str(output.absolute())),
+                    ),
+                    executable=executable,
+                    timeout=timeout,
+                )
+                compile_time = time.perf_counter() - started
+
+                if returncode != 0 or not output.is_file():
+                    return BuildResult(None, False, compile_time, returncode, stderr)
+
+                output.replace(binary)
+
+            info.write_text(json.dumps({"compile_time": compile_time}))
+            await asyncio.to_thread(self._evict)
+
+        return BuildResult(str(binary.absolute()), False, compile_time, 0, stderr)
+
+
+compile_cache = CompileCache()
@@ -54,6 +54,8 @@ class SqliteDatabase(Database):
         self._conn.commit()
 
     def _execute(self, module: str, sql, params=None):
+        params = params or ()
+
         with self._lock:
             try:
                 return self._cursor.execute(sql, params)
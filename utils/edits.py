@@ -0,0 +1,138 @@
+import asyncio
+import collections
+import hashlib
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from pyrogram import errors
+from pyrogram.types import Message
+
+log = logging.getLogger(__name__)
+
+
+class PendingEdit:
+    def __init__(self, message: Message, text: str, kwargs: dict):
+        self.message = message
+        self.text = text
+        self.kwargs = kwargs
+        self.futures: List[asyncio.Future] = []
+
+    @property
+    def digest(self) -> bytes:
+        return hashlib.blake2b(
+            f"{self.text}\0{sorted(self.kwargs.items())!r}".encode(), digest_size=16
+        ).digest()
+
+
+class EditQueue:
+    """Central queue for outgoing message edits.
+
+    Edits are keyed by ``(chat_id, message_id)``: while an edit waits for its turn, newer
+    edits of the same message replace it, so only the latest text is sent. An edit with the
+    same text (and options) as the last sent one is skipped. Edits are paced per chat: every
+    FloodWait doubles the interval between edits in that chat, and successful edits slowly
+    bring it back down.
+    """
+
+    def __init__(
+        self, max_interval: float = 10, recovery: float = 0.8, history_size: int = 1024
+    ):
+        self.max_interval = max_interval
+        self.recovery = recovery
+        self.history_size = history_size
+
+        self._pending: Dict[Tuple[int, int], PendingEdit] = {}
+        self._workers: Dict[Tuple[int, int], asyncio.Task] = {}
+        self._sent = collections.OrderedDict()
+        self._chat_interval: Dict[int, float] = {}
+        self._chat_next: Dict[int, float] = {}
+
+    def submit(self, message: Message, text: str, **kwargs) -> asyncio.Future:
+        """Schedules message edit, returns future resolved with the edited message"""
+        key = (message.chat.id, message.id)
+        future = asyncio.get_running_loop().create_future()
+
+        edit = PendingEdit(message, text, kwargs)
+        previous = self._pending.get(key)
+        if previous:
+            # Superseded edits are resolved together with the latest one
+            edit.futures.extend(previous.futures)
+        edit.futures.append(future)
+
+        self._pending[key] = edit
+
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._worker(key))
+
+        return future
+
+    def interval(self, chat_id: int) -> float:
+        return self._chat_interval.get(chat_id, 0)
+
+    def _remember(self, key: Tuple[int, int], digest: bytes) -> None:
+        self._sent[key] = digest
+        self._sent.move_to_end(key)
+
+        while len(self._sent) > self.history_size:
+            self._sent.popitem(last=False)
+
+    async def _wait_turn(self, chat_id: int) -> None:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        start = max(now, self._chat_next.get(chat_id, 0))
+        self._chat_next[chat_id] = start + self.interval(chat_id)
+
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def _worker(self, key: Tuple[int, int]) -> None:
+        chat_id = key[0]
+
+        try:
+            while key in self._pending:
+                await self._wait_turn(chat_id)
+
+                edit = self._pending.pop(key)
+                digest = edit.digest
+
+                if self._sent.get(key) == digest:
+                    self._resolve(edit, edit.message)
+                    continue
+
+                try:
+                    result = await edit.message.edit_text(edit.text, **edit.kwargs)
+                except errors.MessageNotModified:
+                    self._remember(key, digest)
+                    self._resolve(edit, edit.message)
+                except errors.FloodWait as e:
+                    interval = min(max(self.interval(chat_id) * 2, 0.5), self.max_interval)
+                    self._chat_interval[chat_id] = interval
+                    self._chat_next[chat_id] = asyncio.get_running_loop().time() + e.value
+
+                    log.info("FloodWait on edit in %s, pacing edits every %ss", chat_id, interval)
+
+                    # Retry unless a newer edit arrived meanwhile
+                    newer = self._pending.get(key)
+                    if newer:
+                        newer.futures.extend(edit.futures)
+                    else:
+                        self._pending[key] = edit
+                except Exception as e:
+                    for future in edit.futures:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    self._remember(key, digest)
+                    self._chat_interval[chat_id] = self.interval(chat_id) * self.recovery
+                    self._resolve(edit, result)
+        finally:
+            del self._workers[key]
+
+    @staticmethod
+    def _resolve(edit: PendingEdit, result: Optional[Message]) -> None:
+        for future in edit.futures:
+            if not future.done():
+                future.set_result(result)
+
+
+edit_queue = EditQueue()
@@ -0,0 +1,274 @@
+import asyncio
+import collections
+import functools
+import logging
+from time import perf_counter
+from typing import Callable, Coroutine, Deque, Dict, List, Optional
+
+from pyrogram.types import Message
+
+from utils.db import db
+from utils.scripts import edit_message, get_prefix
+
+log = logging.getLogger(__name__)
+
+
+class Execution:
+    """Code execution submitted to :class:`ExecutionScheduler`"""
+
+    def __init__(self, execution_id: int, name: str, chat_id: int, message_id: int):
+        self.id = execution_id
+        self.name = name
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.task: Optional[asyncio.Task] = None
+        # 1-based position in the queue, None once it's running
+        self.position: Optional[int] = None
+        self.cancelled = False
+
+        self.submitted = perf_counter()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+
+        self._slot = asyncio.get_running_loop().create_future()
+
+    @property
+    def state(self) -> str:
+        if self.finished is not None:
+            return "finished"
+
+        return "running" if self.started is not None else "queued"
+
+    @property
+    def wait_time(self) -> float:
+        return (self.started or self.finished or perf_counter()) - self.submitted
+
+    @property
+    def run_time(self) -> float:
+        if self.started is None:
+            return 0.0
+
+        return (self.finished or perf_counter()) - self.started
+
+
+class ExecutionScheduler:
+    """Limits how many code executions run at once.
+
+    Executions wait for one of ``slots`` in a FIFO queue per chat, and chats take turns,
+    so a burst of snippets in one chat doesn't hold back the others. Wait and run times
+    are recorded separately per execution name (e.g. language).
+    """
+
+    def __init__(self, slots: int = 2):
+        self.slots = slots
+        self.running: Dict[int, Execution] = {}
+        self.stats: Dict[str, Dict[str, float]] = {}
+
+        self._queues: "collections.OrderedDict[int, Deque[Execution]]" = (
+            collections.OrderedDict()
+        )
+        self._position_callbacks: Dict[int, Callable[[Execution], None]] = {}
+        self._next_id = 0
+
+    def queued(self) -> List[Execution]:
+        """Returns waiting executions in the order they will be started"""
+        queues = [list(queue) for queue in self._queues.values()]
+        order = []
+
+        for index in range(max(map(len, queues), default=0)):
+            order.extend(queue[index] for queue in queues if index < len(queue))
+
+        return order
+
+    def get(self, execution_id: int) -> Optional[Execution]:
+        if execution_id in self.running:
+            return self.running[execution_id]
+
+        for execution in self.queued():
+            if execution.id == execution_id:
+                return execution
+
+        return None
+
+    def find(self, chat_id: int, message_id: Optional[int] = None) -> Optional[Execution]:
+        """Returns execution started by the message, or the latest one in the chat"""
+        executions = [
+            execution
+            for execution in [*self.running.values(), *self.queued()]
+            if execution.chat_id == chat_id
+            and (message_id is None or execution.message_id == message_id)
+        ]
+
+        return max(executions, key=lambda execution: execution.id, default=None)
+
+    def _dispatch(self) -> None:
+        while len(self.running) < self.slots and self._queues:
+            chat_id, queue = next(iter(self._queues.items()))
+            execution = queue.popleft()
+
+            # Chat goes to the end of the line after its turn
+            if queue:
+                self._queues.move_to_end(chat_id)
+            else:
+                del self._queues[chat_id]
+
+            # Cancelled, waits only for _finish
+            if execution._slot.done():
+                continue
+
+            execution.position = None
+            execution.started = perf_counter()
+            self.running[execution.id] = execution
+            execution._slot.set_result(None)
+
+        for position, execution in enumerate(self.queued(), 1):
+            if execution.position != position:
+                execution.position = position
+                callback = self._position_callbacks.get(execution.id)
+
+                if callback is not None:
+                    try:
+                        callback(execution)
+                    except Exception:
+                        log.exception("Error in queue position callback")
+
+    def _remove(self, execution: Execution) -> None:
+        queue = self._queues.get(execution.chat_id)
+
+        if queue is not None and execution in queue:
+            queue.remove(execution)
+
+            if not queue:
+                del self._queues[execution.chat_id]
+
+    def _record(self, execution: Execution) -> None:
+        stats = self.stats.setdefault(
+            execution.name,
+            {
+                "runs": 0,
+                "cancelled": 0,
+                "total_wait": 0.0,
+                "max_wait": 0.0,
+                "total_run": 0.0,
+                "max_run": 0.0,
+            },
+        )
+
+        stats["runs"] += 1
+        stats["cancelled"] += execution.cancelled
+        stats["total_wait"] += execution.wait_time
+        stats["max_wait"] = max(stats["max_wait"], execution.wait_time)
+        stats["total_run"] += execution.run_time
+        stats["max_run"] = max(stats["max_run"], execution.run_time)
+
+    @staticmethod
+    async def _run(execution: Execution, coro: Coroutine):
+        await execution._slot
+        return await coro
+
+    def _finish(self, execution: Execution, coro: Coroutine) -> None:
+        # Closes the coroutine if it was cancelled before it started
+        coro.close()
+
+        self._remove(execution)
+        self.running.pop(execution.id, None)
+        self._position_callbacks.pop(execution.id, None)
+
+        execution.finished = perf_counter()
+        self._record(execution)
+        self._dispatch()
+
+    def submit(
+        self,
+        name: str,
+        chat_id: int,
+        message_id: int,
+        coro: Coroutine,
+        on_position: Optional[Callable[[Execution], None]] = None,
+    ) -> Execution:
+        """Queues coroutine for execution and returns :obj:`Execution`, its ``task`` gives
+        the result. ``on_position`` is called whenever queue position of the execution changes.
+        """
+        self._next_id += 1
+        execution = Execution(self._next_id, name, chat_id, message_id)
+
+        if on_position is not None:
+            self._position_callbacks[execution.id] = on_position
+
+        self._queues.setdefault(chat_id, collections.deque()).append(execution)
+        execution.task = asyncio.create_task(self._run(execution, coro))
+        execution.task.add_done_callback(lambda _: self._finish(execution, coro))
+        self._dispatch()
+
+        return execution
+
+    def cancel(self, execution: Execution) -> bool:
+        """Cancels queued or running execution"""
+        if execution.state == "finished":
+            return False
+
+        execution.cancelled = True
+        execution.task.cancel()
+
+        # Its task is cancelled a few loop iterations later, it mustn't be dispatched before
+        if execution.state == "queued":
+            self._remove(execution)
+            self._dispatch()
+
+        return True
+
+
+executions = ExecutionScheduler()
+
+
+def queued(name: str):
+    """Runs the handler as an execution of :obj:`executions`.
+
+    The handler returns right away, so waiting executions don't hold update workers
+    of the dispatcher. While the execution waits for a slot, the message shows its
+    queue position, and if it's cancelled with ``.cancel``, the message says so.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(client, message: Message):
+            def show_position(execution: Execution):
+                asyncio.create_task(
+                    edit_message(
+                        message,
+                        "<b><emoji id=5821116867309210830>🔃</emoji> "
+                        f"Queued, position {execution.position}</b>\n"
+                        f"<i>Cancel with <code>{get_prefix()}cancel {execution.id}</code></i>",
+                        wait=False,
+                    )
+                )
+
+            def done(task: asyncio.Task):
+                if not task.cancelled():
+                    if task.exception() is not None:
+                        log.error(
+                            "Error in %s execution", name, exc_info=task.exception()
+                        )
+                elif execution.cancelled:
+                    asyncio.create_task(
+                        edit_message(
+                            message,
+                            "<b><emoji id=5465665476971471368>❌</emoji> Execution cancelled</b>\n"
+                            f"<b>Waited {round(execution.wait_time, 3)}s, "
+                            f"ran {round(execution.run_time, 3)}s</b>",
+                        )
+                    )
+
+            executions.slots = db.get("code_runner", "slots", 2)
+            execution = executions.submit(
+                name,
+                message.chat.id,
+                message.id,
+                func(client, message),
+                on_position=show_position,
+            )
+            execution.task.add_done_callback(done)
+
+        return wrapper
+
+    return decorator
@@ -29,7 +29,7 @@ def command(commands: Union[str, List[str]], case_sensitive: bool = False):
     command_re = re.compile(r"([\"'])(.*?)(?<!\\)\1|(\S+)")
 
     async def func(flt, client: Client, message: Message):
-        username = client.me.username or ""
+        username = client.profile.username or ""
         text = message.text or message.caption
         message.command = None
 
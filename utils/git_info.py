@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+import git
+
+log = logging.getLogger(__name__)
+
+
+class RepoInfo:
+    """Cached information about the userbot git repository.
+
+    All git operations run in a thread, so they never block the event loop. The remote
+    branch head is fetched in background when it gets older than ``ttl`` seconds, and
+    callers get the last known value meanwhile. Commit counts (versions) are computed
+    once per commit with ``git rev-list --count``, counting only new commits from the
+    nearest already counted ancestor.
+    """
+
+    def __init__(self, path: str = ".", remote: str = "origin", ttl: float = 600):
+        self.path = path
+        self.remote = remote
+        self.ttl = ttl
+
+        self.remote_hash: Optional[str] = None
+        self.remote_version: Optional[int] = None
+        self.fetched_at = 0.0
+
+        self._repo: Optional[git.Repo] = None
+        # commit hexsha -> number of commits reachable from it
+        self._counts: Dict[str, int] = {}
+        self._counts_lock = threading.Lock()
+        self._fetch_task: Optional[asyncio.Task] = None
+
+    @property
+    def repo(self) -> git.Repo:
+        if self._repo is None:
+            self._repo = git.Repo(self.path)
+
+        return self._repo
+
+    def _count(self, hexsha: str) -> int:
+        with self._counts_lock:
+            return self._count_locked(hexsha)
+
+    def _count_locked(self, hexsha: str) -> int:
+        if hexsha in self._counts:
+            return self._counts[hexsha]
+
+        count = None
+        # Try newest known commits first, they are the most likely ancestors
+        for known, known_count in sorted(self._counts.items(), key=lambda x: -x[1]):
+            if self.repo.is_ancestor(known, hexsha):
+                count = known_count + int(
+                    self.repo.git.rev_list("--count", f"{known}..{hexsha}")
+                )
+                break
+
+        if count is None:
+            count = int(self.repo.git.rev_list("--count", hexsha))
+
+        self._counts[hexsha] = count
+
+        # Only a few commits are interesting at once (local and remote heads)
+        while len(self._counts) > 16:
+            del self._counts[min(self._counts, key=self._counts.get)]
+
+        return count
+
+    def _local(self) -> Dict[str, object]:
+        hexsha = self.repo.head.commit.hexsha
+
+        return {
+            "branch": self.repo.active_branch.name,
+            "hash": hexsha,
+            "version": self._count(hexsha),
+        }
+
+    async def local(self) -> Dict[str, object]:
+        """Returns current branch, commit hash and version"""
+        return await asyncio.to_thread(self._local)
+
+    def _fetch(self) -> None:
+        self.repo.remote(self.remote).fetch()
+
+        branch = self.repo.active_branch.name
+        hexsha = self.repo.commit(f"{self.remote}/{branch}").hexsha
+
+        self.remote_hash = hexsha
+        self.remote_version = self._count(hexsha)
+
+    async def fetch(self) -> None:
+        """Fetches remote and updates cached remote head, raises on git errors"""
+        try:
+            await asyncio.to_thread(self._fetch)
+        finally:
+            self.fetched_at = time.monotonic()
+
+    async def _background_fetch(self) -> None:
+        try:
+            await self.fetch()
+        except Exception as e:
+            log.warning("Failed to fetch %s: %r", self.remote, e)
+
+    def refresh(self) -> None:
+        """Starts background fetch if it isn't already running"""
+        if self._fetch_task is None or self._fetch_task.done():
+            self._fetch_task = asyncio.create_task(self._background_fetch())
+
+    async def status(self) -> Dict[str, object]:
+        """Returns local info with last known remote head, without waiting for network.
+
+        ``remote_hash`` and ``remote_version`` are None until the first fetch completes.
+        """
+        if time.monotonic() - self.fetched_at > self.ttl:
+            self.refresh()
+
+        info = await self.local()
+        info["remote_hash"] = self.remote_hash
+        info["remote_version"] = self.remote_version
+
+        return info
+
+    def _changed_files(self, old: str, new: str) -> List[str]:
+        return self.repo.git.diff("--name-only", old, new).splitlines()
+
+    async def changed_files(self, old: str, new: str) -> List[str]:
+        """Returns paths of files changed between two revisions"""
+        return await asyncio.to_thread(self._changed_files, old, new)
+
+    def _pull(self) -> None:
+        self.repo.remote(self.remote).pull()
+
+    async def pull(self) -> None:
+        await asyncio.to_thread(self._pull)
+
+
+repo_info = RepoInfo()
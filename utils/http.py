@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import random
+from typing import Optional
+
+import aiohttp
+
+log = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+
+class HttpClient:
+    """Process-wide HTTP client with a keep-alive connection pool.
+
+    The underlying ``aiohttp.ClientSession`` is created on first use and reused by
+    everyone, so connections (and TLS handshakes) and cookies are shared between calls.
+    Failed idempotent requests (connection errors, timeouts and ``RETRY_STATUSES``) are
+    retried up to ``retries`` times with exponential backoff. Other requests are retried
+    only if the connection couldn't be established, so the server never got them.
+    """
+
+    def __init__(
+        self,
+        limit: int = 20,
+        keepalive_timeout: float = 60,
+        timeout: float = 30,
+        retries: int = 3,
+        backoff: float = 0.5,
+    ):
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    ssl=False,
+                    limit=self.limit,
+                    keepalive_timeout=self.keepalive_timeout,
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+
+        return self._session
+
+    async def request(
+        self, method: str, url: str, retry: Optional[bool] = None, **kwargs
+    ) -> aiohttp.ClientResponse:
+        """Sends request and returns response with already read body.
+
+        Connection is returned to the pool before returning, the body is still
+        available through ``read()``, ``text()`` and ``json()``.
+        ``retry`` enables retries after the request was sent, by default only
+        for idempotent methods.
+        """
+        if retry is None:
+            retry = method.upper() in IDEMPOTENT_METHODS
+
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.session.request(method, url, **kwargs) as response:
+                    await response.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                sent = not isinstance(e, aiohttp.ClientConnectorError)
+                if attempt == self.retries or (sent and not retry):
+                    raise
+
+                log.debug("Retrying %s %s due to: %r", method, url, e)
+            else:
+                if (
+                    not retry
+                    or response.status not in RETRY_STATUSES
+                    or attempt == self.retries
+                ):
+                    return response
+
+                log.debug("Retrying %s %s due to status %s", method, url, response.status)
+
+            await asyncio.sleep(self.backoff * 2**attempt * random.uniform(0.5, 1.5))
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+        self._session = None
+
+
+http_client = HttpClient()
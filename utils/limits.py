@@ -0,0 +1,268 @@
+import contextlib
+import json
+import math
+import shlex
+import signal
+import sys
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional, Tuple, Union
+
+import psutil
+
+from utils.db import db
+from utils.shell_pool import ReplWorker, ShellPool
+
+try:
+    import resource
+except ImportError:
+    # Limits aren't supported on Windows
+    resource = None
+
+
+class Limits:
+    """Resource limits for a snippet process and everything it starts.
+
+    ``cpu`` is in seconds of CPU time, ``memory`` (address space), ``file_size`` and
+    ``output`` are in bytes, ``processes`` is the number of processes of the user.
+    ``None`` means no limit. ``output`` is enforced by the reader, the rest are rlimits.
+    """
+
+    def __init__(
+        self,
+        cpu: Optional[float] = None,
+        memory: Optional[int] = None,
+        processes: Optional[int] = None,
+        file_size: Optional[int] = None,
+        output: Optional[int] = None,
+    ):
+        self.cpu = cpu
+        self.memory = memory
+        self.processes = processes
+        self.file_size = file_size
+        self.output = output
+
+    @classmethod
+    def from_db(cls) -> "Limits":
+        """Limits from ``shell`` settings, sizes there are in MB and 0 disables a limit"""
+
+        def megabytes(key: str, default: Optional[int] = None) -> Optional[int]:
+            value = db.get("shell", key, default)
+            return int(value * 2**20) if value else None
+
+        return cls(
+            cpu=db.get("shell", "cpu_limit", db.get("shell", "timeout", 60)) or None,
+            memory=megabytes("memory_limit"),
+            processes=db.get("shell", "process_limit") or None,
+            file_size=megabytes("file_limit"),
+            output=megabytes("output_limit", 16),
+        )
+
+    def rlimits(self, cpu_used: float = 0.0) -> Dict[str, Optional[int]]:
+        """Returns soft rlimits by name, ``None`` means the hard limit.
+
+        RLIMIT_CPU counts the whole process lifetime, so for long-lived processes
+        ``cpu_used`` moves the limit forward.
+        """
+        return {
+            "RLIMIT_CPU": math.ceil(cpu_used + self.cpu) if self.cpu else None,
+            "RLIMIT_AS": self.memory,
+            "RLIMIT_NPROC": self.processes,
+            "RLIMIT_FSIZE": self.file_size,
+        }
+
+    def apply(self, pid: int = 0, cpu_used: float = 0.0) -> None:
+        """Sets rlimits of a running process (current one by default).
+
+        Unset limits are raised back to the hard limit, so a reused process doesn't
+        keep limits of a previous run.
+        """
+        if resource is None:
+            return
+
+        for name, value in self.rlimits(cpu_used).items():
+            limit = getattr(resource, name)
+            _, hard = resource.prlimit(pid, limit)
+
+            if value is None:
+                soft = hard
+            elif hard == resource.RLIM_INFINITY:
+                soft = value
+            else:
+                soft = min(value, hard)
+
+            resource.prlimit(pid, limit, (soft, hard))
+
+
+def limit_error(returncode: Optional[int]) -> Optional[str]:
+    """Returns description of the limit which killed the process with this return code"""
+    if returncode is None:
+        return None
+
+    # Shells report death by a signal as 128 + signal number
+    for signum, text in (
+        (signal.SIGXCPU, "CPU time limit exceeded"),
+        (signal.SIGXFSZ, "File size limit exceeded"),
+    ):
+        if returncode in (-signum, 128 + signum):
+            return text
+
+    return None
+
+
+class Usage:
+    """Resources used by a snippet: CPU time in seconds, peak RSS and disk I/O in bytes"""
+
+    def __init__(
+        self,
+        user: float = 0.0,
+        system: float = 0.0,
+        max_rss: int = 0,
+        read_bytes: int = 0,
+        write_bytes: int = 0,
+    ):
+        self.user = user
+        self.system = system
+        self.max_rss = max_rss
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+
+    @classmethod
+    def of_process(cls, pid: int) -> "Usage":
+        """Cumulative usage of a running process and its reaped children.
+
+        ``max_rss`` is the peak RSS of the process itself, see :func:`reset_peak_rss`.
+        """
+        process = psutil.Process(pid)
+        times = process.cpu_times()
+        usage = cls(
+            user=times.user + times.children_user,
+            system=times.system + times.children_system,
+        )
+
+        with contextlib.suppress(psutil.Error, AttributeError):
+            io = process.io_counters()
+            usage.read_bytes = io.read_bytes
+            usage.write_bytes = io.write_bytes
+
+        with contextlib.suppress(OSError, ValueError):
+            with open(f"/proc/{pid}/status") as file:
+                for line in file:
+                    if line.startswith("VmHWM:"):
+                        usage.max_rss = int(line.split()[1]) * 1024
+                        break
+            return usage
+
+        usage.max_rss = process.memory_info().rss
+        return usage
+
+    def __sub__(self, other: "Usage") -> "Usage":
+        return Usage(
+            user=self.user - other.user,
+            system=self.system - other.system,
+            max_rss=self.max_rss,
+            read_bytes=self.read_bytes - other.read_bytes,
+            write_bytes=self.write_bytes - other.write_bytes,
+        )
+
+    def format(self) -> str:
+        return (
+            f"<b>CPU:</b> <code>{self.user:.3f}s user, {self.system:.3f}s sys</code>\n"
+            f"<b>Peak RSS:</b> <code>{self.max_rss / 2**20:.1f}MB</code>\n"
+            f"<b>I/O:</b> <code>{self.read_bytes / 2**10:.0f}KB read, "
+            f"{self.write_bytes / 2**10:.0f}KB written</code>"
+        )
+
+
+def reset_peak_rss(pid: int) -> None:
+    """Resets peak RSS (VmHWM) of the process, so it can be measured per run (Linux only)"""
+    with contextlib.suppress(OSError):
+        with open(f"/proc/{pid}/clear_refs", "w") as file:
+            file.write("5")
+
+
+class LimitedStream:
+    """Same interface as :class:`utils.scripts.ShellStream`, but runs the command with
+    the spawner under limits. After iteration ``usage`` contains resources used by the
+    command (lost if it was killed for the output limit) and ``limit_error`` describes
+    the limit it hit, if any.
+    """
+
+    def __init__(
+        self,
+        spawner: "Spawner",
+        command: str,
+        limits: Limits,
+        executable: Optional[str] = None,
+        timeout: Optional[Union[int, float]] = None,
+    ):
+        self.spawner = spawner
+        self.command = command
+        self.limits = limits
+        self.executable = executable
+        self.timeout = timeout
+        self.returncode = None
+        self.usage: Optional[Usage] = None
+        self.limit_error: Optional[str] = None
+
+    async def __aiter__(self) -> AsyncIterator[Tuple[str, str]]:
+        request = json.dumps(
+            {
+                "command": self.command,
+                "executable": self.executable,
+                "rlimits": self.limits.rlimits(),
+            }
+        )
+        worker = await self.spawner.pool.acquire(self.spawner.executable)
+        output_size = 0
+
+        try:
+            async with contextlib.aclosing(worker.stream(request, self.timeout)) as stream:
+                async for name, text in stream:
+                    output_size += len(text.encode())
+
+                    if self.limits.output and output_size > self.limits.output:
+                        self.limit_error = "Output limit exceeded"
+                        await worker.kill()
+                        break
+
+                    yield name, text
+        finally:
+            await self.spawner.pool.release(worker)
+
+        self.returncode = worker.returncode if worker.alive else worker.process.returncode
+        self.limit_error = self.limit_error or limit_error(self.returncode)
+
+        with contextlib.suppress(ValueError, TypeError):
+            self.usage = Usage(**json.loads(worker.trailer))
+
+
+class Spawner:
+    """Runs shell commands under limits and measures their resource usage.
+
+    Commands are started by a small warm process (``utils/repl/spawn.py``), which
+    applies rlimits and reaps them with ``wait4``. Starting them from the userbot
+    itself would make peak RSS of every command at least the RSS of the userbot,
+    because a child inherits peak RSS of the process it was forked from.
+    """
+
+    def __init__(self, size: int = 2):
+        self.executable = (
+            f"{shlex.quote(sys.executable)} -S -E "
+            f"{shlex.quote(str(Path(__file__).parent / 'repl' / 'spawn.py'))}"
+        )
+        self.pool = ShellPool(size=size, worker_class=ReplWorker)
+
+    def stream(
+        self,
+        command: str,
+        limits: Limits,
+        executable: Optional[str] = None,
+        timeout: Optional[Union[int, float]] = None,
+    ) -> LimitedStream:
+        return LimitedStream(self, command, limits, executable, timeout)
+
+    async def close(self) -> None:
+        await self.pool.close()
+
+
+spawner = Spawner()
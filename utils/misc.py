@@ -2,8 +2,12 @@ import datetime
 import pathlib
 
 import environs
+from apscheduler.executors.asyncio import AsyncIOExecutor
+from apscheduler.executors.pool import ProcessPoolExecutor, ThreadPoolExecutor
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
+from utils.db import db
+from utils.scheduling import DatabaseJobStore, JobStats
 from utils.scripts import ModuleHelp
 
 script_path = pathlib.Path(__file__).parent.parent
@@ -11,7 +15,21 @@ script_path = pathlib.Path(__file__).parent.parent
 modules_help = ModuleHelp()
 scheduler_jobs = []
 
-scheduler = AsyncIOScheduler()
+job_store = DatabaseJobStore(db)
+job_stats = JobStats()
+
+# Coroutine jobs run on the event loop, use "thread" or "process" executor for blocking
+# or CPU-heavy ones (process jobs can't receive the client)
+scheduler = AsyncIOScheduler(
+    jobstores={"default": job_store},
+    executors={
+        "default": AsyncIOExecutor(),
+        "thread": ThreadPoolExecutor(db.get("core.scheduler", "threads", 4)),
+        "process": ProcessPoolExecutor(db.get("core.scheduler", "processes", 2)),
+    },
+    job_defaults={"coalesce": True, "misfire_grace_time": 60, "max_instances": 1},
+)
+scheduler.add_listener(job_stats, JobStats.EVENTS)
 uptime = datetime.datetime.now()
 
 env = environs.Env()
@@ -0,0 +1,150 @@
+import asyncio
+import contextlib
+import hashlib
+import logging
+import os
+import re
+import time
+from pathlib import Path
+from typing import Optional
+
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+KEY_RE = re.compile(r"^[0-9a-f]{20}$")
+
+
+class PasteServer:
+    """Embedded paste service for large outputs.
+
+    Pastes are stored on disk under the SHA-256 of their content, so the same output is
+    stored only once. When total size of the storage exceeds ``max_size`` bytes, least
+    recently used pastes are removed. Pastes older than ``max_age`` seconds are removed too.
+    """
+
+    def __init__(
+        self,
+        path: str = ".pastes",
+        base_url: Optional[str] = None,
+        max_size: int = 100 * 2**20,
+        max_age: int = 7 * 24 * 3600,
+    ):
+        self.path = Path(path)
+        self.base_url = base_url
+        self.max_size = max_size
+        self.max_age = max_age
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def running(self) -> bool:
+        return self._runner is not None
+
+    def _file(self, key: str) -> Path:
+        return self.path / key
+
+    def _store(self, data: bytes) -> str:
+        if len(data) > self.max_size:
+            raise ValueError(f"Paste is larger than {self.max_size} bytes")
+
+        key = hashlib.sha256(data).hexdigest()[:20]
+        file = self._file(key)
+
+        if file.exists():
+            # Deduplicated, just mark as recently used
+            os.utime(file)
+            return key
+
+        tmp_file = file.with_suffix(".tmp")
+        tmp_file.write_bytes(data)
+        tmp_file.replace(file)
+
+        self._evict(keep=file)
+
+        return key
+
+    def _evict(self, keep: Optional[Path] = None) -> None:
+        """Removes expired pastes and least recently used ones above ``max_size``,
+        except ``keep``, the paste which was just stored
+        """
+        now = time.time()
+        files = []
+        total = 0
+
+        for file in self.path.iterdir():
+            if not KEY_RE.match(file.name):
+                continue
+
+            stat = file.stat()
+
+            if now - stat.st_mtime > self.max_age:
+                file.unlink(missing_ok=True)
+                continue
+
+            total += stat.st_size
+            if file != keep:
+                files.append((stat.st_mtime, stat.st_size, file))
+
+        for _, size, file in sorted(files):
+            if total <= self.max_size:
+                break
+
+            file.unlink(missing_ok=True)
+            total -= size
+
+    async def paste(self, text: str) -> str:
+        """Stores text and returns link to it.
+
+        Raises :obj:`ValueError` if the text is larger than ``max_size``.
+        """
+        key = await asyncio.to_thread(self._store, text.encode())
+
+        return f"{self.base_url}/{key}"
+
+    async def _handle_paste(self, request: web.Request) -> web.StreamResponse:
+        key = request.match_info["key"]
+
+        if not KEY_RE.match(key) or not self._file(key).is_file():
+            raise web.HTTPNotFound()
+
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(self._file(key))
+
+        return web.FileResponse(
+            self._file(key), headers={"Content-Type": "text/plain; charset=utf-8"}
+        )
+
+    async def start(self, host: str = "0.0.0.0", port: int = 8080) -> None:
+        """Starts the server, unless ``base_url`` isn't set: the address it listens on
+        isn't reachable from outside, so links to it would be useless
+        """
+        if self.running:
+            return
+
+        if not self.base_url:
+            log.warning(
+                "Paste server isn't started, PASTE_SERVER_URL isn't set, pasting to yaso.su"
+            )
+            return
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.base_url = self.base_url.rstrip("/")
+
+        app = web.Application()
+        app.router.add_get("/{key}", self._handle_paste)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+        log.info("Paste server started on %s:%s (%s)", host, port, self.base_url)
+
+    async def stop(self) -> None:
+        if not self.running:
+            return
+
+        await self._runner.cleanup()
+        self._runner = None
+
+
+paste_server = PasteServer()
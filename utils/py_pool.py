@@ -0,0 +1,244 @@
+import asyncio
+import contextlib
+import inspect
+import logging
+import pickle
+import signal
+import sys
+from pathlib import Path
+from typing import Optional
+
+from pyrogram import Client
+from pyrogram.types import Message
+
+from utils.py_worker import HEADER, pack_error, pack_frame
+
+log = logging.getLogger(__name__)
+
+
+class SnippetError(Exception):
+    """Exception raised by a snippet in the worker process"""
+
+    def __init__(self, error: BaseException, traceback: str, output: str = ""):
+        super().__init__(str(error))
+        self.error = error
+        self.name = error.__class__.__name__
+        self.traceback = traceback
+        self.output = output
+
+
+class SnippetTimeout(asyncio.TimeoutError):
+    """Snippet didn't finish in time, ``output`` is what it printed before that"""
+
+    def __init__(self, output: str = ""):
+        super().__init__("Snippet timed out")
+        self.output = output
+
+
+class WorkerDied(Exception):
+    """Worker process exited while running a snippet (e.g. killed by a limit)"""
+
+
+class PythonWorker:
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+        self.uses = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.process.returncode is None
+
+    def send(self, obj) -> None:
+        self.process.stdin.write(pack_frame(obj))
+
+    async def read(self):
+        header = await self.process.stdout.readexactly(HEADER.size)
+        (size,) = HEADER.unpack(header)
+
+        return pickle.loads(await self.process.stdout.readexactly(size))
+
+    async def kill(self) -> None:
+        if self.alive:
+            with contextlib.suppress(ProcessLookupError):
+                self.process.kill()
+
+        await self.process.wait()
+
+
+class PythonPool:
+    """Pool of warm worker processes for running Python snippets.
+
+    Workers have pyrogram already imported, so a snippet starts in milliseconds, and
+    a CPU-bound snippet can't freeze the event loop of the userbot. Method calls on
+    ``client`` (and bound methods of ``message``) in the worker are forwarded to the
+    real client in this process. Each worker runs one snippet at a time and is killed
+    on timeout. Address space of workers is limited to ``memory_limit`` bytes, and each
+    snippet gets ``cpu_limit`` seconds of CPU time.
+    """
+
+    def __init__(self, size: int = 2, memory_limit: int = 1024 * 2**20, max_uses: int = 100):
+        self.size = size
+        self.memory_limit = memory_limit
+        self.max_uses = max_uses
+
+        self._idle: Optional[asyncio.Queue] = None
+        self._workers = set()
+        self._jobs = 0
+
+    @property
+    def running(self) -> bool:
+        return self._idle is not None
+
+    async def _spawn(self) -> PythonWorker:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "utils.py_worker",
+            str(self.memory_limit),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            cwd=Path(__file__).parent.parent,
+        )
+
+        worker = PythonWorker(process)
+        self._workers.add(worker)
+
+        return worker
+
+    async def _replace(self, worker: PythonWorker) -> None:
+        self._workers.discard(worker)
+        await worker.kill()
+
+        if self.running:
+            try:
+                self._idle.put_nowait(await self._spawn())
+            except Exception:
+                log.exception("Failed to start Python worker")
+
+    async def start(self, size: Optional[int] = None) -> None:
+        if self.running:
+            return
+
+        if size:
+            self.size = size
+
+        self._idle = asyncio.Queue()
+        for worker in await asyncio.gather(*(self._spawn() for _ in range(self.size))):
+            self._idle.put_nowait(worker)
+
+    async def close(self) -> None:
+        if not self.running:
+            return
+
+        self._idle = None
+
+        for worker in list(self._workers):
+            worker.process.stdin.close()
+            await worker.kill()
+
+        self._workers.clear()
+
+    async def _handle_call(self, worker: PythonWorker, client: Client, frame) -> None:
+        _, call_id, method, args, kwargs, iterate = frame
+
+        try:
+            result = getattr(client, method)(*args, **kwargs)
+
+            if iterate:
+                result = [item async for item in result]
+            elif inspect.isawaitable(result):
+                result = await result
+
+            reply = ("reply", call_id, True, result)
+            pack_frame(reply)
+        except Exception as e:
+            reply = ("reply", call_id, False, pack_error(e))
+
+        if worker.alive:
+            worker.send(reply)
+
+    async def _run(self, worker, client, message, code, timeout, cpu_limit) -> str:
+        try:
+            pickle.dumps(message)
+        except Exception:
+            log.warning("Message can't be sent to Python worker, running without it")
+            message = None
+
+        self._jobs += 1
+        worker.send(("exec", self._jobs, code, message, client.me, timeout, cpu_limit))
+
+        calls = set()
+
+        try:
+            while True:
+                frame = await worker.read()
+
+                if frame[0] == "call":
+                    task = asyncio.create_task(self._handle_call(worker, client, frame))
+                    calls.add(task)
+                    task.add_done_callback(calls.discard)
+                elif frame[0] == "done":
+                    _, _, ok, output, error, traceback = frame
+
+                    if not ok:
+                        raise SnippetError(error, traceback, output)
+
+                    return output
+        finally:
+            for task in calls:
+                task.cancel()
+
+    async def execute(
+        self,
+        code: str,
+        client: Client,
+        message: Optional[Message] = None,
+        timeout: Optional[float] = None,
+        cpu_limit: Optional[float] = None,
+    ) -> str:
+        """Runs snippet in a worker and returns its stdout.
+
+        Raises :obj:`SnippetError` if the snippet raised an exception,
+        :obj:`SnippetTimeout` (an :obj:`asyncio.TimeoutError`) on timeout and
+        :obj:`WorkerDied` if the worker was killed (e.g. by CPU or memory limit).
+        Both snippet errors carry the output printed before them.
+        """
+        await self.start()
+
+        worker = await self._idle.get()
+        keep = False
+
+        try:
+            # Give the worker a moment to report its own timeout before killing it
+            result = await asyncio.wait_for(
+                self._run(worker, client, message, code, timeout, cpu_limit),
+                timeout + 1 if timeout else None,
+            )
+            keep = True
+
+            return result
+        except SnippetError as e:
+            keep = True
+
+            # Timeout reported by the worker itself
+            if isinstance(e.error, (TimeoutError, asyncio.TimeoutError)):
+                raise SnippetTimeout(e.output) from e
+
+            raise
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            returncode = await worker.process.wait()
+
+            if returncode == -signal.SIGXCPU:
+                raise WorkerDied("CPU time limit exceeded") from e
+
+            raise WorkerDied(f"Worker exited with code {returncode}") from e
+        finally:
+            worker.uses += 1
+
+            if keep and worker.alive and worker.uses < self.max_uses and self.running:
+                self._idle.put_nowait(worker)
+            else:
+                asyncio.create_task(self._replace(worker))
+
+
+python_pool = PythonPool()
@@ -0,0 +1,222 @@
+"""Worker process for Python snippets, started by :class:`utils.py_pool.PythonPool`.
+
+Requests and responses are pickled frames prefixed with 4-byte length, sent over the
+original stdin/stdout of the process. Snippet output is captured separately, and the
+real file descriptors 0 and 1 are redirected, so nothing can break the protocol.
+"""
+
+import asyncio
+import builtins
+import io
+import os
+import pickle
+import struct
+import sys
+import threading
+import traceback
+from contextlib import redirect_stdout
+
+import pyrogram
+from pyrogram import enums, raw, types
+
+from utils.snippets import code_cache
+
+try:
+    import resource
+except ImportError:
+    # Limits aren't supported on Windows
+    resource = None
+
+HEADER = struct.Struct(">I")
+
+
+def pack_frame(obj) -> bytes:
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(data)) + data
+
+
+def read_frame(file):
+    header = file.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise EOFError
+
+    (size,) = HEADER.unpack(header)
+    data = file.read(size)
+    if len(data) < size:
+        raise EOFError
+
+    return pickle.loads(data)
+
+
+def pack_error(e: BaseException):
+    """Returns picklable version of the exception"""
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        return RuntimeError(f"{e.__class__.__name__}: {e}")
+
+
+class ProxyCall:
+    """Result of a proxied client method, can be awaited or iterated with ``async for``"""
+
+    def __init__(self, worker: "Worker", method: str, args: tuple, kwargs: dict):
+        self.worker = worker
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+
+    def __await__(self):
+        return self.worker.call(self.method, self.args, self.kwargs).__await__()
+
+    async def __aiter__(self):
+        # Generators are collected in the main process and sent back as a list
+        for item in await self.worker.call(self.method, self.args, self.kwargs, True):
+            yield item
+
+
+class ClientProxy:
+    """Stands in for the client in worker, forwards method calls to the userbot process"""
+
+    def __init__(self, worker: "Worker", me: types.User):
+        self._worker = worker
+        self.me = me
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            return ProxyCall(self._worker, name, args, kwargs)
+
+        return method
+
+
+class Worker:
+    def __init__(self, stdin, stdout):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.loop = asyncio.new_event_loop()
+        self.globals = {
+            "__builtins__": builtins,
+            "__name__": "__snippet__",
+            "asyncio": asyncio,
+            "pyrogram": pyrogram,
+            "raw": raw,
+            "types": types,
+            "enums": enums,
+        }
+
+        self._calls = {}
+        self._next_call = 0
+        self._lock = threading.Lock()
+
+    def send(self, obj) -> None:
+        frame = pack_frame(obj)
+
+        with self._lock:
+            self.stdout.write(frame)
+            self.stdout.flush()
+
+    async def call(self, method: str, args: tuple, kwargs: dict, iterate: bool = False):
+        self._next_call += 1
+        call_id = self._next_call
+
+        future = self.loop.create_future()
+        self._calls[call_id] = future
+
+        try:
+            self.send(("call", call_id, method, args, kwargs, iterate))
+        except Exception:
+            # Arguments can't be pickled
+            del self._calls[call_id]
+            raise
+
+        return await future
+
+    def _read(self) -> None:
+        while True:
+            try:
+                frame = read_frame(self.stdin)
+            except EOFError:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                return
+
+            self.loop.call_soon_threadsafe(self._dispatch, frame)
+
+    def _dispatch(self, frame) -> None:
+        if frame[0] == "exec":
+            self.loop.create_task(self._exec(*frame[1:]))
+        elif frame[0] == "reply":
+            _, call_id, ok, value = frame
+            future = self._calls.pop(call_id)
+
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    @staticmethod
+    def _limit_cpu(seconds: float) -> None:
+        # RLIMIT_CPU counts the whole process lifetime, so move the limit forward
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        used = usage.ru_utime + usage.ru_stime
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+
+        resource.setrlimit(resource.RLIMIT_CPU, (int(used + seconds) + 1, hard))
+
+    async def _exec(self, job_id: int, code: str, message, me, timeout, cpu_limit) -> None:
+        client = ClientProxy(self, me)
+        if message is not None:
+            message.bind(client)
+
+        if cpu_limit and resource:
+            self._limit_cpu(cpu_limit)
+
+        output = io.StringIO()
+
+        try:
+            local = {}
+            exec(code_cache.get(code), self.globals, local)
+
+            with redirect_stdout(output):
+                await asyncio.wait_for(local["__todo"](client, message), timeout=timeout)
+        except BaseException as e:
+            self.send(
+                (
+                    "done",
+                    job_id,
+                    False,
+                    output.getvalue(),
+                    pack_error(e),
+                    traceback.format_exc(),
+                )
+            )
+        else:
+            self.send(("done", job_id, True, output.getvalue(), None, None))
+
+    def run(self) -> None:
+        threading.Thread(target=self._read, daemon=True).start()
+        self.loop.run_forever()
+
+
+def main() -> None:
+    memory_limit = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    if memory_limit and resource:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    stdin = os.fdopen(os.dup(0), "rb")
+    stdout = os.fdopen(os.dup(1), "wb")
+
+    # Keep snippets and their subprocesses away from the protocol pipes
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(2, 1)
+    sys.stdin = open(os.devnull)
+    sys.stdout = sys.stderr
+
+    Worker(stdin, stdout).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import asyncio
+import collections
+import logging
+import time
+from typing import Dict, List, Optional
+
+from utils.db import Database
+
+log = logging.getLogger(__name__)
+
+
+def method_name(query) -> str:
+    return query.QUALNAME.split(".", 1)[-1]
+
+
+def chat_id(query) -> Optional[int]:
+    for attr in ("peer", "channel"):
+        peer = getattr(query, attr, None)
+
+        for peer_attr in ("user_id", "chat_id", "channel_id"):
+            value = getattr(peer, peer_attr, None)
+            if value is not None:
+                return value
+
+    return None
+
+
+class TokenBucket:
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = 0.0
+        self.blocked_until = 0.0
+        self.saved_at = 0.0
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    @property
+    def capacity(self) -> float:
+        return max(1.0, self.rate)
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def block(self, seconds: float) -> None:
+        now = time.monotonic()
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0.0
+        self._updated = now
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+
+                if self.blocked_until > now:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+
+                self._refill(now)
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Adaptive limiter for outgoing API calls.
+
+    Calls are not limited until Telegram answers with FloodWait. After that, a token
+    bucket is created for the method (or for the method in the chat, if the request
+    targets a peer) with half of the observed call rate, and the key is blocked for the
+    required time. Every successful call raises the rate by ``increase`` calls/s, and once
+    it gets back to ``max_rate`` the bucket is removed (AIMD). Learned rates are stored in
+    the database, so they survive restarts.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        min_rate: float = 0.05,
+        max_rate: float = 30,
+        increase: float = 0.05,
+        decrease: float = 0.5,
+        save_interval: float = 60,
+    ):
+        self.db = db
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.save_interval = save_interval
+
+        self.buckets: Dict[str, TokenBucket] = {}
+        # key -> (last call time, average interval between calls)
+        self._calls = collections.OrderedDict()
+
+        for key, rate in self.db.get_collection("core.ratelimit").items():
+            self.buckets[key] = TokenBucket(float(rate))
+
+    @staticmethod
+    def keys(query) -> List[str]:
+        method = method_name(query)
+        chat = chat_id(query)
+
+        return [method] if chat is None else [method, f"{method}:{chat}"]
+
+    async def acquire(self, query) -> None:
+        for key in self.keys(query):
+            bucket = self.buckets.get(key)
+
+            if bucket:
+                await bucket.acquire()
+
+    def _observe(self, key: str, now: float) -> None:
+        last, interval = self._calls.pop(key, (None, None))
+
+        if last is not None:
+            interval = now - last if interval is None else 0.8 * interval + 0.2 * (now - last)
+
+        self._calls[key] = (now, interval)
+
+        while len(self._calls) > 4096:
+            self._calls.popitem(last=False)
+
+    def _save(self, key: str, bucket: TokenBucket, now: float) -> None:
+        self.db.set("core.ratelimit", key, round(bucket.rate, 4))
+        bucket.saved_at = now
+
+    def on_success(self, query) -> None:
+        now = time.monotonic()
+
+        for key in self.keys(query):
+            self._observe(key, now)
+
+            bucket = self.buckets.get(key)
+            if not bucket:
+                continue
+
+            bucket.rate += self.increase
+
+            if bucket.rate >= self.max_rate:
+                del self.buckets[key]
+                self.db.remove("core.ratelimit", key)
+                log.info("Rate limit for %s recovered", key)
+            elif now - bucket.saved_at > self.save_interval:
+                self._save(key, bucket, now)
+
+    def on_flood(self, query, seconds: float) -> None:
+        now = time.monotonic()
+        keys = self.keys(query)
+        # Peer-targeted floods are usually per chat, don't slow down the whole method
+        key = keys[-1]
+
+        bucket = self.buckets.get(key)
+
+        if bucket is None:
+            _, interval = self._calls.get(key, (None, None))
+            observed = 1 / interval if interval else self.max_rate
+            bucket = self.buckets[key] = TokenBucket(observed)
+
+        bucket.rate = max(min(bucket.rate, self.max_rate) * self.decrease, self.min_rate)
+        bucket.block(seconds)
+        self._save(key, bucket, now)
+
+        log.warning(
+            "FloodWait %ss for %s, limiting to %.2f calls/s", seconds, key, bucket.rate
+        )
+
+    def reset(self) -> None:
+        for key in self.buckets:
+            self.db.remove("core.ratelimit", key)
+
+        self.buckets.clear()
@@ -0,0 +1,37 @@
+-- Warm Lua interpreter for the code runner, see utils/runners.py.
+--
+-- Reads frames of "token\nlength\ncode" from stdin, runs the code and prints the
+-- token followed by the exit status to stdout and the token alone to stderr.
+
+local load = loadstring or load
+local protocol, stdout, stderr = io.stdin, io.stdout, io.stderr
+
+-- Snippets must not read the protocol pipe
+io.input("/dev/null")
+
+while true do
+  local token = protocol:read("*l")
+  if not token or token == "" then break end
+
+  local length = tonumber(protocol:read("*l"))
+  local code = length > 0 and protocol:read(length) or ""
+  local status = 0
+
+  local chunk, err = load(code, "=snippet")
+  if chunk then
+    local ok, e = pcall(chunk)
+    if not ok then
+      stderr:write(tostring(e), "\n")
+      status = 1
+    end
+  else
+    stderr:write(err, "\n")
+    status = 1
+  end
+
+  io.output(stdout)
+  stdout:write(token, status, "\n")
+  stdout:flush()
+  stderr:write(token)
+  stderr:flush()
+end
@@ -0,0 +1,74 @@
+// Warm Node.js interpreter for the code runner, see utils/runners.py.
+//
+// Reads frames of "token\nlength\ncode" from stdin, runs the code as a body of
+// an async function, waits for its timers and prints the token followed by the
+// exit status to stdout and the token alone to stderr.
+
+const { Readable } = require("stream");
+
+const AsyncFunction = (async () => {}).constructor;
+
+// Frames are read from the real stdin, snippets get an empty one (like /dev/null),
+// so they can't consume frames of the next snippets
+const protocol = process.stdin;
+Object.defineProperty(process, "stdin", {
+  configurable: true,
+  enumerable: true,
+  value: Readable.from([]),
+});
+
+let buffer = Buffer.alloc(0);
+let queue = Promise.resolve();
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+function pendingTimers() {
+  if (!process.getActiveResourcesInfo) return 0;
+  return process.getActiveResourcesInfo().filter((name) => name === "Timeout").length;
+}
+
+async function run(token, code) {
+  let status = 0;
+  process.exitCode = undefined;
+
+  try {
+    const snippet = new AsyncFunction("require", "module", "exports", code);
+    await snippet(require, { exports: {} }, {});
+
+    // Like a standalone script, finish when scheduled callbacks are done
+    while (pendingTimers() > 0) await sleep(5);
+  } catch (e) {
+    process.stderr.write((e && e.stack ? e.stack : String(e)) + "\n");
+    status = 1;
+  }
+
+  if (status === 0 && process.exitCode) status = process.exitCode;
+
+  process.stdout.write(token + status + "\n");
+  process.stderr.write(token);
+}
+
+function parse() {
+  for (;;) {
+    const first = buffer.indexOf(10);
+    if (first === -1) return;
+    const second = buffer.indexOf(10, first + 1);
+    if (second === -1) return;
+
+    const length = parseInt(buffer.subarray(first + 1, second).toString(), 10);
+    const end = second + 1 + length;
+    if (buffer.length < end) return;
+
+    const token = buffer.subarray(0, first).toString();
+    const code = buffer.subarray(second + 1, end).toString();
+    buffer = buffer.subarray(end);
+
+    queue = queue.then(() => run(token, code));
+  }
+}
+
+protocol.on("data", (chunk) => {
+  buffer = Buffer.concat([buffer, chunk]);
+  parse();
+});
+protocol.on("end", () => queue.then(() => process.exit(0)));
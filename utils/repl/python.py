@@ -0,0 +1,50 @@
+"""Warm Python interpreter for the code runner, see utils/runners.py.
+
+Reads frames of ``token\\nlength\\ncode`` from stdin, runs the code in a fresh
+namespace and prints the token followed by the exit status to stdout and the
+token alone to stderr. Imported modules stay loaded between snippets.
+"""
+
+import os
+import sys
+import traceback
+
+
+def main() -> None:
+    protocol = os.fdopen(os.dup(0), "rb")
+
+    # Snippets must not read the protocol pipe
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    sys.stdin = open(os.devnull)
+
+    while True:
+        token = protocol.readline().decode().strip()
+        if not token:
+            break
+
+        length = int(protocol.readline())
+        code = protocol.read(length).decode(errors="replace")
+        status = 0
+
+        try:
+            exec(compile(code, "<snippet>", "exec"), {"__name__": "__main__"})
+        except SystemExit as e:
+            if isinstance(e.code, int) or e.code is None:
+                status = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                status = 1
+        except BaseException as e:
+            # Skip the frame of the driver itself
+            traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+            status = 1
+
+        sys.stdout.write(f"{token}{status}\n")
+        sys.stdout.flush()
+        sys.stderr.write(token)
+        sys.stderr.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Warm process spawner for limited shell commands, see utils/limits.py.
+
+Reads frames of ``token\\nlength\\nrequest`` from stdin, where request is JSON with
+``command``, ``executable`` and ``rlimits``. The command inherits stdout and stderr
+of the spawner and is reaped with ``wait4``, then the token is printed to stdout
+followed by the exit code and JSON with resource usage, and to stderr alone.
+
+Only the standard library is used and the spawner is small, because a child
+inherits peak RSS of the process it was forked from.
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+
+
+def set_rlimits(rlimits: dict) -> None:
+    for name, value in rlimits.items():
+        limit = getattr(resource, name)
+        _, hard = resource.getrlimit(limit)
+
+        if value is None:
+            soft = hard
+        elif hard == resource.RLIM_INFINITY:
+            soft = value
+        else:
+            soft = min(value, hard)
+
+        resource.setrlimit(limit, (soft, hard))
+
+
+def main() -> None:
+    protocol = os.fdopen(os.dup(0), "rb")
+
+    while True:
+        token = protocol.readline().decode().strip()
+        if not token:
+            break
+
+        length = int(protocol.readline())
+        request = json.loads(protocol.read(length))
+
+        try:
+            process = subprocess.Popen(
+                request["command"],
+                shell=True,
+                executable=request.get("executable"),
+                stdin=subprocess.DEVNULL,
+                preexec_fn=lambda: set_rlimits(request.get("rlimits", {})),
+            )
+        except OSError as e:
+            sys.stderr.write(f"{e}\n")
+            returncode, usage = 127, {}
+        else:
+            _, status, rusage = os.wait4(process.pid, 0)
+            # Already reaped, don't let Popen wait for it again
+            process.returncode = returncode = os.waitstatus_to_exitcode(status)
+            usage = {
+                "user": rusage.ru_utime,
+                "system": rusage.ru_stime,
+                # Linux reports kilobytes, macOS bytes
+                "max_rss": rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+                "read_bytes": rusage.ru_inblock * 512,
+                "write_bytes": rusage.ru_oublock * 512,
+            }
+
+        sys.stdout.write(f"{token}{returncode} {json.dumps(usage)}\n")
+        sys.stdout.flush()
+        sys.stderr.write(token)
+        sys.stderr.flush()
+
+
+if __name__ == "__main__":
+    main()
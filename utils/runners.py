@@ -0,0 +1,296 @@
+import contextlib
+import shlex
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List, Optional, Union
+
+import psutil
+
+from utils.compile_cache import BuildResult, compile_cache
+from utils.limits import Limits, Usage, limit_error, reset_peak_rss
+from utils.scripts import ShellStream
+from utils.shell_pool import ReplWorker, ShellPool
+
+ROOT = Path(__file__).parent.parent
+DRIVERS = Path(__file__).parent / "repl"
+
+
+class RunResult:
+    def __init__(
+        self,
+        returncode: int,
+        stdout: str,
+        stderr: str,
+        exec_time: float = 0.0,
+        build: Optional[BuildResult] = None,
+        usage: Optional[Usage] = None,
+        limit_error: Optional[str] = None,
+    ):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.exec_time = exec_time
+        self.build = build
+        self.usage = usage
+        self.limit_error = limit_error
+
+    @property
+    def compiled(self) -> bool:
+        return self.build is None or self.build.path is not None
+
+
+class Runner:
+    """Declaration of a language for the code runner.
+
+    Compiled languages set ``compile`` (see :meth:`CompileCache.build`) and
+    ``version``, binaries are cached by content. Interpreted languages set ``run``,
+    a command with ``{source}`` placeholder, and optionally ``repl``, a command line
+    of an interpreter running a driver from ``utils/repl``. Warm interpreters are kept
+    in a pool, so only the first snippet pays for the interpreter startup.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        language: str,
+        pre_language: str,
+        emoji_id: int,
+        suffix: str,
+        compile: Optional[str] = None,
+        version: Optional[str] = None,
+        run: Optional[str] = None,
+        repl: Optional[str] = None,
+    ):
+        self.name = name
+        self.language = language
+        self.pre_language = pre_language
+        self.emoji_id = emoji_id
+        self.suffix = suffix
+        self.compile = compile
+        self.version = version
+        self.run = run
+        self.repl = repl
+
+        self.pool = ShellPool(size=1, worker_class=ReplWorker) if repl else None
+
+    @property
+    def commands(self) -> List[str]:
+        return [self.name, f"r{self.name}"]
+
+    @property
+    def repl_available(self) -> bool:
+        return self.repl is not None and shutil.which(shlex.split(self.repl)[0]) is not None
+
+    async def execute(
+        self,
+        code: str,
+        flags: Optional[List[str]] = None,
+        timeout: Optional[Union[int, float]] = None,
+        executable: Optional[str] = None,
+        repl: bool = True,
+        limits: Optional[Limits] = None,
+    ) -> RunResult:
+        """Compiles (if needed) and runs the code.
+
+        Compilation isn't limited, ``limits`` apply to the run only. In a warm
+        interpreter they apply to the whole interpreter process, so the memory
+        limit must leave room for the interpreter itself.
+        Raises :obj:`asyncio.TimeoutError` on timeout.
+        """
+        build = None
+
+        if self.compile:
+            build = await compile_cache.build(
+                code,
+                self.suffix,
+                self.compile,
+                self.version,
+                flags,
+                executable=executable,
+                timeout=timeout,
+            )
+
+            if build.path is None:
+                return RunResult(build.returncode, "", build.stderr, build=build)
+
+        started = perf_counter()
+
+        if build is not None:
+            result = await self._run_shell(shlex.quote(build.path), executable, timeout, limits)
+        elif repl and self.repl_available:
+            result = await self._run_repl(code, timeout, limits)
+        else:
+            with tempfile.TemporaryDirectory() as tempdir:
+                source = Path(tempdir) / f"main{self.suffix}"
+                source.write_text(code)
+
+                result = await self._run_shell(
+                    self.run.format(source=shlex.quote(str(source))),
+                    executable,
+                    timeout,
+                    limits,
+                )
+
+        result.exec_time = perf_counter() - started
+        result.build = build
+
+        return result
+
+    @staticmethod
+    async def _run_shell(
+        command: str,
+        executable: Optional[str],
+        timeout: Optional[Union[int, float]],
+        limits: Optional[Limits],
+    ) -> RunResult:
+        stream = ShellStream(command, executable, timeout, limits=limits)
+        output = {"stdout": [], "stderr": []}
+
+        async for name, text in stream:
+            output[name].append(text)
+
+        return RunResult(
+            stream.returncode,
+            "".join(output["stdout"]),
+            "".join(output["stderr"]),
+            usage=stream.usage,
+            limit_error=stream.limit_error,
+        )
+
+    async def _run_repl(
+        self, code: str, timeout: Optional[Union[int, float]], limits: Optional[Limits]
+    ) -> RunResult:
+        worker = await self.pool.acquire(self.repl)
+        pid = worker.process.pid
+        output = {"stdout": [], "stderr": []}
+        output_size = 0
+        error = None
+
+        before = Usage.of_process(pid)
+        reset_peak_rss(pid)
+
+        times = psutil.Process(pid).cpu_times()
+        # Also lifts limits of the previous run if there are none now
+        (limits or Limits()).apply(pid, cpu_used=times.user + times.system)
+
+        try:
+            async with contextlib.aclosing(worker.stream(code, timeout)) as stream:
+                async for name, text in stream:
+                    output[name].append(text)
+                    output_size += len(text.encode())
+
+                    if limits and limits.output and output_size > limits.output:
+                        error = "Output limit exceeded"
+                        await worker.kill()
+                        break
+
+            try:
+                usage = Usage.of_process(pid) - before
+            except psutil.Error:
+                # Interpreter was killed, e.g. by CPU limit
+                usage = None
+        finally:
+            await self.pool.release(worker)
+
+        returncode = worker.returncode if worker.alive else worker.process.returncode
+
+        return RunResult(
+            returncode,
+            "".join(output["stdout"]),
+            "".join(output["stderr"]),
+            usage=usage,
+            limit_error=error or limit_error(returncode),
+        )
+
+    async def close(self) -> None:
+        if self.pool is not None:
+            await self.pool.close()
+
+
+runners: Dict[str, Runner] = {}
+
+
+def register(runner: Runner) -> Runner:
+    runners[runner.name] = runner
+    return runner
+
+
+async def close_runners() -> None:
+    for runner in runners.values():
+        await runner.close()
+
+
+def _driver(interpreter: str, name: str) -> str:
+    return f"{interpreter} {shlex.quote(str(DRIVERS / name))}"
+
+
+register(
+    Runner(
+        "gcc",
+        "C",
+        "c",
+        5257955893554721164,
+        ".c",
+        compile="gcc {flags} -o {output} {source}",
+        version="gcc --version",
+    )
+)
+register(
+    Runner(
+        "gpp",
+        "C++",
+        "cpp",
+        5258035603852767295,
+        ".cpp",
+        compile="g++ {flags} -o {output} {source}",
+        version="g++ --version",
+    )
+)
+register(
+    Runner(
+        "go",
+        "Go",
+        "go",
+        5258117049317603088,
+        ".go",
+        compile=f"GOCACHE={shlex.quote(str(ROOT / '.cache' / 'go-build'))} "
+        "go build {flags} -o {output} {source}",
+        version="go version",
+    )
+)
+register(
+    Runner(
+        "lua",
+        "Lua",
+        "lua",
+        5258338381867266341,
+        ".lua",
+        run="lua {source}",
+        repl=_driver("lua", "lua.lua"),
+    )
+)
+register(
+    Runner(
+        "node",
+        "Node.js",
+        "javascript",
+        5258042115023188415,
+        ".js",
+        run="node {source}",
+        repl=_driver("node", "node.js"),
+    )
+)
+register(
+    Runner(
+        "python",
+        "Python",
+        "python",
+        5260480440971570446,
+        ".py",
+        run=f"{shlex.quote(sys.executable)} {{source}}",
+        repl=_driver(shlex.quote(sys.executable), "python.py"),
+    )
+)
@@ -0,0 +1,154 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+import psutil
+
+log = logging.getLogger(__name__)
+
+METRICS = ("rss", "cpu", "fds", "children", "lag")
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+
+def sparkline(values: List[float], width: int = 30) -> str:
+    if not values:
+        return ""
+
+    # Downsample to the width by averaging neighbouring values
+    if len(values) > width:
+        step = len(values) / width
+        values = [
+            sum(chunk) / len(chunk)
+            for chunk in (
+                values[int(i * step) : max(int((i + 1) * step), int(i * step) + 1)]
+                for i in range(width)
+            )
+        ]
+
+    low, high = min(values), max(values)
+    scale = (len(SPARK_CHARS) - 1) / (high - low) if high > low else 0
+
+    return "".join(SPARK_CHARS[int((value - low) * scale)] for value in values)
+
+
+class ResourceSampler:
+    """Periodically samples resource usage of the userbot process tree.
+
+    Every ``period`` seconds it records RSS (MB), CPU usage (%), open file descriptors,
+    number of child processes and event loop lag (ms) into fixed-size ring buffers,
+    so readers get recent values and history without touching psutil.
+    """
+
+    def __init__(self, period: float = 5, capacity: int = 720):
+        self.period = period
+        self.capacity = capacity
+        self._times = array("d", bytes(8 * capacity))
+        self._series = {name: array("d", bytes(8 * capacity)) for name in METRICS}
+        self._index = 0
+        self._count = 0
+        self._task: Optional[asyncio.Task] = None
+        self._process = psutil.Process(os.getpid())
+        # Cached children, so cpu_percent() measures since the previous sample
+        self._children: Dict[int, psutil.Process] = {}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, period: Optional[float] = None) -> None:
+        if period:
+            self.period = period
+
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self.running:
+            self._task.cancel()
+
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+    def _sample(self) -> Tuple[float, float, float, float]:
+        processes = [self._process]
+
+        children = {}
+        for child in self._process.children(recursive=True):
+            children[child.pid] = self._children.get(child.pid, child)
+        self._children = children
+        processes.extend(children.values())
+
+        rss = cpu = fds = 0.0
+        for process in processes:
+            try:
+                with process.oneshot():
+                    rss += process.memory_info().rss / 2.0**20
+                    cpu += process.cpu_percent()
+                    fds += (
+                        process.num_fds()
+                        if hasattr(process, "num_fds")
+                        else process.num_handles()
+                    )
+            except psutil.Error:
+                continue
+
+        return rss, cpu, fds, len(children)
+
+    def _record(self, values: Dict[str, float]) -> None:
+        self._times[self._index] = time.time()
+
+        for name, value in values.items():
+            self._series[name][self._index] = value
+
+        self._index = (self._index + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        # First cpu_percent() call only sets the baseline
+        await asyncio.to_thread(self._sample)
+
+        while True:
+            expected = loop.time() + self.period
+            await asyncio.sleep(self.period)
+            lag = max(loop.time() - expected, 0) * 1000
+
+            try:
+                rss, cpu, fds, children = await asyncio.to_thread(self._sample)
+            except Exception:
+                log.exception("Failed to sample resource usage")
+                continue
+
+            self._record(
+                {"rss": rss, "cpu": cpu, "fds": fds, "children": children, "lag": lag}
+            )
+
+    def latest(self) -> Optional[Dict[str, float]]:
+        if not self._count:
+            return None
+
+        index = (self._index - 1) % self.capacity
+
+        return {name: series[index] for name, series in self._series.items()}
+
+    def window(self, seconds: Optional[float] = None) -> Dict[str, List[float]]:
+        """Returns samples recorded during the last ``seconds`` in chronological order"""
+        since = time.time() - seconds if seconds else 0
+        indexes = [
+            i % self.capacity
+            for i in range(self._index - self._count, self._index)
+            if self._times[i % self.capacity] >= since
+        ]
+
+        result = {name: [series[i] for i in indexes] for name, series in self._series.items()}
+        result["time"] = [self._times[i] for i in indexes]
+
+        return result
+
+
+sampler = ResourceSampler()
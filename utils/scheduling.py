@@ -0,0 +1,185 @@
+import base64
+import io
+import logging
+import pickle
+import time
+from typing import Dict, Optional
+
+from apscheduler.events import (
+    EVENT_JOB_ERROR,
+    EVENT_JOB_EXECUTED,
+    EVENT_JOB_MAX_INSTANCES,
+    EVENT_JOB_MISSED,
+    EVENT_JOB_SUBMITTED,
+)
+from apscheduler.job import Job
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.util import datetime_to_utc_timestamp
+from pyrogram import Client
+
+from utils.db import Database
+
+log = logging.getLogger(__name__)
+
+
+class _JobPickler(pickle.Pickler):
+    def persistent_id(self, obj):
+        # Client can't be pickled, store a reference and put the running one back on load
+        if isinstance(obj, Client):
+            return "client"
+
+        return None
+
+
+class _JobUnpickler(pickle.Unpickler):
+    def __init__(self, file, client: Optional[Client]):
+        super().__init__(file)
+        self.client = client
+
+    def persistent_load(self, pid):
+        if pid == "client":
+            return self.client
+
+        raise pickle.UnpicklingError(f"Unsupported persistent object: {pid}")
+
+
+class DatabaseJobStore(MemoryJobStore):
+    """Job store which keeps jobs in memory and persists them to the database.
+
+    Jobs are pickled into the ``core.jobs`` collection on every change and
+    restored on start, so jobs added at runtime survive restarts. :obj:`Client`
+    instances in job arguments are stored as references to ``client``, which must
+    be set before the scheduler starts. Jobs that can't be pickled (e.g. lambdas)
+    still work, they just aren't persisted.
+    """
+
+    def __init__(self, db: Database, collection: str = "core.jobs"):
+        super().__init__()
+        self.db = db
+        self.collection = collection
+        self.client: Optional[Client] = None
+        self._unpersisted = set()
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+
+        for job_id, row in self.db.get_collection(self.collection).items():
+            try:
+                job = self._restore(row["state"])
+            except Exception:
+                log.exception("Unable to restore job %s, removing it", job_id)
+                self.db.remove(self.collection, job_id)
+                continue
+
+            super().add_job(job)
+
+    def _restore(self, state: str) -> Job:
+        job_state = _JobUnpickler(io.BytesIO(base64.b64decode(state)), self.client).load()
+        job_state["jobstore"] = self
+
+        job = Job.__new__(Job)
+        job.__setstate__(job_state)
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+
+        return job
+
+    def _save(self, job: Job) -> None:
+        buffer = io.BytesIO()
+
+        try:
+            _JobPickler(buffer, pickle.HIGHEST_PROTOCOL).dump(job.__getstate__())
+        except Exception as e:
+            if job.id not in self._unpersisted:
+                self._unpersisted.add(job.id)
+                self.db.remove(self.collection, job.id)
+                log.warning(
+                    "Job %s can't be persisted and will be lost on restart: %r", job.id, e
+                )
+            return
+
+        self._unpersisted.discard(job.id)
+
+        self.db.set(
+            self.collection,
+            job.id,
+            {
+                "next_run_time": datetime_to_utc_timestamp(job.next_run_time),
+                "state": base64.b64encode(buffer.getvalue()).decode(),
+            },
+        )
+
+    def add_job(self, job):
+        super().add_job(job)
+        self._save(job)
+
+    def update_job(self, job):
+        super().update_job(job)
+        self._save(job)
+
+    def remove_job(self, job_id):
+        super().remove_job(job_id)
+        self._unpersisted.discard(job_id)
+        self.db.remove(self.collection, job_id)
+
+    def remove_all_jobs(self):
+        for job in self.get_all_jobs():
+            self.db.remove(self.collection, job.id)
+
+        super().remove_all_jobs()
+
+    def shutdown(self):
+        # Keep persisted jobs, MemoryJobStore.shutdown() would remove them
+        self._jobs = []
+        self._jobs_index = {}
+
+
+class JobStats:
+    """Collects run time, error and miss statistics of scheduler jobs"""
+
+    EVENTS = (
+        EVENT_JOB_SUBMITTED
+        | EVENT_JOB_EXECUTED
+        | EVENT_JOB_ERROR
+        | EVENT_JOB_MISSED
+        | EVENT_JOB_MAX_INSTANCES
+    )
+
+    def __init__(self):
+        self.jobs: Dict[str, Dict[str, float]] = {}
+        self._started: Dict[str, float] = {}
+
+    def get(self, job_id: str) -> Dict[str, float]:
+        return self.jobs.setdefault(
+            job_id,
+            {
+                "runs": 0,
+                "errors": 0,
+                "missed": 0,
+                "skipped": 0,
+                "total_time": 0.0,
+                "last_time": 0.0,
+                "max_time": 0.0,
+            },
+        )
+
+    def __call__(self, event) -> None:
+        stats = self.get(event.job_id)
+
+        if event.code == EVENT_JOB_SUBMITTED:
+            self._started[event.job_id] = time.perf_counter()
+        elif event.code in (EVENT_JOB_EXECUTED, EVENT_JOB_ERROR):
+            started = self._started.pop(event.job_id, None)
+            if started is not None:
+                elapsed = time.perf_counter() - started
+                stats["total_time"] += elapsed
+                stats["last_time"] = elapsed
+                stats["max_time"] = max(stats["max_time"], elapsed)
+
+            stats["runs"] += 1
+            if event.code == EVENT_JOB_ERROR:
+                stats["errors"] += 1
+        elif event.code == EVENT_JOB_MISSED:
+            stats["missed"] += 1
+        elif event.code == EVENT_JOB_MAX_INSTANCES:
+            stats["skipped"] += 1
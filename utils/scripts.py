@@ -1,16 +1,26 @@
 import asyncio
+import codecs
+import collections
+import copy
 import datetime
+import gzip
+import hashlib
+import html
+import json
 import logging
+import logging.handlers
 import os
+import queue
 import random
 import shlex
+import shutil
 import string
+import sys
+import tempfile
 import traceback
 from time import perf_counter
-from typing import Dict, List, Optional, Tuple, Union
+from typing import AsyncIterator, BinaryIO, Callable, Dict, List, Optional, Tuple, Union
 
-import aiohttp
-import git
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 from pyrogram import Client, errors
@@ -18,6 +28,13 @@ from pyrogram.enums import ChatType
 from pyrogram.types import Chat, Message, User
 
 from utils.db import db
+from utils.edits import edit_queue
+from utils.git_info import repo_info
+from utils.http import HttpClient, http_client
+from utils.limits import Limits, Usage, spawner
+from utils.paste_server import paste_server
+from utils.sampler import sampler
+from utils.shell_pool import shell_pool
 
 
 class Formatter(logging.Formatter):
@@ -40,17 +57,92 @@ class Formatter(logging.Formatter):
         logging.CRITICAL: red + bold,
     }
 
+    FORMAT = "(black){asctime}(reset) (levelcolor){levelname:<8}(reset) (green){name}(reset) {message}"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Format strings never change, so formatters are built once per level
+        self._formatters = {
+            level: logging.Formatter(
+                self.FORMAT.replace("(black)", self.black + self.bold)
+                .replace("(reset)", self.reset)
+                .replace("(levelcolor)", color)
+                .replace("(green)", self.green + self.bold),
+                "%Y-%m-%d %H:%M:%S",
+                style="{",
+            )
+            for level, color in self.COLORS.items()
+        }
+
     def format(self, record):
-        log_color = self.COLORS[record.levelno]
-        fmt = "(black){asctime}(reset) (levelcolor){levelname:<8}(reset) (green){name}(reset) {message}"
-        fmt = fmt.replace("(black)", self.black + self.bold)
-        fmt = fmt.replace("(reset)", self.reset)
-        fmt = fmt.replace("(levelcolor)", log_color)
-        fmt = fmt.replace("(green)", self.green + self.bold)
-        formatter = logging.Formatter(fmt, "%Y-%m-%d %H:%M:%S", style="{")
+        formatter = self._formatters.get(record.levelno) or self._formatters[logging.INFO]
         return formatter.format(record)
 
 
+class JsonFormatter(logging.Formatter):
+    """Formats records as JSON lines"""
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "name": record.name,
+            "message": record.getMessage(),
+        }
+
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+
+        return json.dumps(data, ensure_ascii=False)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that leaves all formatting to the listener thread"""
+
+    def prepare(self, record):
+        # Only interpolate arguments now, while they still have their current values
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+
+        return record
+
+
+def setup_logging(
+    level: int = logging.INFO,
+    log_file: Optional[str] = None,
+    max_bytes: int = 10 * 2**20,
+    backup_count: int = 3,
+) -> logging.handlers.QueueListener:
+    """Configures root logger to pass records through a queue to a background thread.
+
+    Records are written to stdout (and optionally to ``log_file`` as JSON lines with
+    size-based rotation) by the returned listener, so logging never blocks the event loop
+    on I/O. The listener should be stopped on exit to flush remaining records.
+    """
+    stdout_handler = logging.StreamHandler()
+    stdout_handler.setFormatter(Formatter())
+    handlers = [stdout_handler]
+
+    if log_file:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+
+    logging.basicConfig(level=level, handlers=[LogQueueHandler(log_queue)], force=True)
+    listener.start()
+
+    return listener
+
+
 def get_proxy(proxies_path: str = "proxies.txt") -> dict:
     try:
         with open(proxies_path, "r") as f:
@@ -120,7 +212,7 @@ def with_args(text: str):
 
 def with_premium(func):
     async def wrapped(client: Client, message: Message):
-        if not (await client.get_users("me")).is_premium:
+        if not client.profile.is_premium:
             await message.edit("<b>Premium account is required</b>")
         else:
             return await func(client, message)
@@ -133,35 +225,126 @@ def generate_random_string(length):
     return "".join(random.choice(characters) for _ in range(length))
 
 
-async def paste_yaso(code: str, expiration_time: int = 10080):
-    try:
-        async with aiohttp.ClientSession(
-            connector=aiohttp.TCPConnector(ssl=False)
-        ) as session:
-            async with session.post(
-                "https://api.yaso.su/v1/auth/guest",
-            ) as auth:
-                auth.raise_for_status()
-
-            async with session.post(
-                "https://api.yaso.su/v1/records",
+class YasoClient:
+    """yaso.su API client, keeps guest auth cookie between pastes and renews it only on 401"""
+
+    api_url = "https://api.yaso.su/v1"
+    url = "https://yaso.su"
+
+    def __init__(self, http: HttpClient):
+        self.http = http
+        self._authorized = False
+        self._auth_lock = asyncio.Lock()
+
+    async def _auth(self) -> None:
+        async with self._auth_lock:
+            if self._authorized:
+                return
+
+            auth = await self.http.request("POST", f"{self.api_url}/auth/guest")
+            auth.raise_for_status()
+            self._authorized = True
+
+    async def paste(self, code: str, expiration_time: int = 10080) -> str:
+        await self._auth()
+
+        for _ in range(2):
+            paste = await self.http.request(
+                "POST",
+                f"{self.api_url}/records",
+                # A retry after a slow response could create a duplicate paste
+                retry=False,
                 json={
                     "captcha": generate_random_string(569),
                     "codeLanguage": "auto",
                     "content": code,
                     "expirationTime": expiration_time,
                 },
-            ) as paste:
-                paste.raise_for_status()
-                result = await paste.json()
+            )
+
+            if paste.status != 401:
+                break
+
+            # Guest session expired
+            self._authorized = False
+            await self._auth()
+
+        paste.raise_for_status()
+        result = await paste.json()
+
+        return f"{self.url}/{result['url']}"
+
+
+yaso = YasoClient(http_client)
+
+
+async def paste_yaso(code: str, expiration_time: int = 10080):
+    try:
+        return await yaso.paste(code, expiration_time)
     except Exception:
         return "Pasting failed"
-    else:
-        return f"https://yaso.su/{result['url']}"
 
 
-def get_prefix():
-    return db.get("core.main", "prefix", default=".")
+async def paste(code: str) -> str:
+    """Pastes text to the built-in paste server if it's running, otherwise to yaso.su"""
+    if paste_server.running:
+        try:
+            return await paste_server.paste(code)
+        except (OSError, ValueError):
+            logging.exception("Local paste failed")
+
+    return await paste_yaso(code)
+
+
+def _log_edit_error(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception():
+        logging.error("Failed to edit message: %r", future.exception())
+
+
+async def edit_message(
+    message: Message, text: str, wait: bool = True, **kwargs
+) -> Optional[Message]:
+    """Edits message text through the shared edit queue.
+
+    Pending edits of the same message are merged and only the latest one is sent,
+    edits that don't change the message are skipped.
+
+    Args:
+        message (Message): Message to edit.
+
+        text (str): New text of the message.
+
+        wait (bool, optional): Wait until the edit is sent. If False, the edit is only scheduled,
+            so it can be replaced by the next one. Defaults to True.
+
+    Returns:
+        Optional[Message]: Edited message or None if ``wait`` is False.
+    """
+    future = edit_queue.submit(message, text, **kwargs)
+
+    if wait:
+        return await future
+
+    future.add_done_callback(_log_edit_error)
+
+
+_prefix: Optional[str] = None
+
+
+def get_prefix() -> str:
+    global _prefix
+
+    if _prefix is None:
+        _prefix = db.get("core.main", "prefix", default=".")
+
+    return _prefix
+
+
+def set_prefix(prefix: str) -> None:
+    global _prefix
+
+    db.set("core.main", "prefix", prefix)
+    _prefix = prefix
 
 
 def get_args_raw(message: Union[Message, str], use_reply: bool = None) -> str:
@@ -229,6 +412,14 @@ def get_args(
 
 
 class ScheduleJob:
+    """Job added to the scheduler on start, with the client as the first argument.
+
+    ``coalesce``, ``misfire_grace_time``, ``jitter`` and ``max_instances`` are passed to
+    APScheduler as is. ``executor`` is "default" (event loop), "thread" or "process".
+    Process jobs don't get the client, it can't be pickled, so ``func`` and its
+    arguments must be picklable.
+    """
+
     def __init__(
         self,
         func: callable,
@@ -236,17 +427,38 @@ class ScheduleJob:
             seconds=3600
         ),
         *args,
+        job_id: Optional[str] = None,
+        coalesce: bool = True,
+        misfire_grace_time: Optional[int] = 60,
+        jitter: Optional[int] = None,
+        max_instances: int = 1,
+        executor: str = "default",
         **kwargs,
     ):
         self.func = func
-        self.args = args or []
+        self.args = list(args)
         self.kwargs = kwargs or {}
-        self.id = func.__name__
+        self.id = job_id or func.__name__
         self.trigger = trigger
+        self.options = {
+            "coalesce": coalesce,
+            "misfire_grace_time": misfire_grace_time,
+            "max_instances": max_instances,
+            "executor": executor,
+        }
+
+        if jitter is not None:
+            # Trigger may be the shared default one
+            self.trigger = copy.copy(trigger)
+            self.trigger.jitter = jitter
 
 
 def get_ram_usage() -> float:
     """Returns current process tree memory usage in MB"""
+    sample = sampler.latest()
+    if sample:
+        return round(sample["rss"], 1)
+
     try:
         import psutil
 
@@ -262,6 +474,10 @@ def get_ram_usage() -> float:
 
 def get_cpu_usage() -> float:
     """Returns current process tree CPU usage in %"""
+    sample = sampler.latest()
+    if sample:
+        return round(sample["cpu"], 1)
+
     try:
         import psutil
 
@@ -291,11 +507,12 @@ class Command:
 
 
 class Module:
-    def __init__(self, name: str, path: str):
+    def __init__(self, name: str, path: str, owner: Optional["ModuleHelp"] = None):
         self.name = name
         self.path = path
         self.commands = {}
         self.hidden = False
+        self._owner = owner
 
     def add_command(
         self,
@@ -309,12 +526,18 @@ class Module:
 
         self.commands[command] = Command(command, description, args, aliases)
 
+        if self._owner:
+            self._owner.index_command(self, self.commands[command])
+
         return self.commands[command]
 
     def delete_command(self, command: str) -> None:
         if command not in self.commands:
             raise ValueError(f"Command {command} not found")
 
+        if self._owner:
+            self._owner.unindex_command(self, self.commands[command])
+
         del self.commands[command]
 
     def hide_command(self, command: str) -> None:
@@ -323,36 +546,88 @@ class Module:
 
         self.commands[command].hidden = True
 
+        if self._owner:
+            self._owner.invalidate()
+
     def show_command(self, command: str) -> None:
         if command not in self.commands:
             raise ValueError(f"Command {command} not found")
 
         self.commands[command].hidden = False
 
+        if self._owner:
+            self._owner.invalidate()
+
 
 class ModuleHelp:
+    """Registry of modules and their commands.
+
+    Keeps an index of command names and aliases, so commands are found in O(1),
+    and caches rendered help texts until modules or prefix change.
+    """
+
     def __init__(self) -> None:
         self.modules = {}
+        # command name or alias -> (module, command)
+        self.index: Dict[str, Tuple[Module, Command]] = {}
+        self._cache = {}
+
+    def invalidate(self) -> None:
+        self._cache.clear()
+
+    def index_command(self, module: Module, command: Command) -> None:
+        for name in [command.name, *(command.aliases or [])]:
+            if name in self.index and self.index[name][0] is not module:
+                other = self.index[name][0]
+                logging.warning(
+                    "Command %s from module %s is already defined in module %s, ignoring it",
+                    name,
+                    module.name,
+                    other.name,
+                )
+                continue
+
+            self.index[name] = (module, command)
+
+        self.invalidate()
+
+    def unindex_command(self, module: Module, command: Command) -> None:
+        for name in [command.name, *(command.aliases or [])]:
+            if self.index.get(name, (None, None))[1] is command:
+                del self.index[name]
+
+        self.invalidate()
 
     def add_module(self, name: str, path: str) -> Module:
-        self.modules[name] = Module(name, path)
+        if name in self.modules:
+            # Module is reloaded, forget its old commands
+            self.delete_module(name)
+
+        self.modules[name] = Module(name, path, self)
+        self.invalidate()
 
         return self.modules[name]
 
     def delete_module(self, name: str) -> None:
+        for command in self.modules[name].commands.values():
+            self.unindex_command(self.modules[name], command)
+
         del self.modules[name]
+        self.invalidate()
 
     def hide_module(self, name: str) -> None:
         if name not in self.modules:
             raise ValueError(f"Module {name} not found")
 
         self.modules[name].hidden = True
+        self.invalidate()
 
     def show_module(self, name: str) -> None:
         if name not in self.modules:
             raise ValueError(f"Module {name} not found")
 
         self.modules[name].hidden = False
+        self.invalidate()
 
     def get_module(self, name: str) -> Module:
         if name not in self.modules:
@@ -367,23 +642,46 @@ class ModuleHelp:
 
         raise ValueError(f"Module with path {path} not found")
 
+    def get_command(self, command: str) -> Tuple[Module, Command]:
+        """Returns module and command by command name or alias"""
+        if command not in self.index:
+            raise ValueError(f"Command {command} not found")
+
+        return self.index[command]
+
     def help(self) -> List[str]:
         prefix = get_prefix()
-        result = []
+        key = ("help", prefix)
+
+        if key not in self._cache:
+            self._cache[key] = self._render_help(prefix)
 
-        help_text = f"For more help on how to use a command, type <code>{prefix}help [module]</code>\n\nAvailable Modules:\n"
+        return list(self._cache[key])
+
+    def _render_help(self, prefix: str) -> List[str]:
+        result = []
+        lines = [
+            f"For more help on how to use a command, type <code>{prefix}help [module]</code>\n\nAvailable Modules:\n"
+        ]
+        length = len(lines[0])
 
         for module_name, module in sorted(self.modules.items(), key=lambda x: x[0]):
-            help_text += f"• {module_name.title()}: {' '.join([f'<code>{prefix + cmd_name}</code>' for cmd_name in module.commands.keys()])}\n"
+            commands = " ".join(
+                f"<code>{prefix + cmd_name}</code>" for cmd_name in module.commands.keys()
+            )
+            line = f"• {module_name.title()}: {commands}\n"
+            lines.append(line)
+            length += len(line)
 
-            if len(help_text) >= 2048:
-                result.append(help_text)
-                help_text = ""
+            if length >= 2048:
+                result.append("".join(lines))
+                lines = []
+                length = 0
 
-        help_text += f"\nThe number of modules in the userbot: {self.modules_count}\n"
-        help_text += f"The number of commands in the userbot: {self.commands_count}"
+        lines.append(f"\nThe number of modules in the userbot: {self.modules_count}\n")
+        lines.append(f"The number of commands in the userbot: {self.commands_count}")
 
-        result.append(help_text)
+        result.append("".join(lines))
 
         return result
 
@@ -392,50 +690,56 @@ class ModuleHelp:
             raise ValueError(f"Module {module} not found")
 
         prefix = get_prefix()
-        help_text = ""
+        key = ("module", module, full, prefix)
+
+        if key in self._cache:
+            return self._cache[key]
+
+        lines = []
 
         if full:
-            help_text += f"<b>Help for |<code>{module}</code>|</b>\n\n"
+            lines.append(f"<b>Help for |<code>{module}</code>|</b>\n\n")
 
-        help_text += "<b>Usage:</b>\n"
+        lines.append("<b>Usage:</b>\n")
         for command in self.modules[module].commands.values():
-            help_text += f"<code>{prefix}{command.name}"
+            lines.append(f"<code>{prefix}{command.name}")
             if command.args:
-                help_text += f" {command.args}"
+                lines.append(f" {command.args}")
             if command.description:
-                help_text += f"</code> — <i>{command.description}</i>\n"
+                lines.append(f"</code> — <i>{command.description}</i>\n")
+
+        self._cache[key] = "".join(lines)
 
-        return help_text
+        return self._cache[key]
 
     def command_help(self, command: str) -> str:
-        for module in self.modules.values():
-            for cmd in module.commands.values():
-                if cmd.name == command or (cmd.aliases and command in cmd.aliases):
-                    command = cmd
-                    break
-            else:
-                continue
-            break
-        else:
-            raise ValueError(f"Command {command} not found")
+        module, command = self.get_command(command)
 
         prefix = get_prefix()
+        key = ("command", module.name, command.name, prefix)
+
+        if key in self._cache:
+            return self._cache[key]
 
-        help_text = f"<b>Help for command</b> <code>{prefix}{command.name}</code>\n"
+        lines = [f"<b>Help for command</b> <code>{prefix}{command.name}</code>\n"]
         if command.aliases:
-            help_text += "<b>Aliases:</b> "
-            help_text += f"{' '.join([f'<code>{prefix}{alias}</code>' for alias in command.aliases])}\n"
+            aliases = " ".join(f"<code>{prefix}{alias}</code>" for alias in command.aliases)
+            lines.append(f"<b>Aliases:</b> {aliases}\n")
 
-        help_text += f"\n<b>Module: {module.name}</b> (<code>{prefix}help {module.name}</code>)\n\n"
-        help_text += f"<code>{prefix}{command.name}"
+        lines.append(
+            f"\n<b>Module: {module.name}</b> (<code>{prefix}help {module.name}</code>)\n\n"
+        )
+        lines.append(f"<code>{prefix}{command.name}")
 
         if command.args:
-            help_text += f" {command.args}"
-        help_text += "</code>"
+            lines.append(f" {command.args}")
+        lines.append("</code>")
         if command.description:
-            help_text += f" — <i>{command.description}</i>"
+            lines.append(f" — <i>{command.description}</i>")
+
+        self._cache[key] = "".join(lines)
 
-        return help_text
+        return self._cache[key]
 
     @property
     def modules_count(self) -> int:
@@ -452,8 +756,19 @@ async def shell_exec(
     timeout: Optional[Union[int, float]] = None,
     stdout=asyncio.subprocess.PIPE,
     stderr=asyncio.subprocess.PIPE,
+    pooled: Optional[bool] = None,
 ) -> Tuple[int, str, str]:
-    """Executes shell command and returns tuple with return code, decoded stdout and stderr"""
+    """Executes shell command and returns tuple with return code, decoded stdout and stderr
+
+    If ``pooled`` is True (defaults to ``shell.pool`` setting), the command is executed
+    in a warm shell worker instead of spawning a new shell process.
+    """
+    if pooled is None:
+        pooled = db.get("shell", "pool", True)
+
+    if pooled and stdout == stderr == asyncio.subprocess.PIPE:
+        return await shell_pool.exec(command, executable, timeout)
+
     process = await asyncio.create_subprocess_shell(
         cmd=command, stdout=stdout, stderr=stderr, shell=True, executable=executable
     )
@@ -467,6 +782,392 @@ async def shell_exec(
     return process.returncode, stdout.decode(), stderr.decode()
 
 
+# Telegram message length limit
+MAX_MESSAGE_LENGTH = 4096
+
+
+class ResultFile:
+    """Full output of a run for uploading as a document.
+
+    Output is kept in memory until it's larger than ``spool_size`` bytes, then it's
+    moved to an anonymous temporary file, so nothing is left in the working directory
+    and concurrent runs don't share a path.
+    """
+
+    def __init__(self, spool_size: int = 4 * 2**20):
+        self.spool_size = spool_size
+        self.size = 0
+        self._file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+
+    @classmethod
+    def from_text(cls, text: str) -> "ResultFile":
+        file = cls()
+        file.write(text)
+        return file
+
+    def write(self, text: str) -> None:
+        data = text.encode(errors="replace")
+        self._file.write(data)
+        self.size += len(data)
+
+    def replace(self, old: str, new: str) -> None:
+        """Replaces text in the whole output, chunk by chunk"""
+        old_data, new_data = old.encode(), new.encode()
+        file = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        self._file.seek(0)
+        carry = b""
+
+        while chunk := self._file.read(2**20):
+            data = (carry + chunk).replace(old_data, new_data)
+            # Tail which may be the start of ``old``, split between chunks
+            keep = len(old_data) - 1
+            carry = data[len(data) - keep :] if keep else b""
+            file.write(data[: len(data) - len(carry)])
+
+        file.write(carry)
+        self._file.close()
+        self._file = file
+        self.size = file.tell()
+
+    def document(
+        self, name: str, compress_size: Optional[int] = None
+    ) -> Tuple[BinaryIO, str]:
+        """Returns file object to upload and its name, gzipped if the output is larger
+        than ``compress_size`` bytes. Blocking, so it's better run in a thread.
+        """
+        self._file.seek(0)
+
+        if not compress_size or self.size <= compress_size:
+            return self._file, name
+
+        file = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        with gzip.GzipFile(name, "wb", fileobj=file) as archive:
+            shutil.copyfileobj(self._file, archive)
+
+        file.seek(0)
+        return file, f"{name}.gz"
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def _cut(text: str, limit: int, from_end: bool = False) -> Tuple[str, str]:
+    """Cuts a part, which is at most ``limit`` characters long once HTML-escaped, from
+    the start (or the end) of the text, at a line break if there is one near the limit.
+
+    Returns the escaped part and the rest of the text.
+    """
+    length = min(len(text), limit)
+
+    while True:
+        part = text[len(text) - length :] if from_end else text[:length]
+        escaped_length = len(html.escape(part))
+        if escaped_length <= limit or length == 1:
+            break
+        length = max(min(length * limit // escaped_length, length - 1), 1)
+
+    if length < len(text):
+        if from_end:
+            newline = part.find("\n")
+            if 0 <= newline < length // 2:
+                part = part[newline + 1 :]
+        else:
+            newline = part.rfind("\n")
+            if newline >= length // 2:
+                part = part[: newline + 1]
+
+    if from_end:
+        return html.escape(part), text[: len(text) - len(part)]
+
+    return html.escape(part), text[len(part) :]
+
+
+def split_output(
+    text: str, first_limit: int, limit: int, max_parts: int, tail: bool = False
+) -> Tuple[List[str], str]:
+    """Splits text into at most ``max_parts`` HTML-escaped parts, the first one fits
+    ``first_limit`` characters and others fit ``limit``. With ``tail`` the parts
+    are taken from the end of the text, if it doesn't fit into them.
+
+    Returns the parts and the rest of the text which didn't fit into them.
+    """
+    parts, rest = [], text
+
+    for part_limit in [first_limit] + [limit] * (max_parts - 1):
+        if not rest:
+            break
+        part, rest = _cut(rest, part_limit)
+        parts.append(part)
+
+    if not tail or not rest:
+        return parts, rest
+
+    parts, rest = [], text
+
+    for part_limit in [limit] * (max_parts - 1) + [first_limit]:
+        part, rest = _cut(rest, part_limit, from_end=True)
+        parts.insert(0, part)
+
+    return parts, rest
+
+
+async def send_output(
+    message: Message,
+    render: Callable[[str], str],
+    output: str,
+    file: Optional[ResultFile] = None,
+    file_name: str = "output.txt",
+    tail: bool = False,
+    upload: bool = True,
+    **kwargs,
+) -> None:
+    """Shows output of a run, the message text is ``render(preview)``, where ``preview``
+    is HTML with output which fits into the message.
+
+    Output which doesn't fit continues in up to ``preview_messages`` replies (see
+    :func:`split_output`, ``tail`` shows its end). If it doesn't fit them either, the
+    full output is uploaded as a document from memory (unless ``upload`` is False):
+    ``file`` if ``output`` is only a part of it, or ``output`` itself. Documents larger
+    than ``compress_size`` MB are gzipped.
+    """
+    max_parts = max(db.get("shell", "preview_messages", 3), 1)
+    first_limit = max(MAX_MESSAGE_LENGTH - len(render("<pre></pre>")), 256)
+    parts, rest = split_output(
+        output, first_limit, MAX_MESSAGE_LENGTH - len("<pre></pre>"), max_parts, tail
+    )
+    parts = [part for part in parts if part]
+
+    await edit_message(message, render(f"<pre>{parts[0]}</pre>" if parts else ""), **kwargs)
+
+    reply_to = message
+    for part in parts[1:]:
+        reply_to = await reply_to.reply_text(f"<pre>{part}</pre>", quote=True)
+
+    if file is not None and file.size == len(output.encode(errors="replace")):
+        file = None
+
+    if not upload or (not rest and file is None):
+        return
+
+    compress_size = db.get("shell", "compress_size", 1) * 2**20
+    owned = file is None
+    if owned:
+        file = ResultFile.from_text(output)
+
+    try:
+        document, name = await asyncio.to_thread(file.document, file_name, compress_size)
+
+        try:
+            await message.reply_document(
+                document=document,
+                file_name=name,
+                caption=f"<b>Full output, {file.size / 2**10:.1f}KB</b>",
+                quote=True,
+            )
+        finally:
+            # Compressed copy
+            if name != file_name:
+                document.close()
+    finally:
+        if owned:
+            file.close()
+
+
+class OutputRing:
+    """Keeps only the last ``max_size`` characters of the written text.
+
+    If ``spill`` is True, everything written is also saved to ``file``
+    (see :class:`ResultFile`), so the full output can be uploaded afterwards.
+    """
+
+    def __init__(self, max_size: int = 65536, spill: bool = False):
+        self.max_size = max_size
+        self.size = 0
+        self._chunks = collections.deque()
+        self._length = 0
+        self.file = ResultFile() if spill else None
+
+    @property
+    def truncated(self) -> bool:
+        return self.size > self._length
+
+    def write(self, text: str) -> None:
+        if self.file:
+            self.file.write(text)
+
+        self.size += len(text)
+
+        if len(text) >= self.max_size:
+            self._chunks.clear()
+            text = text[-self.max_size :]
+            self._length = 0
+
+        self._chunks.append(text)
+        self._length += len(text)
+
+        while self._length - len(self._chunks[0]) >= self.max_size:
+            self._length -= len(self._chunks.popleft())
+
+    def getvalue(self) -> str:
+        value = "".join(self._chunks)
+        return value[-self.max_size :]
+
+    def tail(self, length: int) -> str:
+        result = []
+        total = 0
+
+        for chunk in reversed(self._chunks):
+            result.append(chunk)
+            total += len(chunk)
+            if total >= length:
+                break
+
+        return "".join(reversed(result))[-length:]
+
+    def close(self) -> None:
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class ShellStream:
+    """Executes shell command and yields ``(stream_name, text)`` output chunks as they arrive.
+
+    After iteration is finished, ``returncode`` contains the exit code of the process.
+    Raises ``asyncio.TimeoutError`` if the command didn't finish in ``timeout`` seconds.
+    ``pooled`` has the same meaning as in :func:`shell_exec`.
+
+    With ``limits``, the command is started by the spawner under these limits (see
+    :class:`utils.limits.LimitedStream`), and after iteration ``usage`` contains
+    resources it used and ``limit_error`` describes the limit it hit, if any.
+    """
+
+    def __init__(
+        self,
+        command: str,
+        executable: Optional[str] = None,
+        timeout: Optional[Union[int, float]] = None,
+        chunk_size: int = 4096,
+        pooled: Optional[bool] = None,
+        limits: Optional[Limits] = None,
+    ):
+        self.command = command
+        self.executable = executable
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.pooled = db.get("shell", "pool", True) if pooled is None else pooled
+        self.limits = limits
+        self.returncode = None
+        self.usage: Optional[Usage] = None
+        self.limit_error: Optional[str] = None
+
+    async def __aiter__(self) -> AsyncIterator[Tuple[str, str]]:
+        if self.limits is not None:
+            stream = spawner.stream(self.command, self.limits, self.executable, self.timeout)
+
+            async for item in stream:
+                yield item
+
+            self.returncode = stream.returncode
+            self.usage = stream.usage
+            self.limit_error = stream.limit_error
+            return
+
+        if self.pooled:
+            stream = shell_pool.stream(self.command, self.executable, self.timeout)
+
+            async for item in stream:
+                yield item
+
+            self.returncode = stream.returncode
+            return
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout if self.timeout else None
+        # Bounded, so a chatty process is paused by the pipe instead of filling memory
+        queue = asyncio.Queue(maxsize=64)
+
+        process = await asyncio.create_subprocess_shell(
+            cmd=self.command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            shell=True,
+            executable=self.executable,
+        )
+
+        async def pump(name: str, stream: asyncio.StreamReader):
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+            while chunk := await stream.read(self.chunk_size):
+                await queue.put((name, decoder.decode(chunk)))
+
+            await queue.put((name, decoder.decode(b"", final=True)))
+            await queue.put((name, None))
+
+        pumps = [
+            asyncio.create_task(pump("stdout", process.stdout)),
+            asyncio.create_task(pump("stderr", process.stderr)),
+        ]
+
+        def remaining() -> Optional[float]:
+            return None if deadline is None else max(deadline - loop.time(), 0)
+
+        try:
+            opened = len(pumps)
+            while opened:
+                name, text = await asyncio.wait_for(queue.get(), remaining())
+
+                if text is None:
+                    opened -= 1
+                elif text:
+                    yield name, text
+
+            self.returncode = await asyncio.wait_for(process.wait(), remaining())
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        finally:
+            for task in pumps:
+                task.cancel()
+
+
+def requirements_hash(path: str = "requirements.txt") -> Optional[str]:
+    """Returns SHA-256 of requirements file, or None if it doesn't exist"""
+    try:
+        with open(path, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+async def install_requirements(
+    path: str = "requirements.txt", cache_dir: str = ".pip-cache"
+) -> Tuple[int, str, str]:
+    """Installs requirements with pip without blocking the event loop.
+
+    Downloaded and built wheels are kept in ``cache_dir``, so reinstalling
+    the same versions doesn't hit the network or rebuild anything.
+    """
+    process = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-m",
+        "pip",
+        "install",
+        "-U",
+        "--cache-dir",
+        cache_dir,
+        "-r",
+        path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate()
+
+    return process.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+
+
 async def handle_restart(client: Client):
     restart_info = db.get("core.updater", "restart_info")
 
@@ -482,8 +1183,7 @@ async def handle_restart(client: Client):
                     text=f"<code>Restarted in {perf_counter() - restart_info['time']:.3f}s...</code>",
                 )
             elif restart_info["type"] == "update":
-                current_hash = git.Repo().head.commit.hexsha
-                git.Repo().remote("origin").fetch()
+                current_hash = (await repo_info.local())["hash"]
 
                 update_text = (
                     f"Userbot succesfully updated from {restart_info['hash'][:7]} "
@@ -496,7 +1196,8 @@ async def handle_restart(client: Client):
                     message_id=restart_info["message_id"],
                     text=(
                         f"<code>{update_text}.\n\n"
-                        f"Restarted in {perf_counter() - restart_info['time']:.3f}s...</code>"
+                        + (f"{restart_info['steps']}\n" if restart_info.get("steps") else "")
+                        + f"Restarted in {perf_counter() - restart_info['time']:.3f}s...</code>"
                     ),
                 )
         except Exception:
@@ -505,9 +1206,10 @@ async def handle_restart(client: Client):
 
         db.remove("core.updater", "restart_info")
     else:
+        local = await repo_info.local()
         logging.info(
-            f"{client.me.username}#{client.me.id} on {git.Repo().active_branch.name}"
-            f"@{git.Repo().head.commit.hexsha[:7]}"
+            f"{client.me.username}#{client.me.id} on {local['branch']}"
+            f"@{local['hash'][:7]}"
             " | Userbot succesfully started."
         )
 
@@ -0,0 +1,292 @@
+import asyncio
+import codecs
+import contextlib
+import logging
+import os
+import shlex
+import signal
+import uuid
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+
+log = logging.getLogger(__name__)
+
+DEFAULT_EXECUTABLE = "/bin/sh"
+
+
+class ShellWorker:
+    """Long-lived shell process that executes commands sent to its stdin.
+
+    Every command runs in a subshell with stdin redirected from /dev/null, so ``cd``,
+    ``export`` or ``exit`` don't leak into the next command. After the command the worker
+    prints a random frame token with the exit code to stdout and the same token to stderr,
+    which marks the end of the command output in both streams.
+    """
+
+    def __init__(self, executable: Optional[str] = None):
+        self.executable = executable or DEFAULT_EXECUTABLE
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.returncode: Optional[int] = None
+        self.trailer = ""
+        self.uses = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    @property
+    def argv(self) -> List[str]:
+        return [self.executable]
+
+    def encode(self, command: str, token: str) -> bytes:
+        """Returns input for the worker which runs the command and prints the frame token"""
+        return (
+            f"( eval {shlex.quote(command)} ) </dev/null\n"
+            f"printf '%s%d\\n' '{token}' \"$?\"\n"
+            f"printf '%s' '{token}' >&2\n"
+        ).encode()
+
+    async def start(self) -> "ShellWorker":
+        self.process = await asyncio.create_subprocess_exec(
+            *self.argv,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        )
+
+        return self
+
+    async def kill(self) -> None:
+        if not self.alive:
+            return
+
+        # Worker runs in its own session, so this also kills everything it started
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(self.process.pid, signal.SIGKILL)
+
+        await self.process.wait()
+
+    async def _read_frame(
+        self, name: str, stream: asyncio.StreamReader, token: str, queue: asyncio.Queue
+    ) -> None:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        pending = ""
+
+        while True:
+            chunk = await stream.read(4096)
+            pending += decoder.decode(chunk, final=not chunk)
+
+            index = pending.find(token)
+            if index != -1:
+                if index:
+                    await queue.put((name, pending[:index]))
+
+                trailer = pending[index + len(token) :]
+                # Exit code is written after the token on stdout, wait for the whole line
+                while name == "stdout" and "\n" not in trailer:
+                    chunk = await stream.read(64)
+                    if not chunk:
+                        break
+                    trailer += decoder.decode(chunk)
+
+                await queue.put((name, None, trailer.split("\n", 1)[0].strip()))
+                return
+
+            if not chunk:
+                # Worker died before finishing the command
+                if pending:
+                    await queue.put((name, pending))
+                await queue.put((name, None, None))
+                return
+
+            # Keep possible beginning of the token in the buffer
+            keep = len(token) - 1
+            if len(pending) > keep:
+                await queue.put((name, pending[:-keep]))
+                pending = pending[-keep:]
+
+    async def stream(
+        self, command: str, timeout: Optional[Union[int, float]] = None
+    ) -> AsyncIterator[Tuple[str, str]]:
+        """Executes command and yields ``(stream_name, text)`` chunks, sets ``returncode``"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout else None
+        token = f"__KRM_{uuid.uuid4().hex}__"
+        queue = asyncio.Queue(maxsize=64)
+
+        self.uses += 1
+        self.returncode = None
+        self.trailer = ""
+
+        self.process.stdin.write(self.encode(command, token))
+
+        readers = [
+            asyncio.create_task(
+                self._read_frame("stdout", self.process.stdout, token, queue)
+            ),
+            asyncio.create_task(
+                self._read_frame("stderr", self.process.stderr, token, queue)
+            ),
+        ]
+
+        def remaining() -> Optional[float]:
+            return None if deadline is None else max(deadline - loop.time(), 0)
+
+        try:
+            await asyncio.wait_for(self.process.stdin.drain(), remaining())
+
+            opened = len(readers)
+            while opened:
+                item = await asyncio.wait_for(queue.get(), remaining())
+
+                if item[1] is not None:
+                    yield item[0], item[1]
+                    continue
+
+                opened -= 1
+                if item[0] == "stdout":
+                    # Exit code, optionally followed by extra data of the worker
+                    fields = (item[2] or "").split(maxsplit=1)
+                    if fields and fields[0].lstrip("-").isdigit():
+                        self.returncode = int(fields[0])
+                        self.trailer = fields[1] if len(fields) > 1 else ""
+                    else:
+                        await self.kill()
+                        self.returncode = self.process.returncode
+        except BaseException:
+            # Hung or interrupted command, worker state is unknown now
+            await self.kill()
+            raise
+        finally:
+            for task in readers:
+                task.cancel()
+
+
+class ReplWorker(ShellWorker):
+    """Long-lived interpreter process running a driver from ``utils/repl``.
+
+    ``executable`` is the command line of the interpreter. Code is sent to the driver
+    as ``token\\nlength\\ncode`` frame, and the driver finishes its output with the same
+    token framing as a shell worker.
+    """
+
+    @property
+    def argv(self) -> List[str]:
+        return shlex.split(self.executable)
+
+    def encode(self, command: str, token: str) -> bytes:
+        code = command.encode()
+        return f"{token}\n{len(code)}\n".encode() + code
+
+
+class PoolStream:
+    """Same interface as :class:`utils.scripts.ShellStream`, but runs the command in a pooled worker"""
+
+    def __init__(
+        self,
+        pool: "ShellPool",
+        command: str,
+        executable: Optional[str] = None,
+        timeout: Optional[Union[int, float]] = None,
+    ):
+        self.pool = pool
+        self.command = command
+        self.executable = executable
+        self.timeout = timeout
+        self.returncode = None
+
+    async def __aiter__(self) -> AsyncIterator[Tuple[str, str]]:
+        worker = await self.pool.acquire(self.executable)
+
+        try:
+            async for item in worker.stream(self.command, self.timeout):
+                yield item
+
+            self.returncode = worker.returncode
+        finally:
+            await self.pool.release(worker)
+
+
+class ShellPool:
+    """Pool of warm :class:`ShellWorker` processes.
+
+    Up to ``size`` idle workers are kept alive. If all of them are busy, a new worker is
+    started, so commands never wait for each other. Workers are recycled after
+    ``max_uses`` commands and after any timeout. ``worker_class`` allows pooling other
+    kinds of workers with the same framing, e.g. interpreters.
+    """
+
+    def __init__(self, size: int = 2, max_uses: int = 100, worker_class=ShellWorker):
+        self.size = size
+        self.max_uses = max_uses
+        self.worker_class = worker_class
+        self._idle: Dict[str, List[ShellWorker]] = {}
+
+    async def start(self, executable: Optional[str] = None, size: Optional[int] = None):
+        """Pre-starts workers, so the first commands don't pay the shell startup"""
+        if size is not None:
+            self.size = size
+
+        executable = executable or DEFAULT_EXECUTABLE
+        idle = self._idle.setdefault(executable, [])
+
+        while len(idle) < self.size:
+            idle.append(await self.worker_class(executable).start())
+
+    async def acquire(self, executable: Optional[str] = None) -> ShellWorker:
+        executable = executable or DEFAULT_EXECUTABLE
+
+        # Shell executable was changed, workers of the old one are not needed anymore
+        for other in [e for e in self._idle if e != executable]:
+            for worker in self._idle.pop(other):
+                await worker.kill()
+
+        idle = self._idle.setdefault(executable, [])
+
+        while idle:
+            worker = idle.pop()
+            if worker.alive:
+                return worker
+
+        return await self.worker_class(executable).start()
+
+    async def release(self, worker: ShellWorker) -> None:
+        idle = self._idle.setdefault(worker.executable, [])
+
+        if worker.alive and worker.uses < self.max_uses and len(idle) < self.size:
+            idle.append(worker)
+        else:
+            await worker.kill()
+
+    def stream(
+        self,
+        command: str,
+        executable: Optional[str] = None,
+        timeout: Optional[Union[int, float]] = None,
+    ) -> PoolStream:
+        return PoolStream(self, command, executable, timeout)
+
+    async def exec(
+        self,
+        command: str,
+        executable: Optional[str] = None,
+        timeout: Optional[Union[int, float]] = None,
+    ) -> Tuple[int, str, str]:
+        """Executes shell command and returns tuple with return code, decoded stdout and stderr"""
+        stream = self.stream(command, executable, timeout)
+        output = {"stdout": [], "stderr": []}
+
+        async for name, text in stream:
+            output[name].append(text)
+
+        return stream.returncode, "".join(output["stdout"]), "".join(output["stderr"])
+
+    async def close(self) -> None:
+        for workers in self._idle.values():
+            for worker in workers:
+                await worker.kill()
+
+        self._idle.clear()
+
+
+shell_pool = ShellPool()
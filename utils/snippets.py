@@ -0,0 +1,46 @@
+import collections
+import hashlib
+from ast import PyCF_ALLOW_TOP_LEVEL_AWAIT
+from types import CodeType
+
+
+class CodeCache:
+    """LRU cache of compiled snippets, keyed by hash of the source"""
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._codes = collections.OrderedDict()
+
+    def get(self, source: str, repl: bool = False) -> CodeType:
+        key = hashlib.sha256(f"{repl}\0{source}".encode()).digest()
+
+        if key in self._codes:
+            self._codes.move_to_end(key)
+            return self._codes[key]
+
+        if repl:
+            code = compile(source, "<snippet>", "exec", flags=PyCF_ALLOW_TOP_LEVEL_AWAIT)
+        else:
+            code = compile(
+                "async def __todo(client, message, *args):\n"
+                + " app = client\n"
+                + " m = message\n"
+                # Message is None for snippets run without one, e.g. in a worker
+                + " r = getattr(m, 'reply_to_message', None)\n"
+                + " u = getattr(m, 'from_user', None)\n"
+                + " ru = getattr(r, 'from_user', None)\n"
+                + " p = print\n"
+                + " here = getattr(getattr(m, 'chat', None), 'id', None)\n"
+                + "".join(f"\n {_l}" for _l in source.split("\n")),
+                "<snippet>",
+                "exec",
+            )
+
+        self._codes[key] = code
+        while len(self._codes) > self.maxsize:
+            self._codes.popitem(last=False)
+
+        return code
+
+
+code_cache = CodeCache()
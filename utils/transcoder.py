@@ -0,0 +1,122 @@
+import asyncio
+import collections
+import contextlib
+import os
+import shutil
+from typing import Callable, List, Optional, Union
+
+
+class TranscodeError(Exception):
+    def __init__(self, returncode: int, stderr: str):
+        super().__init__(f"ffmpeg exited with code {returncode}")
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class Transcoder:
+    """Runs ffmpeg jobs, at most ``jobs`` of them at once.
+
+    Each job gets ``cpu_count // jobs`` threads, so parallel jobs don't fight
+    for the same cores. Progress is read from ``-progress pipe:1``.
+    """
+
+    def __init__(self, jobs: int = 2, executable: str = "ffmpeg"):
+        self.jobs = jobs
+        self.executable = executable
+        self.running = 0
+
+        self._condition = asyncio.Condition()
+
+    @property
+    def available(self) -> bool:
+        return shutil.which(self.executable) is not None
+
+    @property
+    def threads(self) -> int:
+        return max((os.cpu_count() or 1) // max(self.jobs, 1), 1)
+
+    @contextlib.asynccontextmanager
+    async def _slot(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.running < self.jobs)
+            self.running += 1
+
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.running -= 1
+                self._condition.notify()
+
+    async def transcode(
+        self,
+        input_path: str,
+        output_path: str,
+        options: List[str],
+        input_options: Optional[List[str]] = None,
+        duration: Optional[float] = None,
+        on_progress: Optional[Callable[[Optional[float], float], None]] = None,
+        timeout: Optional[Union[int, float]] = None,
+    ) -> None:
+        """Converts ``input_path`` to ``output_path`` with output ``options``.
+
+        ``on_progress`` is called with a fraction of ``duration`` done (None if the
+        duration isn't known) and seconds of the output written so far.
+        Raises :obj:`TranscodeError` if ffmpeg fails and :obj:`asyncio.TimeoutError`
+        if it didn't finish in ``timeout`` seconds (waiting for a slot isn't counted).
+        """
+        async with self._slot():
+            process = await asyncio.create_subprocess_exec(
+                self.executable,
+                "-hide_banner",
+                "-nostdin",
+                "-nostats",
+                "-y",
+                *(input_options or []),
+                "-i",
+                input_path,
+                *options,
+                "-threads",
+                str(self.threads),
+                "-progress",
+                "pipe:1",
+                output_path,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+
+            # ffmpeg writes a lot to stderr, only the end is kept for errors
+            stderr = collections.deque(maxlen=30)
+
+            async def read_stderr():
+                async for line in process.stderr:
+                    stderr.append(line.decode(errors="replace"))
+
+            async def read_progress():
+                async for line in process.stdout:
+                    key, _, value = line.decode(errors="replace").strip().partition("=")
+
+                    # out_time_ms is in microseconds too
+                    if key != "out_time_us" or not value.isdigit() or on_progress is None:
+                        continue
+
+                    seconds = int(value) / 1e6
+                    fraction = min(seconds / duration, 1.0) if duration else None
+                    on_progress(fraction, seconds)
+
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(read_stderr(), read_progress(), process.wait()),
+                    timeout,
+                )
+            finally:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+
+            if process.returncode != 0:
+                raise TranscodeError(process.returncode, "".join(stderr))
+
+
+transcoder = Transcoder()
@@ -0,0 +1,213 @@
+import asyncio
+import collections
+import logging
+from typing import Deque, Dict, Hashable, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+SHED_POLICIES = ("drop_oldest", "drop_newest", "coalesce")
+
+# Update types whose later instances fully supersede earlier ones for the same target
+COALESCIBLE_UPDATES = {
+    "UpdateUserStatus",
+    "UpdateUserTyping",
+    "UpdateChatUserTyping",
+    "UpdateChannelUserTyping",
+    "UpdateReadHistoryInbox",
+    "UpdateReadHistoryOutbox",
+    "UpdateReadChannelInbox",
+    "UpdateReadChannelOutbox",
+    "UpdateReadChannelDiscussionInbox",
+    "UpdateReadChannelDiscussionOutbox",
+    "UpdateChannelMessageViews",
+    "UpdateChannelMessageForwards",
+    "UpdateMessagePoll",
+    "UpdateMessageReactions",
+    "UpdateDraftMessage",
+    "UpdateEditMessage",
+    "UpdateEditChannelMessage",
+    "UpdateChatParticipants",
+    "UpdateUserName",
+    "UpdateUserEmojiStatus",
+}
+
+
+def _peer_id(peer) -> Optional[int]:
+    for attr in ("user_id", "chat_id", "channel_id"):
+        value = getattr(peer, attr, None)
+        if value is not None:
+            return value
+
+    return None
+
+
+def is_outgoing(update) -> bool:
+    """Returns True if update carries a message sent by the current account"""
+    message = getattr(update, "message", None)
+
+    return bool(getattr(message, "out", False))
+
+
+def coalesce_key(update) -> Optional[Hashable]:
+    """Returns key identifying what the update refers to, or None if it can't be merged"""
+    name = type(update).__name__
+
+    if name not in COALESCIBLE_UPDATES:
+        return None
+
+    message = getattr(update, "message", None)
+    target = (
+        _peer_id(getattr(message, "peer_id", None)),
+        getattr(message, "id", None),
+    )
+
+    for attr in ("user_id", "channel_id", "chat_id", "poll_id", "msg_id"):
+        value = getattr(update, attr, None)
+        if value is not None:
+            target += (value,)
+
+    peer = getattr(update, "peer", None)
+    if peer is not None:
+        target += (_peer_id(peer),)
+
+    return name, target
+
+
+class UpdateQueue:
+    """Bounded two-level priority queue used in place of the dispatcher updates queue.
+
+    Outgoing messages (own commands) always go first and are never shed. Everything else
+    is limited by ``maxsize``: when the queue is full the incoming update is handled by
+    the shedding policy:
+
+    - ``drop_oldest``: the oldest low-priority update is discarded;
+    - ``drop_newest``: the incoming update is discarded;
+    - ``coalesce``: the incoming update replaces a queued one with the same target
+      (see :func:`coalesce_key`), otherwise falls back to ``drop_oldest``.
+    """
+
+    def __init__(self, maxsize: int = 10000, policy: str = "coalesce"):
+        if maxsize <= 0:
+            raise ValueError("maxsize should be greater than zero")
+
+        if policy not in SHED_POLICIES:
+            raise ValueError(f"Unknown shed policy {policy}")
+
+        self.maxsize = maxsize
+        self.policy = policy
+
+        self._high: Deque = collections.deque()
+        self._low: Deque = collections.deque()
+        # coalesce key -> queued [packet, key] slot, so replacement happens in place
+        self._keys: Dict[Hashable, list] = {}
+        self._not_empty = asyncio.Event()
+
+        self.stats = collections.Counter()
+
+    def qsize(self) -> int:
+        return len(self._high) + len(self._low)
+
+    def empty(self) -> bool:
+        return not self._high and not self._low
+
+    def full(self) -> bool:
+        return len(self._low) >= self.maxsize
+
+    @property
+    def depth(self) -> Tuple[int, int]:
+        """Returns number of queued (high, low) priority updates"""
+        return len(self._high), len(self._low)
+
+    def _drop_oldest(self) -> None:
+        while self._low:
+            slot = self._low.popleft()
+            if slot[0] is None:
+                # Stop sentinels are never shed
+                self._low.appendleft(slot)
+                return
+
+            key = slot[1]
+            if key is not None and self._keys.get(key) is slot:
+                del self._keys[key]
+
+            self._shed()
+            return
+
+    def _shed(self) -> None:
+        self.stats["shed"] += 1
+
+        if self.stats["shed"] % 1000 == 1:
+            log.warning(
+                "Updates queue is full (%s pending), %s updates shed so far",
+                self.qsize(),
+                self.stats["shed"],
+            )
+
+    def put_nowait(self, packet) -> None:
+        if packet is None:
+            # Dispatcher stop sentinel, must be delivered after everything queued before
+            self._low.append([None, None])
+            self._not_empty.set()
+            return
+
+        update = packet[0]
+
+        if is_outgoing(update):
+            self._high.append([packet, None])
+            self.stats["high"] += 1
+            self._not_empty.set()
+            return
+
+        key = coalesce_key(update) if self.policy == "coalesce" else None
+
+        if key is not None and key in self._keys:
+            self._keys[key][0] = packet
+            self.stats["coalesced"] += 1
+            return
+
+        if self.full():
+            if self.policy == "drop_newest":
+                self._shed()
+                return
+
+            self._drop_oldest()
+
+            if self.full():
+                self._shed()
+                return
+
+        slot = [packet, key]
+        self._low.append(slot)
+
+        if key is not None:
+            self._keys[key] = slot
+
+        self.stats["low"] += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.qsize())
+        self._not_empty.set()
+
+    async def put(self, packet) -> None:
+        self.put_nowait(packet)
+
+    def get_nowait(self):
+        if self._high:
+            slot = self._high.popleft()
+        elif self._low:
+            slot = self._low.popleft()
+        else:
+            raise asyncio.QueueEmpty
+
+        key = slot[1]
+        if key is not None and self._keys.get(key) is slot:
+            del self._keys[key]
+
+        if self.empty():
+            self._not_empty.clear()
+
+        return slot[0]
+
+    async def get(self):
+        while self.empty():
+            await self._not_empty.wait()
+
+        return self.get_nowait()